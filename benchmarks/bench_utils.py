@@ -0,0 +1,251 @@
+"""
+Microbenchmarks of the text-processing functions that run on every message, with regression
+gates against a stored baseline:
+
+    python -m benchmarks.bench_utils                     # compare against the baseline
+    python -m benchmarks.bench_utils --update-baseline   # record a new baseline
+
+The run exits with status 1 when a function regresses in ns/message or in allocated bytes per
+message by more than the threshold, or when a local classifier assigns an intent to one of the
+off-topic messages. Timings depend on the machine, so the baseline should be
+recorded on the same machine that runs the gate.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+from utils.intenciones import clasificar_aproximado, clasificar_con_erratas
+from utils.utils_methods import (
+    clasificar_mensaje,
+    mensaje_de_despedida,
+    mensaje_relacionado_con_otro_tema,
+    mensaje_relacionado_con_temas,
+    normalize_text,
+)
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+CORTOS = [
+    "hola",
+    "¿Qué es pediculosis?",
+    "¿cómo se cura?",
+    "muéstrame una imagen",
+    "gracias, adiós",
+    "¿los parásitos son peligrosos?",
+    "ok",
+    "no entiendo",
+]
+
+LARGOS = [
+    (
+        "Hola, buenas tardes. Mi hija de siete años volvió del colegio rascándose la cabeza y "
+        "encontramos unos puntitos blancos pegados al pelo cerca de la nuca. La maestra nos dijo "
+        "que hay varios niños con lo mismo en su clase. ¿Qué tratamiento me recomiendas, cada "
+        "cuánto hay que repetirlo y qué debo hacer con la ropa de cama, los peines y los "
+        "peluches?"
+    ),
+    (
+        "Buenos días. Hace unas semanas tengo dolor de barriga, cansancio y he bajado de peso "
+        "sin motivo. Mi médico me pidió un examen de heces porque sospecha de algún parásito "
+        "intestinal. ¿Cómo se contagian normalmente, qué síntomas son los más habituales y "
+        "cuánto dura el tratamiento si el resultado es positivo? También quisiera saber si mi "
+        "familia debe tratarse."
+    ),
+]
+
+# Mensajes largos sin ninguna palabra clave: el peor caso para el clasificador
+ADVERSARIOS = [
+    (
+        "El sábado fuimos al mercado a comprar manzanas, naranjas y un kilo de arroz. Después "
+        "tomamos un autobús hasta la playa, caminamos por la orilla y volvimos cuando ya estaba "
+        "oscuro. Mañana quiero ordenar el garaje, llamar a mi abuela y terminar de leer mi libro."
+    ),
+    "zzzz qwerty asdfgh " * 20,
+    "¿" * 200,
+]
+
+CORPUS = {"cortos": CORTOS, "largos": LARGOS, "adversarios": ADVERSARIOS}
+
+# Mensajes fuera de tema que ninguna capa local debe asignar a un tema, a imágenes ni a una
+# despedida
+FUERA_DE_TEMA = [
+    "que hora es",
+    "evitame la fatiga",
+    "evitame problemas",
+    "que tal el clima hoy",
+    "hola como estas",
+    "cual es la capital de francia",
+    "me gusta el futbol",
+    "quiero comprar un auto",
+    "cuentame un chiste",
+    "como esta tu familia",
+    "me duele la espalda",
+    "recomiendame una pelicula",
+    "voy a lavar el carro",
+]
+
+FUNCIONES = {
+    "normalize_text": normalize_text,
+    "clasificar_mensaje": clasificar_mensaje,
+    "mensaje_relacionado_con_temas": lambda texto: mensaje_relacionado_con_temas(
+        texto, "pediculosis"
+    ),
+    "mensaje_relacionado_con_otro_tema": lambda texto: mensaje_relacionado_con_otro_tema(
+        texto, "pediculosis"
+    ),
+    "mensaje_de_despedida": mensaje_de_despedida,
+    "solicitud_de_imagen": lambda texto: clasificar_mensaje(texto).imagen,
+    "clasificar_con_erratas": clasificar_con_erratas,
+    "clasificar_aproximado": clasificar_aproximado,
+}
+
+
+def _tiempo_por_mensaje(funcion, mensajes, repeticiones, rondas):
+    # Mediana de varias rondas para reducir el ruido
+    resultados = []
+    for _ in range(rondas):
+        inicio = time.perf_counter_ns()
+        for _ in range(repeticiones):
+            for mensaje in mensajes:
+                funcion(mensaje)
+        resultados.append((time.perf_counter_ns() - inicio) / (repeticiones * len(mensajes)))
+    return statistics.median(resultados)
+
+
+def _bytes_por_mensaje(funcion, mensajes):
+    # Pico de memoria asignada durante cada llamada
+    picos = []
+    tracemalloc.start()
+    for mensaje in mensajes:
+        tracemalloc.reset_peak()
+        actual = tracemalloc.get_traced_memory()[0]
+        funcion(mensaje)
+        picos.append(tracemalloc.get_traced_memory()[1] - actual)
+    tracemalloc.stop()
+    return statistics.fmean(picos)
+
+
+def medir(repeticiones, rondas):
+    """
+    The function `medir` benchmarks every function over every corpus.
+
+    :return: A dictionary `{funcion: {corpus: {"ns": ..., "bytes": ...}}}`.
+    """
+    resultados = {}
+    for nombre, funcion in FUNCIONES.items():
+        for corpus, mensajes in CORPUS.items():
+            # Calentar antes de medir
+            for mensaje in mensajes:
+                funcion(mensaje)
+            resultados.setdefault(nombre, {})[corpus] = {
+                "ns": _tiempo_por_mensaje(funcion, mensajes, repeticiones, rondas),
+                "bytes": _bytes_por_mensaje(funcion, mensajes),
+            }
+    return resultados
+
+
+def comparar(resultados, base, umbral_tiempo, umbral_memoria):
+    """
+    The function `comparar` checks the results against the baseline.
+
+    :return: A list with a description of every regression past the thresholds.
+    """
+    regresiones = []
+    for nombre, por_corpus in resultados.items():
+        for corpus, medida in por_corpus.items():
+            anterior = base.get(nombre, {}).get(corpus)
+            if anterior is None:
+                continue
+            if medida["ns"] > anterior["ns"] * (1 + umbral_tiempo):
+                regresiones.append(
+                    f"{nombre}[{corpus}]: {medida['ns']:.0f} ns/mensaje "
+                    f"(base {anterior['ns']:.0f})"
+                )
+            # Margen absoluto para no fallar por unos pocos bytes
+            if medida["bytes"] > anterior["bytes"] * (1 + umbral_memoria) + 64:
+                regresiones.append(
+                    f"{nombre}[{corpus}]: {medida['bytes']:.0f} bytes/mensaje "
+                    f"(base {anterior['bytes']:.0f})"
+                )
+    return regresiones
+
+
+def falsos_positivos():
+    """
+    The function `falsos_positivos` classifies the off-topic messages with every local layer: exact
+    keywords, keywords with typos and the n-gram model.
+
+    :return: A list with a description of every off-topic message that was given an intent.
+    """
+    falsos = []
+    for mensaje in FUERA_DE_TEMA:
+        for nombre in ("clasificar_mensaje", "clasificar_con_erratas", "clasificar_aproximado"):
+            clasificacion = FUNCIONES[nombre](mensaje)
+            if not clasificacion.vacia:
+                falsos.append(f"{nombre}({mensaje!r}): {clasificacion}")
+    return falsos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--time-threshold", type=float, default=0.30)
+    parser.add_argument("--memory-threshold", type=float, default=0.20)
+    args = parser.parse_args()
+
+    # Los registros INFO de las funciones no forman parte de lo que se mide
+    logging.disable(logging.INFO)
+    resultados = medir(args.repeat, args.rounds)
+
+    base = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as archivo:
+            base = json.load(archivo)["resultados"]
+
+    print(f"{'función':<36}{'corpus':<13}{'ns/mensaje':>12}{'base':>10}{'bytes':>9}{'base':>9}")
+    for nombre, por_corpus in resultados.items():
+        for corpus, medida in por_corpus.items():
+            anterior = base.get(nombre, {}).get(corpus, {})
+            print(
+                f"{nombre:<36}{corpus:<13}{medida['ns']:>12.0f}"
+                f"{anterior.get('ns', float('nan')):>10.0f}"
+                f"{medida['bytes']:>9.0f}{anterior.get('bytes', float('nan')):>9.0f}"
+            )
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as archivo:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "maquina": platform.machine(),
+                    "resultados": resultados,
+                },
+                archivo,
+                indent=2,
+            )
+            archivo.write("\n")
+        print(f"Línea base guardada en {args.baseline}")
+        return
+
+    regresiones = comparar(resultados, base, args.time_threshold, args.memory_threshold)
+    for regresion in regresiones:
+        print(f"REGRESIÓN: {regresion}")
+    falsos = falsos_positivos()
+    for falso in falsos:
+        print(f"FALSO POSITIVO: {falso}")
+    sys.exit(1 if regresiones or falsos else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,116 @@
-from dotenv import load_dotenv
 import os
-import openai
+
+from dotenv import load_dotenv
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
 # Configurar Dialogflow
 dialogflow_project_id = os.getenv("DIALOGFLOW_PROJECT_ID")
 dialogflow_session_id = "meu_bot_sessao"
-dialogflow_language_code = "es"
\ No newline at end of file
+dialogflow_language_code = "es"
+dialogflow_timeout = float(os.getenv("DIALOGFLOW_TIMEOUT", "10"))
+dialogflow_max_workers = int(os.getenv("DIALOGFLOW_MAX_WORKERS", "4"))
+# Plazo total de una consulta incluyendo los reintentos
+dialogflow_deadline = float(os.getenv("DIALOGFLOW_DEADLINE", "15"))
+dialogflow_retries = int(os.getenv("DIALOGFLOW_RETRIES", "1"))
+dialogflow_slow_call = float(os.getenv("DIALOGFLOW_SLOW_CALL", "3"))
+
+# Configurar OpenAI (el cliente se importa en el primer uso)
+openai_api_key = os.getenv("OPENAI_API_KEY")
+openai_model = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+openai_max_concurrency = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+openai_timeout = float(os.getenv("OPENAI_TIMEOUT", "30"))
+# Plazo total de una respuesta incluyendo los reintentos
+openai_deadline = float(os.getenv("OPENAI_DEADLINE", "40"))
+openai_retries = int(os.getenv("OPENAI_RETRIES", "2"))
+openai_slow_call = float(os.getenv("OPENAI_SLOW_CALL", "15"))
+
+# Configurar los reintentos y los interruptores de los servicios externos
+retry_backoff_base = float(os.getenv("RETRY_BACKOFF_BASE", "0.2"))
+retry_backoff_max = float(os.getenv("RETRY_BACKOFF_MAX", "2"))
+breaker_window = int(os.getenv("BREAKER_WINDOW", "20"))
+breaker_min_calls = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+# Fracción de llamadas fallidas o lentas de la ventana que abre el interruptor
+breaker_error_rate = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+breaker_slow_rate = float(os.getenv("BREAKER_SLOW_RATE", "0.5"))
+breaker_open_seconds = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+
+# Configurar los límites de uso de OpenAI
+rate_limit_user_rpm = float(os.getenv("RATE_LIMIT_USER_RPM", "6"))
+rate_limit_user_tpm = float(os.getenv("RATE_LIMIT_USER_TPM", "10000"))
+rate_limit_global_rpm = float(os.getenv("RATE_LIMIT_GLOBAL_RPM", "300"))
+rate_limit_global_tpm = float(os.getenv("RATE_LIMIT_GLOBAL_TPM", "80000"))
+# "queue" espera hasta RATE_LIMIT_MAX_WAIT segundos, "reject" rechaza de inmediato
+rate_limit_mode = os.getenv("RATE_LIMIT_MODE", "queue")
+rate_limit_max_wait = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5"))
+
+# Configurar Telegram
+telegram_streaming = os.getenv("TELEGRAM_STREAMING", "true").lower() == "true"
+telegram_edit_interval = float(os.getenv("TELEGRAM_EDIT_INTERVAL", "1.5"))
+# "webhook" o "polling" (solo main_v2 admite webhook)
+telegram_mode = os.getenv("TELEGRAM_MODE", "polling")
+telegram_webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL", os.getenv("RENDER_EXTERNAL_URL"))
+telegram_webhook_secret = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+telegram_max_concurrent_updates = int(os.getenv("TELEGRAM_MAX_CONCURRENT_UPDATES", "32"))
+
+# Configurar la cola de envíos a Telegram
+telegram_send_queue = os.getenv("TELEGRAM_SEND_QUEUE", "true").lower() == "true"
+# Mensajes por segundo a todos los chats y a cada chat privado, y por minuto a cada grupo
+telegram_global_rate = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+telegram_chat_rate = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+telegram_chat_burst = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+telegram_group_rate = float(os.getenv("TELEGRAM_GROUP_RATE", "20"))
+telegram_send_retries = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+
+# Inicializar los clientes de OpenAI y Dialogflow en segundo plano al arrancar
+startup_warmup = os.getenv("STARTUP_WARMUP", "true").lower() == "true"
+
+# Configurar el historial de conversación
+history_token_budget = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+history_summary_tokens = int(os.getenv("HISTORY_SUMMARY_TOKENS", "200"))
+
+# Configurar la caché de preguntas frecuentes
+faq_cache_size = int(os.getenv("FAQ_CACHE_SIZE", "512"))
+faq_cache_ttl = float(os.getenv("FAQ_CACHE_TTL", "86400"))
+faq_warmup = os.getenv("FAQ_WARMUP", "false").lower() == "true"
+
+# Configurar el catálogo de tarjetas
+card_catalog_ttl = float(os.getenv("CARD_CATALOG_TTL", "3600"))
+card_catalog_snapshot = os.getenv("CARD_CATALOG_SNAPSHOT")
+card_catalog_offline = os.getenv("CARD_CATALOG_OFFLINE", "false").lower() == "true"
+card_catalog_prefetch = os.getenv("CARD_CATALOG_PREFETCH", "true").lower() == "true"
+
+# Configurar las sesiones de usuario
+session_max = int(os.getenv("SESSION_MAX", "10000"))
+session_ttl = float(os.getenv("SESSION_TTL", "21600"))
+session_backend = os.getenv("SESSION_BACKEND", "sqlite")
+session_db_path = os.getenv("SESSION_DB_PATH", "sesiones.db")
+session_flush_interval = float(os.getenv("SESSION_FLUSH_INTERVAL", "2"))
+
+# Configurar los registros
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+# Niveles por módulo, por ejemplo "httpx=WARNING,utils.catalogo=DEBUG"
+log_levels = os.getenv("LOG_LEVELS", "httpx=WARNING,openai=WARNING")
+log_format = os.getenv("LOG_FORMAT", "json")
+# Fracción de los registros INFO o DEBUG que se escriben (los avisos y errores siempre)
+log_sample_rate = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+log_max_field_length = int(os.getenv("LOG_MAX_FIELD_LENGTH", "200"))
+log_queue_size = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Configurar el clasificador local de intenciones
+intent_classifier = os.getenv("INTENT_CLASSIFIER", "true").lower() == "true"
+intent_threshold = float(os.getenv("INTENT_THRESHOLD", "0.55"))
+# Consultar a Dialogflow cuando la confianza del modelo local es baja
+intent_dialogflow_fallback = (
+    os.getenv("INTENT_DIALOGFLOW_FALLBACK", "false").lower() == "true"
+)
+
+# Configurar la recuperación de pasajes del corpus curado
+rag_enabled = os.getenv("RAG_ENABLED", "true").lower() == "true"
+rag_index_path = os.getenv("RAG_INDEX_PATH", "conocimiento/indice")
+rag_top_k = int(os.getenv("RAG_TOP_K", "3"))
+# Puntuación BM25 mínima de un pasaje para incluirlo en el prompt
+rag_min_score = float(os.getenv("RAG_MIN_SCORE", "2"))
+# Cobertura de la pregunta a partir de la cual se responde con el pasaje sin llamar a OpenAI
+rag_answer_threshold = float(os.getenv("RAG_ANSWER_THRESHOLD", "0.85"))
+rag_max_tokens = int(os.getenv("RAG_MAX_TOKENS", "300"))
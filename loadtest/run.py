@@ -0,0 +1,300 @@
+"""
+Load test of the bot's update handler against local stub servers of OpenAI, Dialogflow and the
+Telegram Bot API. It needs no network access:
+
+    python -m loadtest.run --users 200 --openai-latency 0.8 --max-p95 2.5
+
+Every simulated user walks the full flow (greeting, name, topic, questions, image request,
+farewell and confirmation). The run exits with status 1 when a threshold is not met.
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import logging
+import os
+import resource
+import statistics
+import sys
+import time
+from collections import Counter
+
+# Valores por defecto del entorno de prueba, antes de importar la configuración del bot
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+os.environ.setdefault("CARD_CATALOG_PREFETCH", "false")
+os.environ.setdefault("FAQ_WARMUP", "false")
+os.environ.setdefault("RATE_LIMIT_USER_RPM", "100000")
+os.environ.setdefault("RATE_LIMIT_USER_TPM", "100000000")
+os.environ.setdefault("RATE_LIMIT_GLOBAL_RPM", "100000")
+os.environ.setdefault("RATE_LIMIT_GLOBAL_TPM", "100000000")
+os.environ.setdefault("TELEGRAM_EDIT_INTERVAL", "0.2")
+
+import dialogflow_v2 as dialogflow
+import grpc
+import openai
+from telegram import Update
+from telegram.ext import (
+    Application,
+    CallbackQueryHandler,
+    MessageHandler,
+    filters,
+)
+
+from conf.settings import telegram_send_queue
+from loadtest.stubs import (
+    DialogflowServicer,
+    OpenAIStub,
+    Perfil,
+    TelegramStub,
+    iniciar_grpc,
+    iniciar_http,
+)
+from utils.conversacion import manejar_callback, manejar_mensaje
+from utils.dialogflow_client import establecer_cliente
+from utils.dispatcher import ProcesadorPorUsuario
+from utils.envios import planificador
+from utils.sesiones import sesiones
+
+TOKEN = "123456:stub"
+BOT = {"id": 1, "is_bot": True, "first_name": "Stub"}
+
+PREGUNTAS = [
+    "¿Qué es pediculosis?",
+    "¿cuáles son los síntomas de pediculosis?",
+    "¿Cómo se trata la pediculosis en niños pequeños que van al colegio?",
+    "¿Es común la pediculosis?",
+    "¿como se previene la pediculosis",
+]
+
+
+def _argumentos():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entrypoint", default="main", choices=["main", "main_v2"])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--questions", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--log-level", default="WARNING")
+    for upstream, latencia in (("openai", 0.5), ("dialogflow", 0.2), ("telegram", 0.02)):
+        parser.add_argument(f"--{upstream}-latency", type=float, default=latencia)
+        parser.add_argument(f"--{upstream}-jitter", type=float, default=latencia / 2)
+        parser.add_argument(f"--{upstream}-error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--telegram-global-limit", type=float, default=0.0, help="Stub 429s above these msg/s"
+    )
+    parser.add_argument(
+        "--telegram-chat-limit", type=float, default=0.0, help="Stub 429s above these msg/s per chat"
+    )
+    parser.add_argument("--max-p95", type=float, help="Fail if the p95 latency (s) exceeds it")
+    parser.add_argument("--max-p99", type=float, help="Fail if the p99 latency (s) exceeds it")
+    parser.add_argument("--min-throughput", type=float, help="Fail below these updates/s")
+    parser.add_argument("--max-error-rate", type=float, help="Fail above this handler error rate")
+    parser.add_argument("--max-memory-mb", type=float, help="Fail above this RSS growth (MB)")
+    return parser.parse_args()
+
+
+class Simulador:
+    """
+    Builds synthetic Telegram updates for a simulated user.
+    """
+
+    _update_ids = itertools.count(1)
+
+    def __init__(self, bot, user_id):
+        self.bot = bot
+        self.user_id = user_id
+        self.usuario = {"id": user_id, "is_bot": False, "first_name": f"Usuario{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+
+    def _mensaje(self, texto):
+        return {
+            "message_id": next(self._update_ids),
+            "date": int(time.time()),
+            "chat": self.chat,
+            "from": self.usuario,
+            "text": texto,
+        }
+
+    def mensaje(self, texto):
+        return Update.de_json(
+            {"update_id": next(self._update_ids), "message": self._mensaje(texto)}, self.bot
+        )
+
+    def boton(self, data):
+        return Update.de_json(
+            {
+                "update_id": next(self._update_ids),
+                "callback_query": {
+                    "id": str(next(self._update_ids)),
+                    "from": self.usuario,
+                    "chat_instance": str(self.user_id),
+                    "data": data,
+                    "message": {**self._mensaje("menu"), "from": BOT},
+                },
+            },
+            self.bot,
+        )
+
+    def recorrido(self, preguntas):
+        """
+        The method `recorrido` returns the steps of the full conversation as `(etapa, update)` pairs.
+        """
+        pasos = [
+            ("saludo", self.mensaje("Hola")),
+            ("nombre", self.mensaje(f"Usuario{self.user_id}")),
+            ("tema", self.boton("pediculosis")),
+        ]
+        for indice in range(preguntas):
+            pregunta = PREGUNTAS[(self.user_id + indice) % len(PREGUNTAS)]
+            pasos.append(("pregunta", self.mensaje(pregunta)))
+        pasos += [
+            ("imagen", self.mensaje("muéstrame una imagen")),
+            ("despedida", self.mensaje("gracias, adiós")),
+            ("confirmacion", self.boton("confirm_si")),
+        ]
+        return pasos
+
+
+def _percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados)) - 1))
+    return ordenados[indice]
+
+
+def _rss_mb():
+    # ru_maxrss está en KB en Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def ejecutar(args):
+    perfiles = {
+        nombre: Perfil(
+            getattr(args, f"{nombre}_latency"),
+            getattr(args, f"{nombre}_jitter"),
+            getattr(args, f"{nombre}_error_rate"),
+        )
+        for nombre in ("openai", "dialogflow", "telegram")
+    }
+    openai_runner, openai_url = await iniciar_http(OpenAIStub(perfiles["openai"]).app)
+    telegram_stub = TelegramStub(
+        perfiles["telegram"], args.telegram_global_limit, args.telegram_chat_limit
+    )
+    telegram_runner, telegram_url = await iniciar_http(telegram_stub.app)
+    servidor_grpc, direccion_grpc = iniciar_grpc(DialogflowServicer(perfiles["dialogflow"]))
+
+    openai.api_base = f"{openai_url}/v1"
+    establecer_cliente(dialogflow.SessionsClient(channel=grpc.insecure_channel(direccion_grpc)))
+
+    # El punto de entrada configura los registros y las métricas al importarse
+    importlib.import_module(args.entrypoint)
+    logging.getLogger().setLevel(args.log_level)
+    errores = []
+
+    async def registrar_error(update, context):
+        errores.append(context.error)
+
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"{telegram_url}/bot")
+        .concurrent_updates(ProcesadorPorUsuario(args.concurrency))
+        .updater(None)
+    )
+    if telegram_send_queue:
+        builder = builder.rate_limiter(planificador)
+    application = builder.build()
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, manejar_mensaje))
+    application.add_handler(CallbackQueryHandler(manejar_callback))
+    application.add_error_handler(registrar_error)
+    await application.initialize()
+
+    latencias = {}
+
+    async def procesar(etapa, update):
+        inicio = time.perf_counter()
+        await application.update_processor.process_update(
+            update, application.process_update(update)
+        )
+        latencias.setdefault(etapa, []).append(time.perf_counter() - inicio)
+
+    async def usuario(user_id):
+        for etapa, update in Simulador(application.bot, user_id).recorrido(args.questions):
+            await procesar(etapa, update)
+            if args.think_time:
+                await asyncio.sleep(args.think_time)
+
+    memoria_inicial = _rss_mb()
+    inicio = time.perf_counter()
+    await asyncio.gather(*(usuario(10_000 + indice) for indice in range(args.users)))
+    duracion = time.perf_counter() - inicio
+    memoria_final = _rss_mb()
+
+    await application.shutdown()
+    await openai_runner.cleanup()
+    await telegram_runner.cleanup()
+    servidor_grpc.stop(None)
+
+    todas = [valor for valores in latencias.values() for valor in valores]
+    resultado = {
+        "updates": len(todas),
+        "duracion": duracion,
+        "throughput": len(todas) / duracion,
+        "p50": _percentil(todas, 50),
+        "p95": _percentil(todas, 95),
+        "p99": _percentil(todas, 99),
+        "error_rate": len(errores) / len(todas) if todas else 0.0,
+        "memoria_mb": memoria_final - memoria_inicial,
+    }
+
+    print(f"Usuarios: {args.users}  Actualizaciones: {resultado['updates']}  Duración: {duracion:.2f}s")
+    print(f"Throughput: {resultado['throughput']:.1f} actualizaciones/s")
+    print(f"{'etapa':<14}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'media':>10}")
+    for etapa, valores in list(latencias.items()) + [("total", todas)]:
+        print(
+            f"{etapa:<14}{len(valores):>7}"
+            f"{_percentil(valores, 50):>10.3f}{_percentil(valores, 95):>10.3f}"
+            f"{_percentil(valores, 99):>10.3f}{statistics.fmean(valores):>10.3f}"
+        )
+    print(f"Errores en el handler: {len(errores)} ({resultado['error_rate']:.2%})")
+    if errores:
+        tipos = Counter(f"{type(error).__name__}: {error}"[:80] for error in errores)
+        print(f"Tipos de error: {dict(tipos.most_common(5))}")
+    for nombre, perfil in perfiles.items():
+        print(f"Upstream {nombre}: {perfil.solicitudes} solicitudes, {perfil.errores} errores inyectados")
+    print(f"Llamadas a Telegram: {dict(sorted(telegram_stub.llamadas.items()))}")
+    print(f"Rechazadas por los límites de Telegram: {telegram_stub.limitadas}")
+    print(
+        f"Memoria: +{resultado['memoria_mb']:.1f} MB RSS, "
+        f"{sesiones.memoria() / 1024:.1f} KB en {len(sesiones)} sesiones"
+    )
+    return resultado
+
+
+def _verificar(args, resultado):
+    fallos = []
+    if args.max_p95 is not None and resultado["p95"] > args.max_p95:
+        fallos.append(f"p95 {resultado['p95']:.3f}s > {args.max_p95}s")
+    if args.max_p99 is not None and resultado["p99"] > args.max_p99:
+        fallos.append(f"p99 {resultado['p99']:.3f}s > {args.max_p99}s")
+    if args.min_throughput is not None and resultado["throughput"] < args.min_throughput:
+        fallos.append(f"throughput {resultado['throughput']:.1f}/s < {args.min_throughput}/s")
+    if args.max_error_rate is not None and resultado["error_rate"] > args.max_error_rate:
+        fallos.append(f"error rate {resultado['error_rate']:.2%} > {args.max_error_rate:.2%}")
+    if args.max_memory_mb is not None and resultado["memoria_mb"] > args.max_memory_mb:
+        fallos.append(f"memoria +{resultado['memoria_mb']:.1f} MB > {args.max_memory_mb} MB")
+    return fallos
+
+
+def main():
+    args = _argumentos()
+    resultado = asyncio.run(ejecutar(args))
+    fallos = _verificar(args, resultado)
+    for fallo in fallos:
+        print(f"FALLO: {fallo}")
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == "__main__":
+    main()
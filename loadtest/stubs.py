@@ -0,0 +1,226 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+from concurrent import futures
+
+import grpc
+from aiohttp import web
+from dialogflow_v2.proto import session_pb2, session_pb2_grpc
+
+from utils.rate_limit import TokenBucket
+
+# Respuesta simulada de OpenAI, se envía por palabras en modo streaming
+RESPUESTA_OPENAI = (
+    "La pediculosis es la infestación del cuero cabelludo por piojos. Se trata con "
+    "champús pediculicidas, peinado con lendrera y lavado de la ropa de cama."
+)
+
+
+class Perfil:
+    """
+    Latency and error injection settings of a stub upstream.
+    """
+
+    def __init__(self, latencia=0.0, jitter=0.0, error_rate=0.0):
+        """
+        :param latencia: Base latency in seconds added to every request.
+        :param jitter: Maximum random latency in seconds added on top of the base latency.
+        :param error_rate: Probability (0-1) of answering a request with an error.
+        """
+        self.latencia = latencia
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.solicitudes = 0
+        self.errores = 0
+
+    def demora(self):
+        return self.latencia + random.uniform(0, self.jitter)
+
+    def fallar(self):
+        self.solicitudes += 1
+        if random.random() < self.error_rate:
+            self.errores += 1
+            return True
+        return False
+
+
+# Servidor simulado de la API de OpenAI
+class OpenAIStub:
+    def __init__(self, perfil):
+        self.perfil = perfil
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.chat_completions)
+
+    async def chat_completions(self, request):
+        cuerpo = await request.json()
+        await asyncio.sleep(self.perfil.demora())
+        if self.perfil.fallar():
+            return web.json_response(
+                {"error": {"message": "Simulated error", "type": "server_error"}},
+                status=500,
+            )
+        if not cuerpo.get("stream"):
+            return web.json_response(
+                {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "model": cuerpo["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": RESPUESTA_OPENAI},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                }
+            )
+
+        respuesta = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await respuesta.prepare(request)
+        for palabra in RESPUESTA_OPENAI.split(" "):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "model": cuerpo["model"],
+                "choices": [{"index": 0, "delta": {"content": palabra + " "}}],
+            }
+            await respuesta.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(0.005)
+        await respuesta.write(b"data: [DONE]\n\n")
+        await respuesta.write_eof()
+        return respuesta
+
+
+# Servidor simulado de la API de bots de Telegram
+class TelegramStub:
+    def __init__(self, perfil, limite_global=0.0, limite_chat=0.0, rafaga_chat=3):
+        """
+        :param perfil: The latency and error injection settings.
+        :param limite_global: Messages per second accepted for all chats; 0 disables the limit.
+        :param limite_chat: Messages per second accepted for each chat; 0 disables the limit.
+        :param rafaga_chat: Messages a chat can receive at once before its limit applies.
+        """
+        self.perfil = perfil
+        self.limite_chat = limite_chat
+        self.rafaga_chat = rafaga_chat
+        self._global = TokenBucket(limite_global, limite_global) if limite_global else None
+        self._chats = {}
+        self.limitadas = 0
+        self.llamadas = {}
+        self._ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{metodo}", self.metodo)
+
+    def _mensaje(self, chat_id, **extra):
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            **extra,
+        }
+
+    def _foto(self):
+        file_id = f"file-{next(self._ids)}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 320, "height": 320}]
+
+    # Responder 429 como Telegram cuando se supera el límite global o el del chat
+    def _limitar(self, chat_id):
+        if chat_id is None:
+            return False
+        buckets = []
+        if self._global is not None:
+            buckets.append(self._global)
+        if self.limite_chat:
+            if chat_id not in self._chats:
+                self._chats[chat_id] = TokenBucket(self.rafaga_chat, self.limite_chat)
+            buckets.append(self._chats[chat_id])
+        if any(bucket.espera(1) for bucket in buckets):
+            self.limitadas += 1
+            return True
+        for bucket in buckets:
+            bucket.consumir(1)
+        return False
+
+    async def metodo(self, request):
+        metodo = request.match_info["metodo"]
+        datos = await request.post()
+        self.llamadas[metodo] = self.llamadas.get(metodo, 0) + 1
+        await asyncio.sleep(self.perfil.demora())
+        if self._limitar(datos.get("chat_id")) or self.perfil.fallar():
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                },
+                status=429,
+            )
+
+        chat_id = datos.get("chat_id")
+        if metodo == "getMe":
+            resultado = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Stub",
+                "username": "stub_bot",
+            }
+        elif metodo in ("sendMessage", "editMessageText"):
+            resultado = self._mensaje(chat_id, text=datos.get("text", ""))
+        elif metodo == "sendPhoto":
+            resultado = self._mensaje(chat_id, photo=self._foto())
+        elif metodo == "sendMediaGroup":
+            media = json.loads(datos.get("media", "[]"))
+            resultado = [self._mensaje(chat_id, photo=self._foto()) for _ in media]
+        else:
+            resultado = True
+        return web.json_response({"ok": True, "result": resultado})
+
+
+# Servidor simulado de Dialogflow (gRPC)
+class DialogflowServicer(session_pb2_grpc.SessionsServicer):
+    def __init__(self, perfil):
+        self.perfil = perfil
+
+    def DetectIntent(self, request, context):
+        time.sleep(self.perfil.demora())
+        if self.perfil.fallar():
+            context.abort(grpc.StatusCode.UNAVAILABLE, "Simulated error")
+        respuesta = session_pb2.DetectIntentResponse()
+        for tema in ("pediculosis", "parasitismo"):
+            mensaje = respuesta.query_result.fulfillment_messages.add()
+            mensaje.card.title = tema
+            mensaje.card.image_uri = f"https://example.com/{tema}.png"
+            boton = mensaje.card.buttons.add()
+            boton.text = "Más información"
+            boton.postback = f"https://example.com/{tema}"
+        return respuesta
+
+
+async def iniciar_http(app, puerto=0):
+    """
+    The function `iniciar_http` starts an aiohttp application on a free local port.
+
+    :return: A tuple `(runner, url)` with the runner to stop it and its base URL.
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sitio = web.TCPSite(runner, "127.0.0.1", puerto)
+    await sitio.start()
+    puerto = sitio._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{puerto}"
+
+
+def iniciar_grpc(servicer, max_workers=16):
+    """
+    The function `iniciar_grpc` starts the Dialogflow stub on a free local port.
+
+    :return: A tuple `(server, address)`.
+    """
+    servidor = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    session_pb2_grpc.add_SessionsServicer_to_server(servicer, servidor)
+    puerto = servidor.add_insecure_port("127.0.0.1:0")
+    servidor.start()
+    return servidor, f"127.0.0.1:{puerto}"
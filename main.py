@@ -1,241 +1,63 @@
-import os
 import logging
+import os
 
+# El arranque se mide desde aquí: se importa antes que el resto del bot
+from utils.arranque import arranque, calentar, en_segundo_plano
+
+# isort: split
+from telegram import Update
 from telegram.ext import (
     Application,
-    ContextTypes,
-    MessageHandler,
     CallbackQueryHandler,
+    MessageHandler,
     filters,
 )
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from utils.utils_methods import (
-    capitalize_first_letter,
-    handle_user_message,
-    mensaje_relacionado_con_temas,
-    mensaje_de_despedida,
-    generate_response,
-    mensaje_relacionado_con_otro_tema,
-    get_dialogflow_response,
+
+from conf.settings import (
+    faq_warmup,
+    startup_warmup,
+    telegram_max_concurrent_updates,
+    telegram_send_queue,
 )
+from utils.bitacora import configurar_logging
+from utils.catalogo import iniciar_catalogo
+from utils.conversacion import manejar_callback, manejar_mensaje
+from utils.dialogflow_client import obtener_cliente
+from utils.dispatcher import ProcesadorPorUsuario
+from utils.envios import planificador
+from utils.llm_client import obtener_openai
+from utils.recuperacion import obtener_indice
+from utils.sesiones import sesiones
+from utils.utils_methods import precalentar_faq
+
+arranque.marcar("imports")
 
 
 # Configurar logging
-logging.basicConfig(level=logging.INFO)
+configurar_logging()
 logger = logging.getLogger(__name__)
 
-usuarios = {}
-
 
-# Función que se ejecuta cuando se recibe un mensaje
-async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message:
-        user_id = update.message.from_user.id
-        message_text = update.message.text.lower()
-
-        logger.info(f"Mensaje recibido de {user_id}: {message_text}")
-
-        if user_id not in usuarios:
-            await update.message.reply_text("Hola🖐️, ¿cómo estás? ¿Cuál es tu nombre?")
-            usuarios[user_id] = {"messages": [], "name": None, "tema": None}
-        elif usuarios[user_id]["name"] is None:
-            usuarios[user_id]["name"] = message_text
-            keyboard = [
-                [InlineKeyboardButton("Pediculosis", callback_data="pediculosis")],
-                [InlineKeyboardButton("Parasitismo", callback_data="parasitismo")],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(
-                f"Hola 🙋‍♂️ {capitalize_first_letter(message_text)}, bienvenido a Pediculosis y Parasitismo Bot🤖. Escoge una de las siguientes opciones:",
-                reply_markup=reply_markup,
+# Tareas que se ejecutan cuando el bot ya está inicializado
+async def post_init(application: Application):
+    arranque.marcar("initialize")
+    sesiones.iniciar_escritura_diferida()
+    iniciar_catalogo()
+    if startup_warmup:
+        en_segundo_plano(
+            calentar(
+                ("openai", obtener_openai),
+                ("dialogflow", obtener_cliente),
+                ("recuperacion", obtener_indice),
             )
-        elif usuarios[user_id]["tema"] is None:
-            await update.message.reply_text(
-                "Por favor, selecciona una opción del menú."
-            )
-        else:
-            tema_actual = usuarios[user_id]["tema"]
-
-            texto = [
-                "imagen",
-                "muéstrame imagenes",
-                "muéstrame una imagen",
-                "mostrar imagenes",
-                "ver imagenes",
-                "ver una imagen",
-                "imagen",
-                "foto",
-                "ejemplo",
-                "visual",
-                "muestra",
-                "piojos",
-                "infografía",
-                "muéstrame una imagen de pediculosis",
-                "¿tienes fotos de piojos?",
-                "dame un ejemplo visual de pediculosis",
-                "quiero ver una infografía sobre pediculosis",
-                "¿puedes mostrarme cómo se ven los piojos?",
-                "¿tienes imágenes de los síntomas de pediculosis?",
-                "muéstrame fotos de tratamientos para pediculosis",
-                "¿qué aspecto tiene la pediculosis?",
-                "quiero ver una imagen de cómo prevenir la pediculosis"
-                # Imagenes parasitismo
-                "imagen",
-                "foto",
-                "ejemplo",
-                "visual",
-                "muestra",
-                "parásitos",
-                "infografía",
-                "muéstrame una imagen de parasitismo",
-                "¿tienes fotos de parásitos?",
-                "dame un ejemplo visual de parasitismo",
-                "quiero ver una infografía sobre parasitismo",
-                "¿puedes mostrarme cómo se ven los parásitos?",
-                "¿tienes imágenes de los síntomas de parasitismo?",
-                "muéstrame fotos de tratamientos para parasitismo",
-                "¿qué aspecto tienen los parásitos?",
-                "quiero ver una imagen de cómo prevenir el parasitismo"
-            ]
-            # Verificar si el mensaje es una solicitud de imágenes
-            if any(palabra in message_text for palabra in texto):
-                dialogflow_response = get_dialogflow_response(message_text)
-
-                # Filtrar las imágenes según el tema seleccionado
-                mensajes_filtrados = [
-                    msg
-                    for msg in dialogflow_response
-                    if msg.get("title", "").lower() == tema_actual
-                ]
-
-                if mensajes_filtrados:
-                    for msg in mensajes_filtrados:
-                        if msg["type"] == "combined":
-                            await update.message.reply_photo(
-                                photo=msg["photo"],
-                                caption=msg["text"],
-                                reply_markup=InlineKeyboardMarkup([msg["buttons"]]),
-                            )
-                        else:
-                            await update.message.reply_text(msg["text"])
-                else:
-                    await update.message.reply_text(
-                        f"No se encontraron imágenes para el tema {tema_actual}."
-                    )
-                return  # Terminar el manejo aquí
-
-            if mensaje_relacionado_con_temas(message_text, tema_actual):
-                handle_user_message(user_id, message_text)
-                response = generate_response(user_id)
-                logger.info(f"Respuesta generada para {user_id}: {response}")
-                if response:
-                    await update.message.reply_text(response)
-            else:
-                otro_tema = mensaje_relacionado_con_otro_tema(message_text, tema_actual)
-                if otro_tema:
-                    keyboard = [
-                        [
-                            InlineKeyboardButton(
-                                "Volver a seleccionar tema",
-                                callback_data="volver_a_seleccionar",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                f"Seguir con {capitalize_first_letter(tema_actual)}",
-                                callback_data="continuar_con_el_mismo",
-                            )
-                        ],
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await update.message.reply_text(
-                        f"Parece que tu pregunta está relacionada con {otro_tema}. "
-                        f"Sin embargo, seleccionaste el tema {tema_actual}. "
-                        f"Por favor, selecciona el tema correcto o formula una pregunta sobre {tema_actual}.",
-                        reply_markup=reply_markup,
-                    )
-                elif mensaje_de_despedida(message_text):
-                    keyboard = [
-                        [
-                            InlineKeyboardButton(
-                                "SI, Terminar", callback_data="confirm_si"
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "NO, Continuar", callback_data="confirm_no"
-                            )
-                        ],
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await update.message.reply_text(
-                        "¿Fue clara la información o necesitas algo más?",
-                        reply_markup=reply_markup,
-                    )
-                    usuarios[user_id]["esperando_confirmacion"] = True
-                elif usuarios[user_id].get("esperando_confirmacion"):
-                    keyboard = [
-                        [
-                            InlineKeyboardButton(
-                                "SI, Terminar", callback_data="confirm_si"
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "NO, Continuar", callback_data="confirm_no"
-                            )
-                        ],
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await update.message.reply_text(
-                        "Por favor, selecciona una de las opciones propuestas.",
-                        reply_markup=reply_markup,
-                    )
-                else:
-                    logger.info(f"Pregunta fuera de tema de {user_id}: {message_text}")
-                    await update.message.reply_text(
-                        "Este chat está diseñado para responder preguntas sobre pediculosis y parasitismo. Por favor, formula una pregunta relacionada con estos temas."
-                    )
+        )
+    if faq_warmup:
+        en_segundo_plano(precalentar_faq())
 
-    elif update.callback_query:
-        query = update.callback_query
-        user_id = query.from_user.id
-        selected_option = query.data
 
-        if user_id in usuarios:
-            if selected_option == "volver_a_seleccionar":
-                usuarios[user_id]["tema"] = None
-                keyboard = [
-                    [InlineKeyboardButton("Pediculosis", callback_data="pediculosis")],
-                    [InlineKeyboardButton("Parasitismo", callback_data="parasitismo")],
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.message.reply_text(
-                    f"Hola 🙋‍♂️ {capitalize_first_letter(usuarios[user_id]['name'])}, bienvenido a Pediculosis y Parasitismo Bot🤖. Escoge una de las siguientes opciones:",
-                    reply_markup=reply_markup,
-                )
-            elif selected_option == "continuar_con_el_mismo":
-                await query.message.reply_text(
-                    f"Por favor, continúa formulando preguntas sobre {capitalize_first_letter(usuarios[user_id]['tema'])}."
-                )
-            elif selected_option == "confirm_si":
-                await query.message.reply_text(
-                    "Me alegra saber que todo ha sido claro. ¡Hasta luego!"
-                )
-                usuarios.pop(user_id)
-            elif selected_option == "confirm_no":
-                await query.message.reply_text(
-                    "Por favor, dime en qué más puedo ayudarte."
-                )
-                usuarios[user_id]["esperando_confirmacion"] = False
-            elif selected_option in ["pediculosis", "parasitismo"]:
-                usuarios[user_id]["tema"] = selected_option
-                await query.message.reply_text(
-                    f"{capitalize_first_letter(usuarios[user_id]['name'])}, has seleccionado {selected_option}. ¿En qué puedo ayudarte?🤝"
-                )
-            await (
-                query.answer()
-            )  # Responder al callback para evitar que el botón quede en "cargando"
+# Guardar las sesiones pendientes al detener el bot
+async def post_shutdown(application: Application):
+    await sesiones.cerrar()
 
 
 def main():
@@ -246,12 +68,24 @@ def main():
         return
 
     # Crear el bot
-    bot = Application.builder().token(TELEGRAM_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(ProcesadorPorUsuario(telegram_max_concurrent_updates))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if telegram_send_queue:
+        builder = builder.rate_limiter(planificador)
+    bot = builder.build()
+    arranque.marcar("aplicacion")
 
     # Función que se ejecuta cuando se recibe un mensaje
-    bot.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    bot.add_handler(
+        MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, manejar_mensaje)
+    )
     # Función que se ejecuta cuando se recibe un callback query
-    bot.add_handler(CallbackQueryHandler(message_handler))
+    bot.add_handler(CallbackQueryHandler(manejar_callback))
 
     # Ejecutar el bot
     logger.info("Iniciando el bot...")
@@ -1,217 +1,115 @@
-import os
 import logging
-import asyncio
+import os
+import secrets
+import time
 
+# El arranque se mide desde aquí: se importa antes que el resto del bot
+from utils.arranque import arranque, calentar, en_segundo_plano
+
+# isort: split
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
+from telegram import Update
 from telegram.ext import (
     Application,
+    CallbackQueryHandler,
     ContextTypes,
     MessageHandler,
-    CallbackQueryHandler,
     filters,
 )
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from fastapi import FastAPI
-import uvicorn
-from utils.utils_methods import (
-    capitalize_first_letter,
-    handle_user_message,
-    mensaje_relacionado_con_temas,
-    mensaje_de_despedida,
-    generate_response,
-    mensaje_relacionado_con_otro_tema,
-    get_dialogflow_response,
+
+from conf.settings import (
+    faq_warmup,
+    startup_warmup,
+    telegram_max_concurrent_updates,
+    telegram_mode,
+    telegram_send_queue,
+    telegram_webhook_secret,
+    telegram_webhook_url,
 )
+from utils import dialogflow_client, llm_client
+from utils.bitacora import configurar_logging
+from utils.catalogo import catalogo, iniciar_catalogo
+from utils.conversacion import message_handler
+from utils.dialogflow_client import obtener_cliente
+from utils.dispatcher import ProcesadorPorUsuario
+from utils.envios import planificador
+from utils.llm_client import obtener_openai
+from utils.metricas import SolicitudMedida, etapas, registro
+from utils.rate_limit import limitador
+from utils.recuperacion import obtener_indice
+from utils.resiliencia import CERRADO
+from utils.sesiones import sesiones
+from utils.single_flight import vuelos
+from utils.utils_methods import faq_cache, precalentar_faq
+
+arranque.marcar("imports")
 
 # Configuración de FastAPI
 app = FastAPI()
 
 
 # Configurar logging
-logging.basicConfig(level=logging.INFO)
+configurar_logging()
 logger = logging.getLogger(__name__)
 
-usuarios = {}
 bot = None  # Mover la declaración del bot aquí
 
+WEBHOOK_PATH = "/telegram/webhook"
 
-# Función que se ejecuta cuando se recibe un mensaje
-async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_message = update.message.text
-    logger.info(f"Mensaje recibido: {user_message}")
-    if update.message:
-        user_id = update.message.from_user.id
-        message_text = update.message.text.lower()
-
-        logger.info(f"Mensaje recibido de {user_id}: {message_text}")
-
-        if user_id not in usuarios:
-            await update.message.reply_text("Hola🖐️, ¿cómo estás? ¿Cuál es tu nombre?")
-            usuarios[user_id] = {"messages": [], "name": None, "tema": None}
-        elif usuarios[user_id]["name"] is None:
-            usuarios[user_id]["name"] = message_text
-            keyboard = [
-                [InlineKeyboardButton("Pediculosis", callback_data="pediculosis")],
-                [InlineKeyboardButton("Parasitismo", callback_data="parasitismo")],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(
-                f"Hola 🙋‍♂️ {capitalize_first_letter(message_text)}, bienvenido a Pediculosis y Parasitismo Bot🤖. Escoge una de las siguientes opciones:",
-                reply_markup=reply_markup,
-            )
-        elif usuarios[user_id]["tema"] is None:
-            await update.message.reply_text(
-                "Por favor, selecciona una opción del menú."
-            )
-        else:
-            tema_actual = usuarios[user_id]["tema"]
-
-            texto = [
-                "imagen",
-                "muéstrame imagenes",
-                "muéstrame una imagen",
-                "mostrar imagenes",
-                "ver imagenes",
-                "ver una imagen",
-            ]
-            # Verificar si el mensaje es una solicitud de imágenes
-            if any(palabra in message_text for palabra in texto):
-                dialogflow_response = get_dialogflow_response(message_text)
-
-                # Filtrar las imágenes según el tema seleccionado
-                mensajes_filtrados = [
-                    msg
-                    for msg in dialogflow_response
-                    if msg.get("title", "").lower() == tema_actual
-                ]
-
-                if mensajes_filtrados:
-                    for msg in mensajes_filtrados:
-                        if msg["type"] == "combined":
-                            await update.message.reply_photo(
-                                photo=msg["photo"],
-                                caption=msg["text"],
-                                reply_markup=InlineKeyboardMarkup([msg["buttons"]]),
-                            )
-                        else:
-                            await update.message.reply_text(msg["text"])
-                else:
-                    await update.message.reply_text(
-                        f"No se encontraron imágenes para el tema {tema_actual}."
-                    )
-                return  # Terminar el manejo aquí
-
-            if mensaje_relacionado_con_temas(message_text, tema_actual):
-                handle_user_message(user_id, message_text)
-                response = generate_response(user_id)
-                logger.info(f"Respuesta generada para {user_id}: {response}")
-                if response:
-                    await update.message.reply_text(response)
-            else:
-                otro_tema = mensaje_relacionado_con_otro_tema(message_text, tema_actual)
-                if otro_tema:
-                    keyboard = [
-                        [
-                            InlineKeyboardButton(
-                                "Volver a seleccionar tema",
-                                callback_data="volver_a_seleccionar",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                f"Seguir con {capitalize_first_letter(tema_actual)}",
-                                callback_data="continuar_con_el_mismo",
-                            )
-                        ],
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await update.message.reply_text(
-                        f"Parece que tu pregunta está relacionada con {otro_tema}. "
-                        f"Sin embargo, seleccionaste el tema {tema_actual}. "
-                        f"Por favor, selecciona el tema correcto o formula una pregunta sobre {tema_actual}.",
-                        reply_markup=reply_markup,
-                    )
-                elif mensaje_de_despedida(message_text):
-                    keyboard = [
-                        [
-                            InlineKeyboardButton(
-                                "SI, Terminar", callback_data="confirm_si"
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "NO, Continuar", callback_data="confirm_no"
-                            )
-                        ],
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await update.message.reply_text(
-                        "¿Fue clara la información o necesitas algo más?",
-                        reply_markup=reply_markup,
-                    )
-                    usuarios[user_id]["esperando_confirmacion"] = True
-                elif usuarios[user_id].get("esperando_confirmacion"):
-                    keyboard = [
-                        [
-                            InlineKeyboardButton(
-                                "SI, Terminar", callback_data="confirm_si"
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "NO, Continuar", callback_data="confirm_no"
-                            )
-                        ],
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await update.message.reply_text(
-                        "Por favor, selecciona una de las opciones propuestas.",
-                        reply_markup=reply_markup,
-                    )
-                else:
-                    logger.info(f"Pregunta fuera de tema de {user_id}: {message_text}")
-                    await update.message.reply_text(
-                        "Este chat está diseñado para responder preguntas sobre pediculosis y parasitismo. Por favor, formula una pregunta relacionada con estos temas."
-                    )
-
-    elif update.callback_query:
-        query = update.callback_query
-        user_id = query.from_user.id
-        selected_option = query.data
-
-        if user_id in usuarios:
-            if selected_option == "volver_a_seleccionar":
-                usuarios[user_id]["tema"] = None
-                keyboard = [
-                    [InlineKeyboardButton("Pediculosis", callback_data="pediculosis")],
-                    [InlineKeyboardButton("Parasitismo", callback_data="parasitismo")],
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.message.reply_text(
-                    f"Hola 🙋‍♂️ {capitalize_first_letter(usuarios[user_id]['name'])}, bienvenido a Pediculosis y Parasitismo Bot🤖. Escoge una de las siguientes opciones:",
-                    reply_markup=reply_markup,
-                )
-            elif selected_option == "continuar_con_el_mismo":
-                await query.message.reply_text(
-                    f"Por favor, continúa formulando preguntas sobre {capitalize_first_letter(usuarios[user_id]['tema'])}."
-                )
-            elif selected_option == "confirm_si":
-                await query.message.reply_text(
-                    "Me alegra saber que todo ha sido claro. ¡Hasta luego!"
-                )
-                usuarios.pop(user_id)
-            elif selected_option == "confirm_no":
-                await query.message.reply_text(
-                    "Por favor, dime en qué más puedo ayudarte."
-                )
-                usuarios[user_id]["esperando_confirmacion"] = False
-            elif selected_option in ["pediculosis", "parasitismo"]:
-                usuarios[user_id]["tema"] = selected_option
-                await query.message.reply_text(
-                    f"{capitalize_first_letter(usuarios[user_id]['name'])}, has seleccionado {selected_option}. ¿En qué puedo ayudarte?🤝"
-                )
-            await (
-                query.answer()
-            )  # Responder al callback para evitar que el botón quede en "cargando"
+# Métricas que se leen en el momento de exponerlas
+registro.indicador("bot_sesiones_activas", "Sessions kept in memory", lambda: len(sesiones))
+registro.indicador(
+    "bot_sesiones_bytes", "Approximate memory used by the sessions", sesiones.memoria
+)
+registro.indicador(
+    "bot_envios_en_cola", "Telegram calls waiting in the send queue", lambda: planificador.pendientes
+)
+for nombre, ayuda, funcion in (
+    ("bot_sesiones_expulsadas_total", "Sessions evicted by TTL or capacity", lambda: sesiones.expulsadas),
+    ("bot_faq_aciertos_total", "FAQ cache hits", lambda: faq_cache.hits),
+    ("bot_faq_fallos_total", "FAQ cache misses", lambda: faq_cache.misses),
+    ("bot_llamadas_compartidas_total", "Requests served by an identical call in flight", lambda: vuelos.compartidas),
+):
+    registro.indicador(nombre, ayuda, funcion, tipo="counter")
+# Estado del limitador de OpenAI
+for campo, nombre, ayuda, tipo in (
+    ("admitidas", "bot_limite_admitidas_total", "OpenAI calls admitted by the rate limiter", "counter"),
+    ("rechazadas", "bot_limite_rechazadas_total", "OpenAI calls rejected by the rate limiter", "counter"),
+    ("en_espera", "bot_limite_en_espera", "OpenAI calls waiting for rate-limit capacity", "gauge"),
+    ("usuarios", "bot_limite_usuarios", "Users with rate-limit buckets in memory", "gauge"),
+    ("global_solicitudes", "bot_limite_global_solicitudes", "Requests left in the global bucket", "gauge"),
+    ("global_tokens", "bot_limite_global_tokens", "Prompt tokens left in the global bucket", "gauge"),
+):
+    registro.indicador(nombre, ayuda, lambda campo=campo: limitador.estado()[campo], tipo=tipo)
+for servicio, interruptor in (
+    ("openai", llm_client.interruptor),
+    ("dialogflow", dialogflow_client.interruptor),
+):
+    registro.indicador(
+        f"bot_circuito_{servicio}_abierto",
+        f"1 while the circuit breaker of {servicio} is open or half-open",
+        lambda interruptor=interruptor: int(interruptor.estado != CERRADO),
+    )
+
+
+# Medir la duración total de cada actualización
+async def handler_medido(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    inicio = time.perf_counter()
+    try:
+        await message_handler(update, context)
+    finally:
+        latencia = time.perf_counter() - inicio
+        etapas.observar(latencia, "total")
+        logger.info(
+            "Actualización procesada",
+            extra={
+                "user_id": update.effective_user.id if update.effective_user else None,
+                "etapa": "total",
+                "latencia": round(latencia, 4),
+            },
+        )
 
 
 # Iniciar el bot en el evento de inicio de FastAPI
@@ -222,20 +120,119 @@ async def startup_event():
     if not TELEGRAM_TOKEN:
         logger.error("Falta el TELEGRAM_TOKEN en el archivo .env")
         return
+    # Sin secreto cualquiera que conozca la URL podría enviar actualizaciones falsas
+    if telegram_mode == "webhook" and not telegram_webhook_secret:
+        logger.error("El modo webhook necesita TELEGRAM_WEBHOOK_SECRET en el archivo .env")
+        return
+    if telegram_mode == "webhook" and not telegram_webhook_url:
+        logger.error("El modo webhook necesita TELEGRAM_WEBHOOK_URL en el archivo .env")
+        return
 
-    # Crear el bot
-    bot = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Crear el bot (en modo webhook las actualizaciones llegan por FastAPI)
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(ProcesadorPorUsuario(telegram_max_concurrent_updates))
+        .request(SolicitudMedida())
+    )
+    if telegram_mode == "webhook":
+        builder = builder.updater(None)
+    if telegram_send_queue:
+        builder = builder.rate_limiter(planificador)
+    bot = builder.build()
+    arranque.marcar("aplicacion")
 
     # Agregar handlers
-    bot.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-    bot.add_handler(CallbackQueryHandler(message_handler))
+    bot.add_handler(
+        MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, handler_medido)
+    )
+    bot.add_handler(CallbackQueryHandler(handler_medido))
 
     # Iniciar el bot en modo asincrónico
-    logger.info("Iniciando el bot...")
+    logger.info(f"Iniciando el bot en modo {telegram_mode}...")
     await bot.initialize()  # Inicializar la aplicación
-    asyncio.create_task(
-        bot.updater.start_polling()
-    )  # Comenzar a recibir actualizaciones
+    arranque.marcar("initialize")
+    # Abrir las sesiones guardadas antes de recibir la primera actualización
+    sesiones.iniciar_escritura_diferida()
+    await bot.start()  # Procesar las actualizaciones de update_queue
+    if telegram_mode == "webhook":
+        await bot.bot.set_webhook(
+            url=f"{telegram_webhook_url.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=telegram_webhook_secret,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        # Comenzar a recibir actualizaciones por long polling
+        await bot.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    arranque.marcar("recepcion")
+    iniciar_catalogo()
+    if startup_warmup:
+        en_segundo_plano(
+            calentar(
+                ("openai", obtener_openai),
+                ("dialogflow", obtener_cliente),
+                ("recuperacion", obtener_indice),
+            )
+        )
+    if faq_warmup:
+        en_segundo_plano(precalentar_faq())
+
+
+# Detener el bot y guardar las sesiones pendientes al detener el servidor
+@app.on_event("shutdown")
+async def shutdown_event():
+    if bot is not None:
+        if telegram_mode == "webhook":
+            await bot.bot.delete_webhook()
+        elif bot.updater.running:
+            await bot.updater.stop()
+        if bot.running:
+            await bot.stop()
+        await bot.shutdown()
+    await sesiones.cerrar()
+
+
+# Recibir las actualizaciones que envía Telegram
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    secreto = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not telegram_webhook_secret or not secrets.compare_digest(
+        secreto, telegram_webhook_secret
+    ):
+        return Response(status_code=403)
+    if bot is None:
+        return Response(status_code=503)
+    update = Update.de_json(await request.json(), bot.bot)
+    await bot.update_queue.put(update)
+    return {"ok": True}
+
+
+# Métricas en el formato de texto de Prometheus
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(
+        registro.exponer(), media_type="text/plain; version=0.0.4"
+    )
+
+
+# Listo cuando el bot recibe actualizaciones y, si se calientan al arrancar, los clientes
+# externos ya están inicializados
+@app.get("/ready")
+async def ready():
+    informe = arranque.informe()
+    estado = {
+        "bot": bot is not None and bot.running,
+        "openai": "openai" in informe["clientes"],
+        "dialogflow": "dialogflow" in informe["clientes"],
+        "catalogo": bool(catalogo),
+    }
+    listo = estado["bot"] and (
+        not startup_warmup or (estado["openai"] and estado["dialogflow"])
+    )
+    return JSONResponse(
+        {"listo": listo, "estado": estado, "arranque": informe},
+        status_code=200 if listo else 503,
+    )
 
 
 @app.get("/")
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Arranque:
+    """
+    Records how long each startup phase takes, measured from the moment the bot starts being
+    imported, and the warm state of the upstream clients.
+    """
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self._anterior = self.inicio
+        self.fases = {}
+        # Clientes ya inicializados (openai, dialogflow)
+        self.clientes = {}
+        self.primera_respuesta = None
+
+    def marcar(self, fase):
+        """
+        The method `marcar` closes a phase that started when the previous one ended.
+
+        :param fase: The name of the phase.
+        """
+        ahora = time.perf_counter()
+        self.fases[fase] = round(ahora - self._anterior, 4)
+        self._anterior = ahora
+
+    def cliente_listo(self, nombre, segundos):
+        """
+        The method `cliente_listo` records that an upstream client finished its initialization.
+
+        :param nombre: The name of the client.
+        :param segundos: The time spent initializing it.
+        """
+        self.clientes[nombre] = round(segundos, 4)
+
+    def respuesta_enviada(self):
+        """
+        The method `respuesta_enviada` records the time from startup to the first handled update.
+        """
+        if self.primera_respuesta is None:
+            self.primera_respuesta = round(time.perf_counter() - self.inicio, 4)
+            logger.info(
+                "Primera respuesta enviada",
+                extra={"etapa": "arranque", "latencia": self.primera_respuesta},
+            )
+
+    def informe(self):
+        """
+        The method `informe` reports the startup timings.
+
+        :return: A dictionary with the duration of every phase, the initialization time of every
+        warm client, the time to the first reply and the total elapsed time.
+        """
+        return {
+            "fases": dict(self.fases),
+            "clientes": dict(self.clientes),
+            "primera_respuesta": self.primera_respuesta,
+            "desde_inicio": round(time.perf_counter() - self.inicio, 4),
+        }
+
+
+arranque = Arranque()
+
+# Tareas lanzadas al arrancar: el bucle solo guarda una referencia débil a ellas
+_tareas = set()
+
+
+def _terminada(tarea):
+    _tareas.discard(tarea)
+    if not tarea.cancelled() and tarea.exception() is not None:
+        logger.error("Falló una tarea del arranque", exc_info=tarea.exception())
+
+
+def en_segundo_plano(corrutina):
+    """
+    The function `en_segundo_plano` runs a startup coroutine as a background task. A reference is
+    kept until the task finishes, so it cannot be garbage-collected midway, and its exception, if
+    any, is logged.
+
+    :param corrutina: The coroutine to run.
+    :return: The `asyncio.Task`.
+    """
+    tarea = asyncio.create_task(corrutina)
+    _tareas.add(tarea)
+    tarea.add_done_callback(_terminada)
+    return tarea
+
+
+async def calentar(*clientes):
+    """
+    The function `calentar` initializes upstream clients in worker threads, after the bot is already
+    receiving updates, so the first real request does not pay for the imports and channel setup.
+
+    :param clientes: Pairs `(nombre, funcion)` where `funcion` initializes the client.
+    """
+    for nombre, funcion in clientes:
+        inicio = time.perf_counter()
+        try:
+            await asyncio.to_thread(funcion)
+        except Exception:
+            logger.warning("No se pudo inicializar %s", nombre, exc_info=True)
+            continue
+        arranque.cliente_listo(nombre, time.perf_counter() - inicio)
+    logger.info("Arranque", extra={"etapa": "arranque", **arranque.informe()})
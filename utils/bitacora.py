@@ -0,0 +1,149 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+from conf.settings import (
+    log_format,
+    log_level,
+    log_levels,
+    log_max_field_length,
+    log_queue_size,
+    log_sample_rate,
+)
+
+# Atributos propios de LogRecord; el resto son los campos pasados con `extra`
+_ATRIBUTOS_ESTANDAR = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener = None
+
+
+def _recortar(valor, limite):
+    if isinstance(valor, str) and len(valor) > limite:
+        return f"{valor[:limite]}… (+{len(valor) - limite})"
+    return valor
+
+
+class FormatoJSON(logging.Formatter):
+    """
+    Formats every record as one JSON object per line with the time, level, logger, message and the
+    fields passed with `extra` (for example `user_id`, `etapa` or `latencia`).
+    """
+
+    def format(self, record):
+        datos = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        for clave, valor in vars(record).items():
+            if clave not in _ATRIBUTOS_ESTANDAR:
+                datos[clave] = valor
+        if record.exc_info:
+            datos["excepcion"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            datos["excepcion"] = record.exc_text
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class ColaRegistros(logging.handlers.QueueHandler):
+    """
+    A `QueueHandler` that only truncates the record in the calling thread and leaves formatting and
+    writing to the background listener. When the queue is full the record is dropped instead of
+    blocking the event loop.
+    """
+
+    def __init__(self, cola, limite):
+        super().__init__(cola)
+        self.limite = limite
+        self.descartados = 0
+
+    def prepare(self, record):
+        # Resolver el mensaje ahora: los argumentos pueden cambiar antes de escribirse
+        record.msg = _recortar(record.getMessage(), self.limite)
+        record.args = None
+        for clave, valor in vars(record).items():
+            if clave not in _ATRIBUTOS_ESTANDAR and isinstance(valor, str):
+                setattr(record, clave, _recortar(valor, self.limite))
+        if record.exc_info:
+            # Las trazas no se recortan, pero se formatean aquí porque no se pueden serializar
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+class FiltroMuestreo(logging.Filter):
+    """
+    Keeps only a fraction of the records below WARNING; warnings and errors always pass.
+    """
+
+    def __init__(self, fraccion):
+        super().__init__()
+        self.fraccion = fraccion
+
+    def filter(self, record):
+        return (
+            record.levelno >= logging.WARNING
+            or self.fraccion >= 1
+            or random.random() < self.fraccion
+        )
+
+
+def _niveles(texto):
+    niveles = {}
+    for par in filter(None, (parte.strip() for parte in texto.split(","))):
+        nombre, _, nivel = par.partition("=")
+        niveles[nombre.strip()] = nivel.strip().upper()
+    return niveles
+
+
+# Configurar los registros de todo el bot
+def configurar_logging():
+    """
+    The function `configurar_logging` routes every log record through a bounded queue to a
+    background thread that formats and writes it, so logging never blocks the event loop. It sets
+    the root level from `LOG_LEVEL`, the per-module levels from `LOG_LEVELS`, sampling of INFO and
+    DEBUG records from `LOG_SAMPLE_RATE` and the truncation of long messages and fields from
+    `LOG_MAX_FIELD_LENGTH`. Calling it again has no effect.
+
+    :return: The `ColaRegistros` handler installed on the root logger.
+    """
+    global _listener
+    raiz = logging.getLogger()
+    if _listener is not None:
+        return next(h for h in raiz.handlers if isinstance(h, ColaRegistros))
+
+    salida = logging.StreamHandler(sys.stdout)
+    if log_format == "json":
+        salida.setFormatter(FormatoJSON())
+    else:
+        salida.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        )
+
+    cola = ColaRegistros(queue.Queue(log_queue_size), log_max_field_length)
+    cola.addFilter(FiltroMuestreo(log_sample_rate))
+    for handler in raiz.handlers[:]:
+        raiz.removeHandler(handler)
+    raiz.addHandler(cola)
+    raiz.setLevel(log_level)
+    for nombre, nivel in _niveles(log_levels).items():
+        logging.getLogger(nombre).setLevel(nivel)
+
+    _listener = logging.handlers.QueueListener(cola.queue, salida)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return cola
@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache whose entries expire after a fixed time to live. It keeps hit and miss
+    counters so its effectiveness can be reported.
+    """
+
+    def __init__(self, maxsize, ttl):
+        """
+        :param maxsize: Maximum number of entries; the least recently used one is evicted first.
+        :param ttl: Seconds an entry stays valid after it was stored.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._datos = OrderedDict()
+
+    def __len__(self):
+        return len(self._datos)
+
+    def __contains__(self, clave):
+        entrada = self._datos.get(clave)
+        return entrada is not None and entrada[1] > time.monotonic()
+
+    def get(self, clave, default=None):
+        """
+        The method `get` returns the value stored for a key and marks it as recently used.
+
+        :param clave: The key to look up.
+        :param default: The value returned when the key is missing or expired.
+        :return: The cached value or `default`.
+        """
+        entrada = self._datos.get(clave)
+        if entrada is None:
+            self.misses += 1
+            return default
+        if entrada[1] <= time.monotonic():
+            del self._datos[clave]
+            self.misses += 1
+            return default
+        self._datos.move_to_end(clave)
+        self.hits += 1
+        return entrada[0]
+
+    def set(self, clave, valor, ttl=None):
+        """
+        The method `set` stores a value, evicting the least recently used entry when the cache is full.
+
+        :param clave: The key to store.
+        :param valor: The value to store.
+        :param ttl: Optional time to live for this entry; defaults to the cache TTL.
+        """
+        expira = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._datos[clave] = (valor, expira)
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self.maxsize:
+            self._datos.popitem(last=False)
+
+    def pop(self, clave, default=None):
+        entrada = self._datos.pop(clave, None)
+        return default if entrada is None else entrada[0]
+
+    def clear(self):
+        self._datos.clear()
+
+    def stats(self):
+        """
+        The method `stats` reports the size of the cache and its hit and miss counters.
+
+        :return: A dictionary with `size`, `hits`, `misses` and `hit_rate`.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._datos),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
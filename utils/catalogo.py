@@ -0,0 +1,196 @@
+import asyncio
+import json
+import logging
+import os
+
+from telegram import InlineKeyboardButton
+
+from conf.settings import (
+    card_catalog_offline,
+    card_catalog_prefetch,
+    card_catalog_snapshot,
+    card_catalog_ttl,
+)
+from utils.single_flight import vuelos
+from utils.utils_methods import get_dialogflow_response, palabras_clave
+
+logger = logging.getLogger(__name__)
+
+# Tarjetas de Dialogflow indexadas por tema
+catalogo = {}
+
+_refresco = None
+# Precargas de temas en curso
+_precargas = set()
+
+
+# Indexar las tarjetas por su título (que coincide con el tema)
+def _indexar(mensajes):
+    indice = {}
+    for msg in mensajes:
+        indice.setdefault(msg.get("title", "").lower(), []).append(msg)
+    return indice
+
+
+def _consulta(tema):
+    return f"muéstrame una imagen de {tema}"
+
+
+# Consultar a Dialogflow las tarjetas de un tema y guardarlas en el catálogo
+async def actualizar_tema(tema):
+    """
+    The function `actualizar_tema` fetches the cards of a topic from Dialogflow and stores them in
+    the catalogue.
+
+    :param tema: The topic whose cards are fetched.
+    :return: The list of cards of the topic.
+    """
+    return await vuelos.hacer(("tarjetas", tema), lambda: _consultar(tema, _consulta(tema)))
+
+
+# Consultar a Dialogflow e indexar las tarjetas recibidas
+async def _consultar(tema, message_text, user_id=None):
+    indice = _indexar(await get_dialogflow_response(message_text, user_id))
+    for titulo, tarjetas in indice.items():
+        catalogo[titulo] = tarjetas
+    return indice.get(tema, [])
+
+
+# Consultar todos los temas
+async def actualizar_catalogo():
+    """
+    The function `actualizar_catalogo` refreshes the cards of every topic in `palabras_clave` and,
+    when `CARD_CATALOG_SNAPSHOT` is set, saves the result to the snapshot file.
+    """
+    resultados = await asyncio.gather(
+        *(actualizar_tema(tema) for tema in palabras_clave), return_exceptions=True
+    )
+    for tema, resultado in zip(palabras_clave, resultados):
+        if isinstance(resultado, Exception):
+            logger.warning("No se pudo actualizar el catálogo de %s", tema, exc_info=resultado)
+    if card_catalog_snapshot:
+        guardar_snapshot(card_catalog_snapshot)
+
+
+# Guardar el catálogo en un archivo JSON
+def guardar_snapshot(ruta):
+    """
+    The function `guardar_snapshot` writes the catalogue to a JSON file so it can be loaded later
+    without calling Dialogflow.
+
+    :param ruta: The path of the snapshot file.
+    """
+    datos = {
+        tema: [
+            {**msg, "buttons": [boton.to_dict() for boton in msg["buttons"]]}
+            for msg in tarjetas
+        ]
+        for tema, tarjetas in catalogo.items()
+    }
+    temporal = f"{ruta}.tmp"
+    with open(temporal, "w", encoding="utf-8") as archivo:
+        json.dump(datos, archivo, ensure_ascii=False, indent=2)
+    os.replace(temporal, ruta)
+
+
+# Cargar el catálogo desde un archivo JSON
+def cargar_snapshot(ruta):
+    """
+    The function `cargar_snapshot` loads the catalogue from a JSON file written by
+    `guardar_snapshot`.
+
+    :param ruta: The path of the snapshot file.
+    :return: True if the snapshot was loaded, False if the file does not exist.
+    """
+    if not os.path.exists(ruta):
+        return False
+    with open(ruta, encoding="utf-8") as archivo:
+        datos = json.load(archivo)
+    for tema, tarjetas in datos.items():
+        catalogo[tema] = [
+            {
+                **msg,
+                "buttons": [
+                    InlineKeyboardButton.de_json(boton, None) for boton in msg["buttons"]
+                ],
+            }
+            for msg in tarjetas
+        ]
+    logger.info(f"Catálogo de tarjetas cargado desde {ruta}")
+    return True
+
+
+async def _mantener_catalogo():
+    espera = 0 if card_catalog_prefetch else card_catalog_ttl
+    while True:
+        await asyncio.sleep(espera)
+        try:
+            await actualizar_catalogo()
+        except Exception:
+            logger.warning("No se pudo refrescar el catálogo", exc_info=True)
+        espera = card_catalog_ttl
+
+
+# Preparar el catálogo al iniciar el bot
+def iniciar_catalogo():
+    """
+    The function `iniciar_catalogo` loads the snapshot file if there is one and, unless
+    `CARD_CATALOG_OFFLINE` is set, starts a background task that prefetches every topic from
+    Dialogflow (when `CARD_CATALOG_PREFETCH` is set) and refreshes the catalogue every
+    `CARD_CATALOG_TTL` seconds.
+    """
+    global _refresco
+    if card_catalog_snapshot:
+        cargar_snapshot(card_catalog_snapshot)
+    if card_catalog_offline or _refresco is not None:
+        return
+    _refresco = asyncio.create_task(_mantener_catalogo())
+
+
+# Precargar un tema en segundo plano si todavía no está en el catálogo
+def precargar_tema(tema):
+    """
+    The function `precargar_tema` schedules a background fetch of a topic's cards, for example when
+    a user selects the topic, so the first image request is already served from the catalogue.
+
+    :param tema: The topic to prefetch.
+    """
+    if tema in catalogo or card_catalog_offline or not card_catalog_prefetch:
+        return
+    # El bucle solo guarda una referencia débil a las tareas
+    tarea = asyncio.create_task(_precargar(tema))
+    _precargas.add(tarea)
+    tarea.add_done_callback(_precargas.discard)
+
+
+async def _precargar(tema):
+    try:
+        await actualizar_tema(tema)
+    except Exception:
+        logger.warning("No se pudo precargar el catálogo de %s", tema, exc_info=True)
+
+
+# Obtener las tarjetas de un tema
+async def obtener_tarjetas(tema, message_text, user_id=None):
+    """
+    The function `obtener_tarjetas` returns the cards of a topic from the catalogue. Only when the
+    topic is missing (and the bot is not offline) does it fall back to a live Dialogflow query with
+    the user's message, whose cards are indexed into the catalogue for later requests. Concurrent
+    requests for the same topic share that query. If Dialogflow fails or its circuit breaker is
+    open, whatever the catalogue holds for the topic is returned.
+
+    :param tema: The topic selected by the user.
+    :param message_text: The message of the user, used for the fallback query.
+    :param user_id: The Telegram user ID, used for the Dialogflow session.
+    :return: The list of cards of the topic.
+    """
+    if tema in catalogo or card_catalog_offline:
+        return catalogo.get(tema, [])
+    try:
+        # Las solicitudes simultáneas del mismo tema comparten una sola consulta
+        return await vuelos.hacer(
+            ("tarjetas", tema), lambda: _consultar(tema, message_text, user_id)
+        )
+    except Exception:
+        logger.warning("Tarjetas no disponibles", extra={"user_id": user_id}, exc_info=True)
+        return catalogo.get(tema, [])
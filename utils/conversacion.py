@@ -0,0 +1,346 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from enum import Enum
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import ContextTypes
+
+from conf.settings import telegram_streaming
+from utils.arranque import arranque
+from utils.catalogo import obtener_tarjetas, precargar_tema
+from utils.intenciones import clasificar_intencion
+from utils.media import enviar_tarjetas
+from utils.metricas import etapas, historial_tokens, ramas
+from utils.sesiones import sesiones
+from utils.telegram_stream import responder_en_streaming
+from utils.utils_methods import (
+    capitalize_first_letter,
+    controlar_limite,
+    generate_response,
+    generate_response_stream,
+    get_faq_response,
+    handle_user_message,
+    responder_desde_corpus,
+)
+
+logger = logging.getLogger(__name__)
+
+TEMAS = ("pediculosis", "parasitismo")
+
+# Textos fijos de la conversación
+SALUDO = "Hola🖐️, ¿cómo estás? ¿Cuál es tu nombre?"
+BIENVENIDA = (
+    "Hola 🙋‍♂️ {nombre}, bienvenido a Pediculosis y Parasitismo Bot🤖. "
+    "Escoge una de las siguientes opciones:"
+)
+ELEGIR_TEMA = "Por favor, selecciona una opción del menú."
+TEMA_ELEGIDO = "{nombre}, has seleccionado {tema}. ¿En qué puedo ayudarte?🤝"
+SIN_IMAGENES = "No se encontraron imágenes para el tema {tema}."
+OTRO_TEMA = (
+    "Parece que tu pregunta está relacionada con {otro}. "
+    "Sin embargo, seleccionaste el tema {tema}. "
+    "Por favor, selecciona el tema correcto o formula una pregunta sobre {tema}."
+)
+PREGUNTA_CONFIRMACION = "¿Fue clara la información o necesitas algo más?"
+REPETIR_CONFIRMACION = "Por favor, selecciona una de las opciones propuestas."
+FUERA_DE_TEMA = (
+    "Este chat está diseñado para responder preguntas sobre pediculosis y parasitismo. "
+    "Por favor, formula una pregunta relacionada con estos temas."
+)
+CONTINUAR = "Por favor, continúa formulando preguntas sobre {tema}."
+DESPEDIDA = "Me alegra saber que todo ha sido claro. ¡Hasta luego!"
+SEGUIR = "Por favor, dime en qué más puedo ayudarte."
+
+# Teclados inmutables que se construyen una sola vez
+TECLADO_TEMAS = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(tema.capitalize(), callback_data=tema)] for tema in TEMAS]
+)
+TECLADO_CONFIRMACION = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("SI, Terminar", callback_data="confirm_si")],
+        [InlineKeyboardButton("NO, Continuar", callback_data="confirm_no")],
+    ]
+)
+TECLADOS_OTRO_TEMA = {
+    tema: InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("Volver a seleccionar tema", callback_data="volver_a_seleccionar")],
+            [
+                InlineKeyboardButton(
+                    f"Seguir con {capitalize_first_letter(tema)}",
+                    callback_data="continuar_con_el_mismo",
+                )
+            ],
+        ]
+    )
+    for tema in TEMAS
+}
+
+
+class Estado(Enum):
+    """
+    The states of a conversation, derived from the session of the user.
+    """
+
+    NUEVA = "nueva"
+    SIN_NOMBRE = "sin_nombre"
+    SIN_TEMA = "sin_tema"
+    CON_TEMA = "con_tema"
+
+
+def estado_de(sesion):
+    """
+    The function `estado_de` returns the state of the conversation of a session.
+
+    :param sesion: The `Sesion` of the user, or None if the user has no session.
+    :return: The `Estado` of the conversation.
+    """
+    if sesion is None:
+        return Estado.NUEVA
+    if sesion.name is None:
+        return Estado.SIN_NOMBRE
+    if sesion.tema is None:
+        return Estado.SIN_TEMA
+    return Estado.CON_TEMA
+
+
+async def _saludar(message, user_id, sesion, texto):
+    await message.reply_text(SALUDO)
+    sesiones.crear(user_id)
+
+
+async def _guardar_nombre(message, user_id, sesion, texto):
+    sesion.name = texto
+    sesiones.marcar(user_id)
+    await message.reply_text(
+        BIENVENIDA.format(nombre=capitalize_first_letter(texto)),
+        reply_markup=TECLADO_TEMAS,
+    )
+
+
+async def _pedir_tema(message, user_id, sesion, texto):
+    await message.reply_text(ELEGIR_TEMA)
+
+
+async def _enviar_imagenes(message, user_id, sesion, texto):
+    ramas.inc("imagen")
+    tema = sesion.tema
+    # Tarjetas del tema seleccionado desde el catálogo
+    with etapas.medir("tarjetas"):
+        tarjetas = await obtener_tarjetas(tema, texto, user_id)
+    if tarjetas:
+        with etapas.medir("envio_tarjetas"):
+            await enviar_tarjetas(message, tarjetas)
+    else:
+        await message.reply_text(SIN_IMAGENES.format(tema=tema))
+
+
+async def _responder_pregunta(message, user_id, sesion, texto):
+    ramas.inc("tema")
+    inicio = time.perf_counter()
+    handle_user_message(user_id, texto, sesion.tema)
+    historial_tokens.observar(sesion.historial.total_tokens)
+    with etapas.medir("cache_y_limite"):
+        respuesta = (
+            get_faq_response(user_id)
+            or responder_desde_corpus(user_id)
+            or await controlar_limite(user_id)
+        )
+    with etapas.medir("respuesta"):
+        if respuesta:
+            await message.reply_text(respuesta)
+        elif telegram_streaming:
+            respuesta = await responder_en_streaming(message, generate_response_stream(user_id))
+        else:
+            respuesta = await generate_response(user_id)
+            if respuesta:
+                await message.reply_text(respuesta)
+    logger.info(
+        "Respuesta generada",
+        extra={
+            "user_id": user_id,
+            "etapa": "respuesta",
+            "latencia": round(time.perf_counter() - inicio, 4),
+            "longitud": len(respuesta or ""),
+        },
+    )
+
+
+async def _conversar(message, user_id, sesion, texto):
+    tema = sesion.tema
+    with etapas.medir("clasificacion"):
+        clasificacion = await clasificar_intencion(texto, user_id)
+
+    if clasificacion.imagen:
+        await _enviar_imagenes(message, user_id, sesion, texto)
+    elif tema in clasificacion.temas:
+        await _responder_pregunta(message, user_id, sesion, texto)
+    elif otro := clasificacion.otro_tema(tema):
+        ramas.inc("otro_tema")
+        await message.reply_text(
+            OTRO_TEMA.format(otro=otro, tema=tema), reply_markup=TECLADOS_OTRO_TEMA[tema]
+        )
+    elif clasificacion.despedida:
+        ramas.inc("despedida")
+        await message.reply_text(PREGUNTA_CONFIRMACION, reply_markup=TECLADO_CONFIRMACION)
+        sesion.esperando_confirmacion = True
+        sesiones.marcar(user_id)
+    elif sesion.esperando_confirmacion:
+        ramas.inc("esperando_confirmacion")
+        await message.reply_text(REPETIR_CONFIRMACION, reply_markup=TECLADO_CONFIRMACION)
+    else:
+        ramas.inc("fuera_de_tema")
+        # El texto del usuario solo se registra en DEBUG
+        logger.info(
+            "Pregunta fuera de tema",
+            extra={"user_id": user_id, "rama": "fuera_de_tema", "longitud": len(texto)},
+        )
+        logger.debug("Texto fuera de tema", extra={"user_id": user_id, "texto": texto})
+        await message.reply_text(FUERA_DE_TEMA)
+
+
+# Qué hacer con un mensaje de texto en cada estado de la conversación
+TRANSICIONES = {
+    Estado.NUEVA: _saludar,
+    Estado.SIN_NOMBRE: _guardar_nombre,
+    Estado.SIN_TEMA: _pedir_tema,
+    Estado.CON_TEMA: _conversar,
+}
+
+
+# Editar el mensaje de los botones y, si no se puede, enviar uno nuevo
+async def _editar_o_responder(query, texto, reply_markup=None):
+    try:
+        await query.edit_message_text(texto, reply_markup=reply_markup)
+    except BadRequest as error:
+        # Telegram rechaza las ediciones que no cambian nada
+        if "not modified" in str(error).lower():
+            return
+        await query.message.reply_text(texto, reply_markup=reply_markup)
+
+
+async def _volver_a_seleccionar(query, user_id, sesion):
+    sesion.tema = None
+    sesiones.marcar(user_id)
+    await _editar_o_responder(
+        query,
+        BIENVENIDA.format(nombre=capitalize_first_letter(sesion.name)),
+        TECLADO_TEMAS,
+    )
+
+
+async def _continuar_con_el_mismo(query, user_id, sesion):
+    await _editar_o_responder(
+        query, CONTINUAR.format(tema=capitalize_first_letter(sesion.tema))
+    )
+
+
+async def _terminar(query, user_id, sesion):
+    sesiones.pop(user_id)
+    await _editar_o_responder(query, DESPEDIDA)
+
+
+async def _seguir(query, user_id, sesion):
+    sesion.esperando_confirmacion = False
+    sesiones.marcar(user_id)
+    await _editar_o_responder(query, SEGUIR)
+
+
+async def _elegir_tema(query, user_id, sesion):
+    sesion.tema = query.data
+    sesiones.marcar(user_id)
+    precargar_tema(query.data)
+    await _editar_o_responder(
+        query,
+        TEMA_ELEGIDO.format(nombre=capitalize_first_letter(sesion.name), tema=query.data),
+    )
+
+
+# Acción de cada botón, por su callback_data
+ACCIONES = {
+    "volver_a_seleccionar": _volver_a_seleccionar,
+    "continuar_con_el_mismo": _continuar_con_el_mismo,
+    "confirm_si": _terminar,
+    "confirm_no": _seguir,
+    **{tema: _elegir_tema for tema in TEMAS},
+}
+
+
+# Descartar la respuesta que Telegram sigue limitando tras todos los reintentos de la cola
+@contextmanager
+def _limite_de_telegram(user_id):
+    try:
+        yield
+    except RetryAfter as error:
+        logger.warning(
+            "Respuesta descartada por el límite de Telegram",
+            extra={"user_id": user_id, "reintentar_en": error.retry_after},
+        )
+
+
+# Procesar un mensaje de texto
+async def manejar_mensaje(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    The function `manejar_mensaje` handles a text message by dispatching it to the transition of
+    the current state of the conversation of the user. A reply that Telegram keeps rate-limiting
+    after all the retries of the send queue is dropped and logged.
+
+    :param update: The Telegram `Update` with the message.
+    :param context: The callback context of python-telegram-bot.
+    """
+    message = update.message
+    # Los mensajes editados no forman parte de la conversación
+    if message is None:
+        return
+    user_id = message.from_user.id
+    texto = message.text.lower()
+    logger.info(
+        "Mensaje recibido",
+        extra={"user_id": user_id, "etapa": "recepcion", "longitud": len(texto)},
+    )
+    logger.debug("Texto recibido", extra={"user_id": user_id, "texto": texto})
+    sesion = await sesiones.cargar(user_id)
+    with _limite_de_telegram(user_id):
+        await TRANSICIONES[estado_de(sesion)](message, user_id, sesion, texto)
+    arranque.respuesta_enviada()
+
+
+# Procesar la pulsación de un botón
+async def manejar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    The function `manejar_callback` handles a button press. The callback is acknowledged at once,
+    concurrently with the action, so the button does not stay in the "loading" state; the action
+    edits the message that carried the buttons instead of sending a new one whenever possible. A
+    reply that Telegram keeps rate-limiting after all the retries is dropped and logged.
+
+    :param update: The Telegram `Update` with the callback query.
+    :param context: The callback context of python-telegram-bot.
+    """
+    query = update.callback_query
+    user_id = query.from_user.id
+    sesion = await sesiones.cargar(user_id)
+    accion = ACCIONES.get(query.data)
+    with _limite_de_telegram(user_id):
+        if sesion is None or accion is None:
+            await query.answer()
+        else:
+            await asyncio.gather(query.answer(), accion(query, user_id, sesion))
+    arranque.respuesta_enviada()
+
+
+# Función que se ejecuta cuando se recibe un mensaje o un callback query
+async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    The function `message_handler` is the single entry point of the conversation for both text
+    messages and button presses.
+
+    :param update: The Telegram `Update` received.
+    :param context: The callback context of python-telegram-bot.
+    """
+    if update.message:
+        await manejar_mensaje(update, context)
+    elif update.callback_query:
+        await manejar_callback(update, context)
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from conf.settings import (
+    dialogflow_deadline,
+    dialogflow_language_code,
+    dialogflow_max_workers,
+    dialogflow_project_id,
+    dialogflow_retries,
+    dialogflow_session_id,
+    dialogflow_slow_call,
+    dialogflow_timeout,
+)
+from utils.metricas import medir_upstream
+from utils.resiliencia import Interruptor, llamar
+
+# Cliente y canal gRPC compartidos por todas las solicitudes, creados en el primer uso
+_cliente = None
+_dialogflow = None
+# El calentamiento y la primera consulta pueden crearlo a la vez desde hilos distintos
+_creacion = threading.Lock()
+# Dejar de llamar a Dialogflow mientras falla o responde demasiado lento
+interruptor = Interruptor("dialogflow", dialogflow_slow_call)
+# Hilos dedicados a las llamadas bloqueantes de Dialogflow
+_ejecutor = ThreadPoolExecutor(
+    max_workers=dialogflow_max_workers, thread_name_prefix="dialogflow"
+)
+
+
+def _modulo():
+    # dialogflow_v2 arrastra gRPC y protobuf: importarlo solo cuando se necesita
+    global _dialogflow
+    if _dialogflow is None:
+        import dialogflow_v2
+
+        _dialogflow = dialogflow_v2
+    return _dialogflow
+
+
+def obtener_cliente():
+    """
+    The function `obtener_cliente` returns the long-lived Dialogflow `SessionsClient`, importing the
+    library and creating it on first use so the gRPC channel, authentication and TLS handshake
+    happen only once and stay out of the cold start.
+
+    :return: The shared `SessionsClient`.
+    """
+    global _cliente
+    if _cliente is None:
+        with _creacion:
+            if _cliente is None:
+                _cliente = _modulo().SessionsClient()
+    return _cliente
+
+
+def establecer_cliente(cliente):
+    """
+    The function `establecer_cliente` replaces the shared client, for example with one connected to
+    a local stub server in the load tests.
+
+    :param cliente: The `SessionsClient` to use.
+    """
+    global _cliente
+    _cliente = cliente
+
+
+# Sesión de Dialogflow propia de cada usuario de Telegram
+def session_path(user_id=None):
+    """
+    The function `session_path` builds the Dialogflow session path for a Telegram user.
+
+    :param user_id: The Telegram user ID; when omitted the shared `dialogflow_session_id` is used.
+    :return: The session path of the user.
+    """
+    session_id = dialogflow_session_id if user_id is None else f"telegram-{user_id}"
+    return obtener_cliente().session_path(dialogflow_project_id, session_id)
+
+
+def _detect_intent(message_text, user_id, timeout):
+    cliente = obtener_cliente()
+    dialogflow = _modulo()
+    text_input = dialogflow.types.TextInput(
+        text=message_text, language_code=dialogflow_language_code
+    )
+    query_input = dialogflow.types.QueryInput(text=text_input)
+    return cliente.detect_intent(
+        session=session_path(user_id), query_input=query_input, timeout=timeout
+    )
+
+
+# Detectar la intención sin bloquear el bucle de eventos
+async def detect_intent(message_text, user_id=None, timeout=None):
+    """
+    The function `detect_intent` sends a text query to Dialogflow over the shared client. The blocking
+    gRPC call runs in a bounded thread pool so the event loop keeps serving other updates. Transient
+    failures are retried with jittered backoff within `DIALOGFLOW_DEADLINE`, and the call fails fast
+    while the circuit breaker of Dialogflow is open.
+
+    :param message_text: The text sent to Dialogflow.
+    :param user_id: The Telegram user ID used to derive the Dialogflow session.
+    :param timeout: Deadline in seconds for each RPC. Defaults to `DIALOGFLOW_TIMEOUT`.
+    :return: The `DetectIntentResponse` returned by Dialogflow. Raises `asyncio.TimeoutError` when
+    the deadline expires, `CircuitoAbierto` when the breaker is open.
+    """
+    timeout = dialogflow_timeout if timeout is None else timeout
+    from google.api_core.exceptions import DeadlineExceeded, ServiceUnavailable
+
+    return await llamar(
+        interruptor,
+        lambda restante: _intento(message_text, user_id, min(timeout, restante)),
+        dialogflow_deadline,
+        dialogflow_retries,
+        (DeadlineExceeded, ServiceUnavailable),
+    )
+
+
+async def _intento(message_text, user_id, timeout):
+    from google.api_core.exceptions import DeadlineExceeded
+
+    loop = asyncio.get_running_loop()
+    with medir_upstream("dialogflow", (DeadlineExceeded,)):
+        return await asyncio.wait_for(
+            loop.run_in_executor(_ejecutor, _detect_intent, message_text, user_id, timeout),
+            timeout,
+        )
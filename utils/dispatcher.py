@@ -0,0 +1,67 @@
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+# Actualizaciones que pueden esperar turno por cada una en ejecución
+FACTOR_EN_ESPERA = 16
+
+
+class ProcesadorPorUsuario(BaseUpdateProcessor):
+    """
+    Update processor that runs updates from different users concurrently while processing the
+    updates of each user strictly in arrival order, so the conversation state of a user is never
+    modified by two handlers at the same time.
+
+    The per-user lock is taken before the global concurrency slot, so a user flooding the bot only
+    queues behind their own updates and never holds slots that other users could be using.
+    """
+
+    __slots__ = ("_bloqueos", "_ejecucion")
+
+    def __init__(self, max_concurrent_updates):
+        """
+        :param max_concurrent_updates: Maximum number of updates executed at the same time.
+        """
+        # El semáforo de la clase base solo limita las actualizaciones en espera
+        super().__init__(max_concurrent_updates * FACTOR_EN_ESPERA)
+        self._ejecucion = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # user_id -> [bloqueo, actualizaciones que lo usan]
+        self._bloqueos = {}
+
+    @staticmethod
+    def _clave(update):
+        usuario = getattr(update, "effective_user", None)
+        if usuario is not None:
+            return usuario.id
+        chat = getattr(update, "effective_chat", None)
+        return None if chat is None else chat.id
+
+    async def do_process_update(self, update, coroutine):
+        clave = self._clave(update)
+        if clave is None:
+            async with self._ejecucion:
+                await coroutine
+            return
+
+        entrada = self._bloqueos.get(clave)
+        if entrada is None:
+            entrada = self._bloqueos[clave] = [asyncio.Lock(), 0]
+        entrada[1] += 1
+        try:
+            async with entrada[0], self._ejecucion:
+                await coroutine
+        finally:
+            entrada[1] -= 1
+            if not entrada[1]:
+                del self._bloqueos[clave]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def usuarios_activos(self):
+        """:obj:`int`: Number of users with updates being processed or waiting."""
+        return len(self._bloqueos)
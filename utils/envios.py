@@ -0,0 +1,301 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from conf.settings import (
+    session_max,
+    telegram_chat_burst,
+    telegram_chat_rate,
+    telegram_global_rate,
+    telegram_group_rate,
+    telegram_send_retries,
+)
+from utils.cache import TTLCache
+from utils.metricas import envios, envios_retry_after
+from utils.rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Prioridades de los envíos: un número menor sale antes
+INTERACTIVA = 0
+MASIVA = 1
+NOMBRES_PRIORIDAD = {INTERACTIVA: "interactiva", MASIVA: "masiva"}
+
+_prioridad = contextvars.ContextVar("prioridad_envio", default=INTERACTIVA)
+# Futuro que se resuelve cuando la llamada de un envío en segundo plano entra en la cola
+_encolado = contextvars.ContextVar("envio_encolado", default=None)
+# Envíos en segundo plano: el bucle solo guarda una referencia débil a ellos
+_en_segundo_plano = set()
+
+
+@contextmanager
+def prioridad(valor):
+    """
+    The function `prioridad` sets the priority of the Telegram calls made inside the `with` block,
+    for example `MASIVA` for traffic that can wait behind the replies to other users.
+
+    :param valor: `INTERACTIVA` (the default) or `MASIVA`.
+    """
+    token = _prioridad.set(valor)
+    try:
+        yield
+    finally:
+        _prioridad.reset(token)
+
+
+def _envio_terminado(tarea):
+    _en_segundo_plano.discard(tarea)
+    if tarea.cancelled():
+        return
+    error = tarea.exception()
+    if isinstance(error, RetryAfter):
+        logger.warning(
+            "Envío descartado por el límite de Telegram",
+            extra={"reintentar_en": error.retry_after},
+        )
+    elif error is not None:
+        logger.error("Falló un envío en segundo plano", exc_info=error)
+
+
+async def encolar(corrutina, valor=MASIVA):
+    """
+    The function `encolar` makes a Telegram call in a background task and returns as soon as the
+    call is waiting in the queue of its chat, without waiting for it to be sent, so a throttled or
+    paused chat does not keep the handler busy. Calls queued one after the other keep their order in
+    the chat. The errors of the call, including a `RetryAfter` that outlasts the retries, are
+    logged.
+
+    :param corrutina: The coroutine that makes the call, for example `message.reply_photo(...)`.
+    :param valor: The priority of the call, `MASIVA` by default.
+    :return: The `asyncio.Task` that makes the call.
+    """
+    encolado = asyncio.get_running_loop().create_future()
+    token = _encolado.set(encolado)
+    try:
+        with prioridad(valor):
+            tarea = asyncio.create_task(corrutina)
+    finally:
+        _encolado.reset(token)
+    _en_segundo_plano.add(tarea)
+    tarea.add_done_callback(_envio_terminado)
+    # Las llamadas que no pasan por la cola terminan sin avisar
+    await asyncio.wait((encolado, tarea), return_when=asyncio.FIRST_COMPLETED)
+    return tarea
+
+
+class _Envio:
+    __slots__ = (
+        "args",
+        "callback",
+        "encolado",
+        "futuro",
+        "intentos",
+        "kwargs",
+        "prioridad",
+        "secuencia",
+    )
+
+    def __init__(self, callback, args, kwargs, futuro, prioridad, secuencia):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.futuro = futuro
+        self.prioridad = prioridad
+        self.secuencia = secuencia
+        self.encolado = time.perf_counter()
+        self.intentos = 0
+
+
+class PlanificadorEnvios(BaseRateLimiter):
+    """
+    Outbound scheduler of the Bot API calls, plugged into the bot as its rate limiter. The calls
+    addressed to a chat wait in a FIFO queue of that chat, and a dispatcher task sends them while
+    the global and per-chat token buckets allow, serving first the chats whose next call has the
+    highest priority. A chat has at most one call in flight, so its messages keep their order. A
+    `RetryAfter` pauses the chat and the call is retried automatically. Calls that are not
+    addressed to a chat (`getUpdates`, `answerCallbackQuery`, `getMe`) are not queued.
+    """
+
+    def __init__(
+        self,
+        global_por_segundo=telegram_global_rate,
+        chat_por_segundo=telegram_chat_rate,
+        rafaga_chat=telegram_chat_burst,
+        grupo_por_minuto=telegram_group_rate,
+        reintentos=telegram_send_retries,
+    ):
+        """
+        :param global_por_segundo: Messages per second sent to all chats together.
+        :param chat_por_segundo: Messages per second sent to a private chat.
+        :param rafaga_chat: Messages that can be sent to a chat at once before throttling.
+        :param grupo_por_minuto: Messages per minute sent to a group or channel.
+        :param reintentos: Times a call answered with `RetryAfter` is retried.
+        """
+        self.chat_por_segundo = chat_por_segundo
+        self.rafaga_chat = rafaga_chat
+        self.grupo_por_minuto = grupo_por_minuto
+        self.reintentos = reintentos
+        self._global = TokenBucket(global_por_segundo, global_por_segundo)
+        # Un bucket inactivo más de un minuto ya está lleno: se puede descartar
+        self._chats = TTLCache(maxsize=session_max, ttl=60)
+        self._colas = {}
+        # (prioridad, secuencia, chat_id) de la primera llamada de cada chat que puede enviar
+        self._listos = []
+        self._en_vuelo = set()
+        self._pausas = {}
+        self._secuencia = itertools.count()
+        self._tareas = set()
+        self._despertar = asyncio.Event()
+        self._despachador = None
+        self.pendientes = 0
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Los grupos y canales tienen ID negativo o nombre de usuario
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.rafaga_chat, self.grupo_por_minuto / 60)
+            else:
+                bucket = TokenBucket(self.rafaga_chat, self.chat_por_segundo)
+        self._chats.set(chat_id, bucket)
+        return bucket
+
+    async def initialize(self):
+        if self._despachador is None:
+            self._despachador = asyncio.create_task(self._despachar())
+
+    async def shutdown(self):
+        if self._despachador is not None:
+            self._despachador.cancel()
+            await asyncio.gather(self._despachador, return_exceptions=True)
+            self._despachador = None
+        for cola in self._colas.values():
+            for envio in cola:
+                envio.futuro.cancel()
+        self._colas.clear()
+        self._listos.clear()
+        self.pendientes = 0
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._despachador is None:
+            return await callback(*args, **kwargs)
+        envio = _Envio(
+            callback,
+            args,
+            kwargs,
+            asyncio.get_running_loop().create_future(),
+            _prioridad.get(),
+            next(self._secuencia),
+        )
+        cola = self._colas.setdefault(chat_id, deque())
+        cola.append(envio)
+        self.pendientes += 1
+        encolado = _encolado.get()
+        if encolado is not None and not encolado.done():
+            encolado.set_result(None)
+        if len(cola) == 1 and chat_id not in self._en_vuelo:
+            heapq.heappush(self._listos, (envio.prioridad, envio.secuencia, chat_id))
+            self._despertar.set()
+        return await envio.futuro
+
+    async def _despachar(self):
+        while True:
+            espera = self._despachar_listos()
+            self._despertar.clear()
+            try:
+                await asyncio.wait_for(self._despertar.wait(), espera)
+            except asyncio.TimeoutError:
+                pass
+
+    # Enviar todo lo que los límites permiten ahora y devolver cuándo volver a intentarlo
+    def _despachar_listos(self):
+        esperando = []
+        espera = None
+        ahora = time.monotonic()
+        while self._listos:
+            espera_global = self._global.espera(1)
+            if espera_global:
+                espera = espera_global
+                break
+            entrada = heapq.heappop(self._listos)
+            chat_id = entrada[2]
+            cola = self._colas[chat_id]
+            # Descartar las llamadas de quienes ya dejaron de esperar
+            while cola and cola[0].futuro.done():
+                cola.popleft()
+                self.pendientes -= 1
+            if not cola:
+                del self._colas[chat_id]
+                continue
+            if cola[0].secuencia != entrada[1]:
+                entrada = (cola[0].prioridad, cola[0].secuencia, chat_id)
+
+            bucket = self._bucket(chat_id)
+            espera_chat = max(self._pausas.get(chat_id, ahora) - ahora, bucket.espera(1))
+            if espera_chat:
+                esperando.append(entrada)
+                espera = espera_chat if espera is None else min(espera, espera_chat)
+                continue
+            self._pausas.pop(chat_id, None)
+            self._global.consumir(1)
+            bucket.consumir(1)
+            self._en_vuelo.add(chat_id)
+            tarea = asyncio.create_task(self._enviar(chat_id, cola.popleft()))
+            self._tareas.add(tarea)
+            tarea.add_done_callback(self._tareas.discard)
+        for entrada in esperando:
+            heapq.heappush(self._listos, entrada)
+        return espera
+
+    async def _enviar(self, chat_id, envio):
+        try:
+            resultado = await envio.callback(*envio.args, **envio.kwargs)
+        except RetryAfter as error:
+            envios_retry_after.inc()
+            if envio.intentos < self.reintentos and not envio.futuro.done():
+                envio.intentos += 1
+                self._pausas[chat_id] = time.monotonic() + error.retry_after
+                self._colas.setdefault(chat_id, deque()).appendleft(envio)
+                logger.warning(
+                    "Envío limitado por Telegram",
+                    extra={"chat_id": chat_id, "reintentar_en": error.retry_after},
+                )
+                return
+            self._resolver(envio, error=error)
+        except Exception as error:
+            self._resolver(envio, error=error)
+        else:
+            self._resolver(envio, resultado)
+        finally:
+            self._en_vuelo.discard(chat_id)
+            cola = self._colas.get(chat_id)
+            if cola:
+                heapq.heappush(self._listos, (cola[0].prioridad, cola[0].secuencia, chat_id))
+            elif cola is not None:
+                del self._colas[chat_id]
+            self._despertar.set()
+
+    def _resolver(self, envio, resultado=None, error=None):
+        self.pendientes -= 1
+        envios.observar(
+            time.perf_counter() - envio.encolado, NOMBRES_PRIORIDAD.get(envio.prioridad, "otra")
+        )
+        if envio.futuro.done():
+            return
+        if error is None:
+            envio.futuro.set_result(resultado)
+        else:
+            envio.futuro.set_exception(error)
+
+
+# Cola de envíos compartida por todo el bot
+planificador = PlanificadorEnvios()
@@ -0,0 +1,195 @@
+from conf.settings import (
+    history_summary_tokens,
+    history_token_budget,
+    openai_model,
+    rag_enabled,
+    rag_max_tokens,
+)
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken es opcional, se usa una aproximación sin él
+    tiktoken = None
+
+# Tokens extra que OpenAI cuenta por cada mensaje (rol y separadores)
+TOKENS_POR_MENSAJE = 4
+# Caracteres que se conservan de cada turno al resumirlo
+LONGITUD_TURNO_RESUMIDO = 160
+
+PROMPTS_SISTEMA = {
+    "pediculosis": (
+        "Eres un asistente de salud que responde solo preguntas sobre pediculosis "
+        "(piojos y liendres): definición, síntomas, contagio, prevención y tratamiento. "
+        "Responde en español, de forma breve y clara."
+    ),
+    "parasitismo": (
+        "Eres un asistente de salud que responde solo preguntas sobre parasitismo "
+        "(parásitos intestinales y externos): definición, síntomas, contagio, prevención "
+        "y tratamiento. Responde en español, de forma breve y clara."
+    ),
+}
+
+INSTRUCCION_PASAJES = (
+    "Información de referencia. Úsala para responder en pocas frases y no inventes datos "
+    "que no estén en ella:"
+)
+
+_codificador = None
+_tokens_reservados = None
+
+
+def _obtener_codificador():
+    global _codificador
+    if _codificador is None:
+        try:
+            _codificador = tiktoken.encoding_for_model(openai_model)
+        except KeyError:
+            _codificador = tiktoken.get_encoding("cl100k_base")
+    return _codificador
+
+
+# Contar los tokens de un texto
+def contar_tokens(texto):
+    """
+    The function `contar_tokens` counts the tokens of a text with `tiktoken` when it is installed, or
+    estimates them (about four characters per token) otherwise.
+
+    :param texto: The text to measure.
+    :return: The number of tokens of the text.
+    """
+    if tiktoken is not None:
+        return len(_obtener_codificador().encode(texto))
+    return (len(texto) + 3) // 4
+
+
+# Tokens reservados para el prompt de sistema más largo, el resumen y los pasajes del corpus
+def _reserva():
+    global _tokens_reservados
+    if _tokens_reservados is None:
+        sistema = max(contar_tokens(prompt) for prompt in PROMPTS_SISTEMA.values())
+        pasajes = rag_max_tokens + contar_tokens(INSTRUCCION_PASAJES) if rag_enabled else 0
+        _tokens_reservados = (
+            sistema + history_summary_tokens + pasajes + 3 * TOKENS_POR_MENSAJE
+        )
+    return _tokens_reservados
+
+
+class Historial:
+    """
+    Conversation history of a user with a token budget. When the prompt would exceed the budget the
+    oldest turns are folded into a compact summary, so the size of the prompt sent to OpenAI stays
+    flat no matter how long the conversation runs.
+    """
+
+    __slots__ = ("mensajes", "resumen", "tokens", "tokens_resumen", "total_tokens")
+
+    def __init__(self):
+        self.mensajes = []
+        self.tokens = []
+        self.total_tokens = 0
+        self.resumen = []
+        self.tokens_resumen = 0
+
+    def __len__(self):
+        return len(self.mensajes)
+
+    def agregar(self, role, content):
+        """
+        The method `agregar` appends a message to the history and enforces the token budget.
+
+        :param role: The role of the message (`user` or `assistant`).
+        :param content: The text of the message.
+        """
+        tokens = contar_tokens(content) + TOKENS_POR_MENSAJE
+        self.mensajes.append({"role": role, "content": content})
+        self.tokens.append(tokens)
+        self.total_tokens += tokens
+        self._compactar()
+
+    def descartar_ultimo(self):
+        """
+        The method `descartar_ultimo` removes the last message of the history, for example a
+        question that was not answered.
+        """
+        self.mensajes.pop()
+        self.total_tokens -= self.tokens.pop()
+
+    def _compactar(self):
+        # Presupuesto disponible para los turnos después del prompt de sistema y el resumen
+        disponible = history_token_budget - _reserva()
+        plegados = 0
+        while self.total_tokens > disponible and len(self.mensajes) - plegados > 1:
+            self._plegar(self.mensajes[plegados])
+            self.total_tokens -= self.tokens[plegados]
+            plegados += 1
+        if plegados:
+            del self.mensajes[:plegados]
+            del self.tokens[:plegados]
+
+    def _plegar(self, mensaje):
+        autor = "Usuario" if mensaje["role"] == "user" else "Asistente"
+        texto = " ".join(mensaje["content"].split())
+        if len(texto) > LONGITUD_TURNO_RESUMIDO:
+            texto = texto[:LONGITUD_TURNO_RESUMIDO].rsplit(" ", 1)[0] + "…"
+        linea = f"{autor}: {texto}"
+        self.resumen.append((linea, contar_tokens(linea)))
+        self.tokens_resumen += self.resumen[-1][1]
+        # Mantener el resumen dentro de su presupuesto descartando lo más antiguo
+        while self.tokens_resumen > history_summary_tokens and len(self.resumen) > 1:
+            self.tokens_resumen -= self.resumen.pop(0)[1]
+
+    def a_dict(self):
+        """
+        The method `a_dict` returns the history as a JSON-serializable dictionary.
+        """
+        return {
+            "mensajes": self.mensajes,
+            "tokens": self.tokens,
+            "resumen": self.resumen,
+        }
+
+    @classmethod
+    def desde_dict(cls, datos):
+        """
+        The method `desde_dict` rebuilds a history saved with `a_dict`.
+        """
+        historial = cls()
+        historial.mensajes = datos["mensajes"]
+        historial.tokens = datos["tokens"]
+        historial.total_tokens = sum(historial.tokens)
+        historial.resumen = [tuple(linea) for linea in datos["resumen"]]
+        historial.tokens_resumen = sum(tokens for _, tokens in historial.resumen)
+        return historial
+
+    def prompt(self, tema=None, pasajes=()):
+        """
+        The method `prompt` builds the list of messages sent to OpenAI: the system prompt pinned to
+        the topic, the reference passages of the corpus, the summary of the folded turns and the
+        most recent turns.
+
+        :param tema: The topic selected by the user, used to pick the system prompt.
+        :param pasajes: The texts of the passages retrieved for the pending question.
+        :return: A list of `{"role": ..., "content": ...}` dictionaries.
+        """
+        mensajes = []
+        if tema in PROMPTS_SISTEMA:
+            mensajes.append({"role": "system", "content": PROMPTS_SISTEMA[tema]})
+        if pasajes:
+            mensajes.append(
+                {
+                    "role": "system",
+                    "content": INSTRUCCION_PASAJES
+                    + "\n"
+                    + "\n".join(f"- {pasaje}" for pasaje in pasajes),
+                }
+            )
+        if self.resumen:
+            mensajes.append(
+                {
+                    "role": "system",
+                    "content": "Resumen de la conversación anterior:\n"
+                    + "\n".join(linea for linea, _ in self.resumen),
+                }
+            )
+        mensajes.extend(self.mensajes)
+        return mensajes
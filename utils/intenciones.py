@@ -0,0 +1,223 @@
+import logging
+import re
+from collections import Counter
+from functools import lru_cache
+from itertools import chain
+
+import numpy as np
+
+from conf.settings import (
+    intent_classifier,
+    intent_dialogflow_fallback,
+    intent_threshold,
+)
+from utils.dialogflow_client import detect_intent
+from utils.keyword_matcher import PALABRAS_VACIAS, IndiceDifuso, normalizar
+from utils.utils_methods import (
+    Clasificacion,
+    clasificar_mensaje,
+    palabras_clave,
+    palabras_despedida,
+    palabras_imagen,
+)
+
+logger = logging.getLogger(__name__)
+
+IMAGEN = "imagen"
+DESPEDIDA = "despedida"
+
+_palabras = re.compile(r"[^\W_]+")
+
+
+def _contenido(texto):
+    # Palabras normalizadas del texto sin las palabras vacías
+    return [p for p in _palabras.findall(normalizar(texto)) if p not in PALABRAS_VACIAS]
+
+
+def _ngramas(palabra, tamanos):
+    palabra = f" {palabra} "
+    return {palabra[i : i + n] for n in tamanos for i in range(len(palabra) - n + 1)}
+
+
+class ClasificadorIntenciones:
+    """
+    Character n-gram TF-IDF intent model trained from example phrases. Stop words are ignored, and
+    phrases shared by several classes are left to the exact keywords, since they cannot tell the
+    classes apart. Every word of a phrase scores the share of its TF-IDF weight whose n-grams appear
+    in the message, and a phrase scores its weakest word, so a long message containing a misspelled
+    keyword still scores high but common words ("que es", "evitar") cannot carry a phrase on their
+    own. The n-grams of each word seen are cached.
+    """
+
+    def __init__(self, clases, tamanos=(3, 4), cache=8192):
+        """
+        :param clases: A dictionary `{intencion: [frases de ejemplo]}`.
+        :param tamanos: The sizes of the character n-grams.
+        :param cache: Number of words whose n-grams are kept.
+        """
+        self.tamanos = tamanos
+        self.clases = tuple(clases)
+        por_clase = {
+            clase: dict.fromkeys(tuple(_contenido(frase)) for frase in clases[clase])
+            for clase in self.clases
+        }
+        repetidas = Counter(frase for frases in por_clase.values() for frase in frases)
+        frases = []
+        inicios = []
+        for clase in self.clases:
+            inicios.append(len(frases))
+            frases.extend(f for f in por_clase[clase] if f and repetidas[f] == 1)
+        self._inicios = np.array(inicios)
+
+        palabras = {palabra: i for i, palabra in enumerate(dict.fromkeys(chain(*frases)))}
+        self.vocabulario = {}
+        filas = [
+            [self.vocabulario.setdefault(n, len(self.vocabulario)) for n in _ngramas(p, tamanos)]
+            for p in palabras
+        ]
+        frecuencia = np.zeros(len(self.vocabulario))
+        for columnas in filas:
+            frecuencia[columnas] += 1
+        idf = np.log((1 + len(filas)) / (1 + frecuencia)) + 1
+
+        # Matriz dispersa (n-grama, palabra, peso) con los pesos normalizados por palabra
+        self._ngrama = np.concatenate([np.array(columnas) for columnas in filas])
+        self._palabra = np.repeat(np.arange(len(filas)), [len(columnas) for columnas in filas])
+        pesos = idf[self._ngrama] ** 2
+        self._peso = pesos / np.bincount(self._palabra, weights=pesos)[self._palabra]
+        self._total_palabras = len(filas)
+        # Palabras de cada frase, consecutivas
+        self._palabras_frase = np.array([palabras[p] for frase in frases for p in frase])
+        self._inicios_frase = np.cumsum([0] + [len(frase) for frase in frases[:-1]])
+        self._columnas = lru_cache(maxsize=cache)(self._columnas_de)
+
+    def _columnas_de(self, palabra):
+        # Índices en el vocabulario de los n-gramas de una palabra
+        return tuple(
+            indice
+            for indice in map(self.vocabulario.get, _ngramas(palabra, self.tamanos))
+            if indice is not None
+        )
+
+    def puntuar(self, texto):
+        """
+        The method `puntuar` scores a message against every class.
+
+        :param texto: The text of the message.
+        :return: An array with the score (0-1) of each class, in the order of `clases`.
+        """
+        columnas = [
+            indice for palabra in _contenido(texto) for indice in self._columnas(palabra)
+        ]
+        if not columnas:
+            return np.zeros(len(self.clases))
+        presentes = np.zeros(len(self.vocabulario), dtype=bool)
+        presentes[columnas] = True
+        seleccion = presentes[self._ngrama]
+        por_palabra = np.bincount(
+            self._palabra[seleccion], weights=self._peso[seleccion], minlength=self._total_palabras
+        )
+        por_frase = np.minimum.reduceat(por_palabra[self._palabras_frase], self._inicios_frase)
+        return np.maximum.reduceat(por_frase, self._inicios)
+
+    def predecir(self, texto):
+        """
+        The method `predecir` returns the most likely class of a message.
+
+        :param texto: The text of the message.
+        :return: A tuple `(intencion, confianza)`.
+        """
+        puntuaciones = self.puntuar(texto)
+        mejor = int(puntuaciones.argmax())
+        return self.clases[mejor], float(puntuaciones[mejor])
+
+
+# Modelo e índice aproximado construidos con las mismas frases que las palabras clave
+modelo = ClasificadorIntenciones(
+    {**palabras_clave, IMAGEN: palabras_imagen, DESPEDIDA: palabras_despedida}
+)
+indice = IndiceDifuso({**palabras_clave, IMAGEN: palabras_imagen, DESPEDIDA: palabras_despedida})
+
+
+def clasificar_con_erratas(message_text):
+    """
+    The function `clasificar_con_erratas` classifies a message by matching each of its words to
+    the closest single-word keyword within a bounded edit distance ("pioyos" -> "piojos",
+    "tratamiemto" -> "tratamiento").
+
+    :param message_text: The text of the message sent by the user.
+    :return: A `Clasificacion` whose `confianza` is the lowest score among the matched groups.
+    """
+    coincidencias = indice.clasificar(message_text)
+    if not coincidencias:
+        return Clasificacion((), False, False, 0.0)
+    logger.debug("Palabras clave aproximadas: %s", coincidencias)
+    return Clasificacion(
+        temas=tuple(tema for tema in palabras_clave if tema in coincidencias),
+        despedida=DESPEDIDA in coincidencias,
+        imagen=IMAGEN in coincidencias,
+        confianza=min(puntuacion for _, puntuacion in coincidencias.values()),
+    )
+
+
+def clasificar_aproximado(message_text, umbral=None):
+    """
+    The function `clasificar_aproximado` classifies a message with the local model, tolerating
+    misspellings and inflections that the exact keywords miss.
+
+    :param message_text: The text of the message sent by the user.
+    :param umbral: Minimum score of a class to be included. Defaults to `INTENT_THRESHOLD`.
+    :return: A `Clasificacion` with every class scoring at least `umbral`, whose `confianza` is the
+    best score.
+    """
+    umbral = intent_threshold if umbral is None else umbral
+    puntuaciones = dict(zip(modelo.clases, modelo.puntuar(message_text).tolist()))
+    return Clasificacion(
+        temas=tuple(tema for tema in palabras_clave if puntuaciones[tema] >= umbral),
+        despedida=puntuaciones[DESPEDIDA] >= umbral,
+        imagen=puntuaciones[IMAGEN] >= umbral,
+        confianza=max(puntuaciones.values()),
+    )
+
+
+# Pedir la intención a Dialogflow cuando el modelo local no está seguro
+async def _clasificar_con_dialogflow(message_text, user_id):
+    try:
+        respuesta = await detect_intent(message_text, user_id)
+    except Exception:
+        logger.warning("No se pudo consultar la intención a Dialogflow", exc_info=True)
+        return None
+    resultado = respuesta.query_result
+    intencion = normalizar(resultado.intent.display_name)
+    if resultado.intent_detection_confidence < intent_threshold:
+        return None
+    if intencion in palabras_clave:
+        return Clasificacion((intencion,), False, False, resultado.intent_detection_confidence)
+    if intencion in (IMAGEN, DESPEDIDA):
+        return Clasificacion(
+            (), intencion == DESPEDIDA, intencion == IMAGEN, resultado.intent_detection_confidence
+        )
+    return None
+
+
+async def clasificar_intencion(message_text, user_id=None):
+    """
+    The function `clasificar_intencion` routes a message: exact keywords first, then keywords with
+    typos, then the local n-gram model and, only when all of them are inconclusive and
+    `INTENT_DIALOGFLOW_FALLBACK` is enabled, the Dialogflow agent, whose intents must be named
+    after the topics, `imagen` or `despedida`.
+
+    :param message_text: The text of the message sent by the user.
+    :param user_id: The Telegram user ID, used for the Dialogflow session.
+    :return: A `Clasificacion`; an empty one means the message is off-topic.
+    """
+    clasificacion = clasificar_mensaje(message_text)
+    if not clasificacion.vacia or not intent_classifier:
+        return clasificacion
+    con_erratas = clasificar_con_erratas(message_text)
+    if not con_erratas.vacia:
+        return con_erratas
+    aproximada = clasificar_aproximado(message_text)
+    if not aproximada.vacia or not intent_dialogflow_fallback:
+        return aproximada
+    return await _clasificar_con_dialogflow(message_text, user_id) or aproximada
@@ -0,0 +1,285 @@
+import re
+import unicodedata
+from collections import deque
+from functools import lru_cache
+
+
+# Tabla de traducción para normalizar texto (sin acentos y en minúsculas)
+class _TablaNormalizacion(dict):
+    """
+    Translation table for `str.translate` that maps every character to its normalized form (NFD
+    decomposition without combining marks, lowercased). Characters that are not precomputed are
+    resolved on first use and cached, so the result always matches the `unicodedata` path.
+    """
+
+    def __missing__(self, codigo):
+        caracter = chr(codigo)
+        normalizado = "".join(
+            c
+            for c in unicodedata.normalize("NFD", caracter)
+            if unicodedata.category(c) != "Mn"
+        ).lower()
+        self[codigo] = normalizado
+        return normalizado
+
+
+TABLA_NORMALIZACION = _TablaNormalizacion()
+# Precalcular ASCII, Latin-1 y Latin Extended (cubre el español) y las marcas combinantes
+for _codigo in list(range(0x250)) + list(range(0x300, 0x370)):
+    TABLA_NORMALIZACION[_codigo]
+
+
+def normalizar(text):
+    """
+    The function `normalizar` removes accents and lowercases the text with a single
+    `str.translate` call over the precomputed `TABLA_NORMALIZACION`.
+
+    :param text: The text to normalize.
+    :return: The normalized text, equivalent to decomposing it with NFD, dropping the combining
+    marks and converting it to lowercase.
+    """
+    return text.translate(TABLA_NORMALIZACION)
+
+
+# Palabras sin contenido que no ayudan a reconocer un tema (ya normalizadas)
+PALABRAS_VACIAS = frozenset(
+    {
+        "a", "al", "algo", "algun", "alguna", "como", "con", "cual", "cuales", "cuando", "de",
+        "del", "donde", "e", "el", "ella", "ellas", "ellos", "en", "entre", "es", "esa", "ese",
+        "eso", "esta", "estan", "este", "esto", "hay", "la", "las", "le", "les", "lo", "los",
+        "mas", "me", "mi", "mis", "muy", "ni", "no", "nos", "o", "os", "para", "pero", "por",
+        "porque", "puede", "pueden", "puedo", "que", "se", "ser", "si", "sin", "sobre", "son",
+        "su", "sus", "te", "tengo", "tiene", "tienen", "tu", "tus", "un", "una", "unas", "uno",
+        "unos", "y", "ya", "yo",
+    }
+)
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton compiled from named groups of keywords. A single linear pass over a
+    message returns every group that has at least one keyword contained in it, with the same
+    substring semantics as `normalizar(palabra) in normalizar(texto)`.
+    """
+
+    def __init__(self, grupos):
+        """
+        :param grupos: Dictionary that maps a group name (topic, farewell, image, ...) to its list of
+        keywords. Keywords are normalized, deduplicated and keywords that contain a shorter keyword of
+        the same group are pruned, since they can never change the result.
+        """
+        self.grupos = tuple(grupos)
+        # Cada nodo: transiciones, enlace de fallo y grupos que terminan en él
+        self._transiciones = [{}]
+        self._salidas = [frozenset()]
+        self.total_palabras = 0
+
+        for grupo, palabras in grupos.items():
+            for palabra in self._podar(palabras):
+                self._insertar(palabra, grupo)
+                self.total_palabras += 1
+
+        self._construir_fallos()
+
+    @staticmethod
+    def _podar(palabras):
+        # Normalizar y quitar duplicados conservando el orden
+        unicas = list(dict.fromkeys(p for p in map(normalizar, palabras) if p))
+        unicas.sort(key=len)
+        conservadas = []
+        for palabra in unicas:
+            # Una frase que contiene otra palabra del grupo está dominada por ella
+            if not any(corta in palabra for corta in conservadas):
+                conservadas.append(palabra)
+        return conservadas
+
+    def _insertar(self, palabra, grupo):
+        nodo = 0
+        for caracter in palabra:
+            siguiente = self._transiciones[nodo].get(caracter)
+            if siguiente is None:
+                siguiente = len(self._transiciones)
+                self._transiciones[nodo][caracter] = siguiente
+                self._transiciones.append({})
+                self._salidas.append(frozenset())
+            nodo = siguiente
+        self._salidas[nodo] = self._salidas[nodo] | {grupo}
+
+    def _construir_fallos(self):
+        fallos = [0] * len(self._transiciones)
+        cola = deque(self._transiciones[0].values())
+        while cola:
+            nodo = cola.popleft()
+            for caracter, hijo in self._transiciones[nodo].items():
+                cola.append(hijo)
+                fallo = fallos[nodo]
+                while fallo and caracter not in self._transiciones[fallo]:
+                    fallo = fallos[fallo]
+                destino = self._transiciones[fallo].get(caracter, 0)
+                fallos[hijo] = destino if destino != hijo else 0
+                # Heredar las salidas del enlace de fallo para no recorrer la cadena al buscar
+                self._salidas[hijo] = self._salidas[hijo] | self._salidas[fallos[hijo]]
+        self._fallos = fallos
+
+    def buscar(self, texto_normalizado):
+        """
+        The function `buscar` runs the automaton over an already normalized text.
+
+        :param texto_normalizado: Text returned by `normalizar`.
+        :return: A frozenset with the names of every group that matched.
+        """
+        transiciones = self._transiciones
+        fallos = self._fallos
+        salidas = self._salidas
+        total_grupos = len(self.grupos)
+        encontrados = set()
+        nodo = 0
+        for caracter in texto_normalizado:
+            while True:
+                siguiente = transiciones[nodo].get(caracter)
+                if siguiente is not None:
+                    nodo = siguiente
+                    break
+                if nodo == 0:
+                    break
+                nodo = fallos[nodo]
+            if salidas[nodo]:
+                encontrados |= salidas[nodo]
+                if len(encontrados) == total_grupos:
+                    break
+        return frozenset(encontrados)
+
+    def clasificar(self, texto):
+        """
+        The function `clasificar` normalizes the text and returns the groups it matches.
+
+        :param texto: Raw message text.
+        :return: A frozenset with the names of every group that matched.
+        """
+        return self.buscar(normalizar(texto))
+
+
+_palabras = re.compile(r"\w+")
+
+
+def _borrados(palabra, distancia):
+    # Todas las variantes de la palabra con hasta `distancia` caracteres borrados
+    variantes = {palabra}
+    frontera = {palabra}
+    for _ in range(distancia):
+        frontera = {p[:i] + p[i + 1 :] for p in frontera for i in range(len(p))}
+        variantes |= frontera
+    return variantes
+
+
+def distancia_edicion(a, b, maxima):
+    """
+    The function `distancia_edicion` computes the optimal string alignment distance (insertions,
+    deletions, substitutions and transpositions of adjacent characters) between two words.
+
+    :param a: The first word.
+    :param b: The second word.
+    :param maxima: The largest distance of interest; the computation stops early past it.
+    :return: The distance, or `maxima + 1` if it is larger than `maxima`.
+    """
+    if abs(len(a) - len(b)) > maxima:
+        return maxima + 1
+    anterior2 = None
+    anterior = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        actual = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            costo = a[i - 1] != b[j - 1]
+            actual[j] = min(anterior[j] + 1, actual[j - 1] + 1, anterior[j - 1] + costo)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                actual[j] = min(actual[j], anterior2[j - 2] + 1)
+        if min(actual) > maxima:
+            return maxima + 1
+        anterior2, anterior = anterior, actual
+    return anterior[-1] if anterior[-1] <= maxima else maxima + 1
+
+
+class IndiceDifuso:
+    """
+    SymSpell-style deletion index over the single-word keywords of named groups. Every keyword is
+    stored under all its variants with up to N characters deleted, so a misspelled token is matched
+    by looking up its own deletions and verifying the few candidates found, without comparing it
+    against every keyword.
+    """
+
+    def __init__(self, grupos, longitud_minima=5, cache=4096):
+        """
+        :param grupos: Dictionary that maps a group name to its list of keywords. Multi-word
+        keywords and keywords shorter than `longitud_minima` are left to the exact matcher.
+        :param longitud_minima: Shortest keyword, and token, that is matched approximately.
+        :param cache: Number of looked-up tokens whose result is kept.
+        """
+        self.longitud_minima = longitud_minima
+        self._grupos = {}
+        self._borrados = {}
+        for grupo, palabras in grupos.items():
+            for palabra in map(normalizar, palabras):
+                if len(palabra) < longitud_minima or not palabra.isalnum():
+                    continue
+                self._grupos.setdefault(palabra, set()).add(grupo)
+        for palabra in self._grupos:
+            for variante in _borrados(palabra, self.distancia_maxima(len(palabra))):
+                self._borrados.setdefault(variante, set()).add(palabra)
+        self.buscar_palabra = lru_cache(maxsize=cache)(self._buscar_palabra)
+
+    def __len__(self):
+        return len(self._grupos)
+
+    @staticmethod
+    def distancia_maxima(longitud):
+        """
+        The method `distancia_maxima` returns the edit distance tolerated for a word length: one
+        typo in short words, two from eight characters on.
+        """
+        return 1 if longitud < 8 else 2
+
+    def _buscar_palabra(self, token):
+        if len(token) < self.longitud_minima:
+            return None
+        distancia = self.distancia_maxima(len(token))
+        candidatos = set()
+        for variante in _borrados(token, distancia):
+            candidatos |= self._borrados.get(variante, set())
+        mejor = None
+        for palabra in candidatos:
+            maxima = min(distancia, self.distancia_maxima(len(palabra)))
+            d = distancia_edicion(token, palabra, maxima)
+            if d <= maxima and (mejor is None or d < mejor[1]):
+                mejor = (palabra, d)
+        if mejor is None:
+            return None
+        palabra, d = mejor
+        return palabra, d, 1 - d / max(len(palabra), len(token))
+
+    def buscar(self, texto_normalizado):
+        """
+        The method `buscar` matches every word of an already normalized text against the index.
+
+        :param texto_normalizado: Text returned by `normalizar`.
+        :return: A dictionary `{grupo: (palabra_clave, puntuacion)}` with the best match of each
+        group, where the score is `1 - distancia / longitud`.
+        """
+        resultado = {}
+        for token in _palabras.findall(texto_normalizado):
+            coincidencia = self.buscar_palabra(token)
+            if coincidencia is None:
+                continue
+            palabra, _, puntuacion = coincidencia
+            for grupo in self._grupos[palabra]:
+                if grupo not in resultado or puntuacion > resultado[grupo][1]:
+                    resultado[grupo] = (palabra, puntuacion)
+        return resultado
+
+    def clasificar(self, texto):
+        """
+        The method `clasificar` normalizes the text and returns the groups it matches approximately.
+
+        :param texto: Raw message text.
+        :return: A dictionary `{grupo: (palabra_clave, puntuacion)}`.
+        """
+        return self.buscar(normalizar(texto))
@@ -0,0 +1,175 @@
+import asyncio
+from contextlib import aclosing
+
+from conf.settings import (
+    openai_api_key,
+    openai_deadline,
+    openai_max_concurrency,
+    openai_model,
+    openai_retries,
+    openai_slow_call,
+    openai_timeout,
+)
+from utils.metricas import medir_upstream, reintentos
+from utils.resiliencia import Interruptor, espera_reintento, llamar
+
+# Limitar las llamadas simultáneas a OpenAI
+_semaforo = asyncio.Semaphore(openai_max_concurrency)
+# Dejar de llamar a OpenAI mientras falla o responde demasiado lento
+interruptor = Interruptor("openai", openai_slow_call)
+# Módulo de OpenAI, importado en el primer uso
+_openai = None
+
+
+def obtener_openai():
+    """
+    The function `obtener_openai` imports and configures the OpenAI client on first use, so the
+    import cost is paid by the background warm-up or the first question instead of the cold start.
+
+    :return: The configured `openai` module.
+    """
+    global _openai
+    if _openai is None:
+        import openai
+
+        if openai.api_key is None:
+            openai.api_key = openai_api_key
+        _openai = openai
+    return _openai
+
+
+# Errores transitorios que vale la pena reintentar
+def _reintentables(openai):
+    return (
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.TryAgain,
+        openai.error.APIError,
+    )
+
+
+# Obtener una respuesta de OpenAI sin bloquear el bucle de eventos
+async def completar(messages, timeout=None):
+    """
+    The function `completar` requests a chat completion from OpenAI using the native async client,
+    so other Telegram updates keep being processed while the request is in flight. Transient
+    failures are retried with jittered backoff within `OPENAI_DEADLINE`, and the call fails fast
+    while the circuit breaker of OpenAI is open.
+
+    :param messages: The list of chat messages (`{"role": ..., "content": ...}`) sent to the model.
+    :param timeout: Maximum number of seconds to wait for each attempt, including the time spent
+    waiting for a free concurrency slot. Defaults to `OPENAI_TIMEOUT`.
+    :return: The content of the reply generated by the model. Raises `asyncio.TimeoutError` when the
+    deadline expires, `CircuitoAbierto` when the breaker is open; cancelling the calling task
+    cancels the request.
+    """
+    timeout = openai_timeout if timeout is None else timeout
+    openai = obtener_openai()
+    return await llamar(
+        interruptor,
+        lambda restante: _intento(openai, messages, min(timeout, restante)),
+        openai_deadline,
+        openai_retries,
+        _reintentables(openai),
+    )
+
+
+async def _intento(openai, messages, timeout):
+    with medir_upstream("openai", (openai.error.Timeout,)):
+        return await asyncio.wait_for(_completar(openai, messages, timeout), timeout)
+
+
+async def _completar(openai, messages, timeout):
+    async with _semaforo:
+        response = await openai.ChatCompletion.acreate(
+            model=openai_model,
+            messages=messages,
+            request_timeout=timeout,
+        )
+    return response.choices[0].message["content"]
+
+
+# Obtener la respuesta de OpenAI fragmento a fragmento
+async def completar_stream(messages, timeout=None):
+    """
+    The function `completar_stream` requests a streamed chat completion from OpenAI and yields the
+    text of each delta as soon as it arrives. Failures before the first fragment are retried with
+    jittered backoff; the circuit breaker of OpenAI judges the latency to the first fragment.
+
+    :param messages: The list of chat messages (`{"role": ..., "content": ...}`) sent to the model.
+    :param timeout: Maximum number of seconds for the whole stream. Defaults to `OPENAI_TIMEOUT`.
+    :return: An async generator of text fragments. Raises `asyncio.TimeoutError` when the deadline
+    expires before the stream is complete, `CircuitoAbierto` when the breaker is open.
+    """
+    timeout = openai_timeout if timeout is None else timeout
+    openai = obtener_openai()
+    loop = asyncio.get_running_loop()
+    limite = loop.time() + timeout
+    reintentables = (asyncio.TimeoutError,) + _reintentables(openai)
+
+    intento = 0
+    while True:
+        interruptor.permitir()
+        inicio = loop.time()
+        primer_fragmento = None
+        try:
+            # Cerrar el stream en cuanto se deja de leer para liberar el semáforo
+            async with aclosing(_stream(openai, messages, limite, timeout)) as fragmentos:
+                async for delta in fragmentos:
+                    if primer_fragmento is None:
+                        primer_fragmento = loop.time() - inicio
+                        interruptor.registrar(True, primer_fragmento)
+                    yield delta
+        except Exception as error:
+            if primer_fragmento is not None:
+                raise
+            interruptor.registrar(False, loop.time() - inicio)
+            espera = espera_reintento(intento)
+            if (
+                intento >= openai_retries
+                or not isinstance(error, reintentables)
+                or loop.time() + espera >= limite
+            ):
+                raise
+            reintentos.inc("openai")
+            intento += 1
+            await asyncio.sleep(espera)
+        except BaseException:
+            # Cancelado o cerrado por quien lo consume antes del primer fragmento
+            if primer_fragmento is None:
+                interruptor.liberar()
+            raise
+        else:
+            if primer_fragmento is None:
+                interruptor.registrar(True, loop.time() - inicio)
+            return
+
+
+async def _stream(openai, messages, limite, timeout):
+    loop = asyncio.get_running_loop()
+    with medir_upstream("openai", (openai.error.Timeout,)):
+        await asyncio.wait_for(_semaforo.acquire(), max(limite - loop.time(), 0))
+        try:
+            stream = await asyncio.wait_for(
+                openai.ChatCompletion.acreate(
+                    model=openai_model,
+                    messages=messages,
+                    request_timeout=timeout,
+                    stream=True,
+                ),
+                limite - loop.time(),
+            )
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        stream.__anext__(), max(limite - loop.time(), 0)
+                    )
+                except StopAsyncIteration:
+                    break
+                delta = chunk.choices[0].delta.get("content")
+                if delta:
+                    yield delta
+        finally:
+            _semaforo.release()
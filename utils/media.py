@@ -0,0 +1,103 @@
+from itertools import groupby
+
+from telegram import InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest
+
+from utils.envios import encolar
+
+# Telegram acepta entre 2 y 10 elementos por álbum
+MAXIMO_ALBUM = 10
+
+# file_id de Telegram para cada URL de imagen ya enviada
+file_ids = {}
+
+
+def _foto(url):
+    return file_ids.get(url, url)
+
+
+def _registrar(url, mensaje):
+    if mensaje is not None and mensaje.photo:
+        file_ids[url] = mensaje.photo[-1].file_id
+
+
+# Enviar una sola tarjeta con su imagen, título y botones
+async def _enviar_foto(message, tarjeta):
+    url = tarjeta["photo"]
+    reply_markup = InlineKeyboardMarkup([tarjeta["buttons"]])
+    try:
+        enviado = await message.reply_photo(
+            photo=_foto(url), caption=tarjeta["text"], reply_markup=reply_markup
+        )
+    except BadRequest:
+        if url not in file_ids:
+            raise
+        # El file_id ya no es válido: volver a enviar desde la URL
+        file_ids.pop(url)
+        enviado = await message.reply_photo(
+            photo=url, caption=tarjeta["text"], reply_markup=reply_markup
+        )
+    _registrar(url, enviado)
+
+
+# Enviar varias tarjetas como un álbum
+async def _enviar_album(message, tarjetas):
+    def album(usar_file_ids):
+        return [
+            InputMediaPhoto(
+                media=_foto(t["photo"]) if usar_file_ids else t["photo"],
+                caption=t["text"],
+            )
+            for t in tarjetas
+        ]
+
+    try:
+        enviados = await message.reply_media_group(media=album(True))
+    except BadRequest:
+        if not any(t["photo"] in file_ids for t in tarjetas):
+            raise
+        for t in tarjetas:
+            file_ids.pop(t["photo"], None)
+        enviados = await message.reply_media_group(media=album(False))
+    for tarjeta, enviado in zip(tarjetas, enviados):
+        _registrar(tarjeta["photo"], enviado)
+
+
+# Poner en la cola una foto suelta o un álbum con sus botones
+async def _encolar_fotos(message, grupo):
+    if len(grupo) == 1:
+        await encolar(_enviar_foto(message, grupo[0]))
+        return
+    await encolar(_enviar_album(message, grupo))
+    # Los álbumes no admiten botones: van en un mensaje aparte
+    botones = [tarjeta["buttons"] for tarjeta in grupo if tarjeta["buttons"]]
+    if botones:
+        await encolar(
+            message.reply_text("Más información:", reply_markup=InlineKeyboardMarkup(botones))
+        )
+
+
+# Enviar las tarjetas de un tema
+async def enviar_tarjetas(message, tarjetas):
+    """
+    The function `enviar_tarjetas` sends the cards of a topic with as few Telegram API calls as
+    possible. Several images are sent together as a media group (with their buttons in a separate
+    message, since albums cannot carry inline keyboards), and the `file_id` of every uploaded image
+    is reused afterwards so Telegram does not download the URL again. The cards keep their order:
+    only consecutive image cards are grouped into an album.
+
+    The calls are queued as bulk traffic and the function returns once all of them are waiting in
+    the queue of the chat, without waiting for them to be sent. A resend from the URL after an
+    expired `file_id` is queued behind the calls already waiting.
+
+    :param message: The Telegram message being answered.
+    :param tarjetas: The list of cards returned by the catalogue.
+    """
+    for combinadas, seguidas in groupby(tarjetas, key=lambda t: t["type"] == "combined"):
+        seguidas = list(seguidas)
+        if not combinadas:
+            for tarjeta in seguidas:
+                await encolar(message.reply_text(tarjeta["text"]))
+            continue
+        for inicio in range(0, len(seguidas), MAXIMO_ALBUM):
+            await _encolar_fotos(message, seguidas[inicio : inicio + MAXIMO_ALBUM])
@@ -0,0 +1,247 @@
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from telegram.error import TimedOut
+from telegram.request import HTTPXRequest
+
+# Límites en segundos de los histogramas de latencia
+LIMITES_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Límites de los histogramas de tamaño del historial en tokens
+LIMITES_TOKENS = (50, 100, 250, 500, 1000, 1500, 2000, 4000)
+
+
+def _etiquetas(nombres, valores):
+    if not nombres:
+        return ""
+    pares = ",".join(f'{nombre}="{valor}"' for nombre, valor in zip(nombres, valores))
+    return "{" + pares + "}"
+
+
+class Contador:
+    """
+    A Prometheus counter with optional labels. Updates are plain dictionary increments: the bot
+    records every metric from the event loop thread, so no locking is needed.
+    """
+
+    tipo = "counter"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+
+    def inc(self, *valores, cantidad=1):
+        """
+        The method `inc` increments the counter of a combination of label values.
+
+        :param valores: The label values, in the order of `etiquetas`.
+        :param cantidad: The amount added to the counter.
+        """
+        self._valores[valores] = self._valores.get(valores, 0) + cantidad
+
+    def valor(self, *valores):
+        return self._valores.get(valores, 0)
+
+    def muestras(self):
+        for valores, valor in self._valores.items():
+            yield f"{self.nombre}{_etiquetas(self.etiquetas, valores)} {valor}"
+
+
+class Histograma:
+    """
+    A Prometheus histogram with fixed bucket limits and optional labels.
+    """
+
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), limites=LIMITES_LATENCIA):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.limites = tuple(limites)
+        # Por etiquetas: [cuentas por cubeta (+Inf al final), suma]
+        self._series = {}
+
+    def observar(self, valor, *valores):
+        """
+        The method `observar` records an observation.
+
+        :param valor: The observed value.
+        :param valores: The label values, in the order of `etiquetas`.
+        """
+        serie = self._series.get(valores)
+        if serie is None:
+            serie = self._series[valores] = [[0] * (len(self.limites) + 1), 0.0]
+        serie[0][bisect_left(self.limites, valor)] += 1
+        serie[1] += valor
+
+    @contextmanager
+    def medir(self, *valores):
+        """
+        The method `medir` observes the seconds spent in the `with` block, also when it raises.
+        """
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, *valores)
+
+    def cuenta(self, *valores):
+        serie = self._series.get(valores)
+        return sum(serie[0]) if serie else 0
+
+    def muestras(self):
+        for valores, (cuentas, suma) in self._series.items():
+            acumulado = 0
+            for limite, cuenta in zip(self.limites + ("+Inf",), cuentas):
+                acumulado += cuenta
+                etiquetas = _etiquetas(self.etiquetas + ("le",), valores + (limite,))
+                yield f"{self.nombre}_bucket{etiquetas} {acumulado}"
+            etiquetas = _etiquetas(self.etiquetas, valores)
+            yield f"{self.nombre}_sum{etiquetas} {suma}"
+            yield f"{self.nombre}_count{etiquetas} {acumulado}"
+
+
+class Indicador:
+    """
+    A metric whose value is read from a callable when the metrics are scraped, so it costs nothing
+    on the hot path. It is a gauge unless `tipo` says otherwise (e.g. an existing counter attribute).
+    """
+
+    def __init__(self, nombre, ayuda, funcion, tipo="gauge"):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.funcion = funcion
+        self.tipo = tipo
+
+    def muestras(self):
+        yield f"{self.nombre} {self.funcion()}"
+
+
+class Registro:
+    """
+    The set of metrics exposed on `/metrics`.
+    """
+
+    def __init__(self):
+        self._metricas = {}
+
+    def _registrar(self, metrica):
+        self._metricas[metrica.nombre] = metrica
+        return metrica
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        return self._registrar(Contador(nombre, ayuda, etiquetas))
+
+    def histograma(self, nombre, ayuda, etiquetas=(), limites=LIMITES_LATENCIA):
+        return self._registrar(Histograma(nombre, ayuda, etiquetas, limites))
+
+    def indicador(self, nombre, ayuda, funcion, tipo="gauge"):
+        return self._registrar(Indicador(nombre, ayuda, funcion, tipo))
+
+    def exponer(self):
+        """
+        The method `exponer` renders every metric in the Prometheus text exposition format.
+
+        :return: The text served on `/metrics`.
+        """
+        lineas = []
+        for metrica in self._metricas.values():
+            lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+            lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+            lineas.extend(metrica.muestras())
+        return "\n".join(lineas) + "\n"
+
+
+registro = Registro()
+
+# Latencia de cada etapa del handler de mensajes
+etapas = registro.histograma(
+    "bot_etapa_segundos", "Latency of each stage of the message handler", ("etapa",)
+)
+# Mensajes por rama de la conversación
+ramas = registro.contador(
+    "bot_mensajes_total", "Messages handled per conversation branch", ("rama",)
+)
+# Latencia, errores y tiempos agotados de los servicios externos
+upstream = registro.histograma(
+    "bot_upstream_segundos", "Latency of the calls to external services", ("servicio",)
+)
+upstream_errores = registro.contador(
+    "bot_upstream_errores_total",
+    "Failed calls to external services by kind (error or timeout)",
+    ("servicio", "tipo"),
+)
+# Reintentos y estado de los interruptores de los servicios externos
+reintentos = registro.contador(
+    "bot_upstream_reintentos_total", "Retried calls to external services", ("servicio",)
+)
+circuito_aperturas = registro.contador(
+    "bot_circuito_aperturas_total", "Times the circuit breaker of a service opened", ("servicio",)
+)
+circuito_rechazos = registro.contador(
+    "bot_circuito_rechazos_total",
+    "Calls failed fast because the circuit breaker of a service was open",
+    ("servicio",),
+)
+# Cola de envíos a Telegram
+envios = registro.histograma(
+    "bot_envio_segundos",
+    "Time from queuing a Telegram call to its completion, by priority",
+    ("prioridad",),
+)
+envios_retry_after = registro.contador(
+    "bot_envio_retry_after_total", "Telegram calls answered with RetryAfter (429)"
+)
+# Preguntas respondidas con un pasaje del corpus sin llamar a OpenAI
+respuestas_corpus = registro.contador(
+    "bot_respuestas_corpus_total", "Questions answered from a corpus passage without OpenAI"
+)
+# Tamaño del historial enviado al modelo
+historial_tokens = registro.histograma(
+    "bot_historial_tokens",
+    "Size in tokens of the conversation history sent to the model",
+    limites=LIMITES_TOKENS,
+)
+
+
+@contextmanager
+def medir_upstream(servicio, timeouts=()):
+    """
+    The function `medir_upstream` times a call to an external service and counts its failures.
+    `asyncio.TimeoutError` and the exception types in `timeouts` are counted as timeouts; any other
+    exception as an error. Exceptions are always re-raised.
+
+    :param servicio: The name of the service (`openai`, `dialogflow`, `telegram`).
+    :param timeouts: Additional exception types that mean the deadline expired.
+    """
+    inicio = time.perf_counter()
+    try:
+        yield
+    except (asyncio.TimeoutError,) + tuple(timeouts):
+        upstream_errores.inc(servicio, "timeout")
+        raise
+    except Exception:
+        upstream_errores.inc(servicio, "error")
+        raise
+    finally:
+        upstream.observar(time.perf_counter() - inicio, servicio)
+
+
+class SolicitudMedida(HTTPXRequest):
+    """
+    The HTTP client of the Bot API that times every call to Telegram and counts the failed ones.
+    """
+
+    def __init__(self, connection_pool_size=256, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+    async def do_request(self, *args, **kwargs):
+        with medir_upstream("telegram", (TimedOut,)):
+            codigo, cuerpo = await super().do_request(*args, **kwargs)
+        if codigo >= 400:
+            upstream_errores.inc("telegram", "error")
+        return codigo, cuerpo
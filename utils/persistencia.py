@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import threading
+
+
+class BackendSQLite:
+    """
+    Session backend stored in a SQLite database in WAL mode. Reads use their own connection so
+    loading a session is never blocked by a batch being written from the flush thread.
+    """
+
+    def __init__(self, ruta):
+        """
+        :param ruta: The path of the SQLite database file.
+        """
+        self.ruta = ruta
+        self._escritura = self._conectar()
+        self._escritura.execute(
+            "CREATE TABLE IF NOT EXISTS sesiones ("
+            "user_id INTEGER PRIMARY KEY, datos TEXT NOT NULL, actualizado REAL NOT NULL)"
+        )
+        self._escritura.commit()
+        self._lectura = self._conectar()
+        self._bloqueo_escritura = threading.Lock()
+        self._bloqueo_lectura = threading.Lock()
+
+    def _conectar(self):
+        conexion = sqlite3.connect(self.ruta, check_same_thread=False)
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("PRAGMA synchronous=NORMAL")
+        return conexion
+
+    def cargar(self, user_id):
+        """
+        The method `cargar` reads the stored state of a session.
+
+        :param user_id: The Telegram user ID.
+        :return: A tuple `(datos, actualizado)` with the session dictionary and the time it was last
+        saved, or None if the user has no stored session.
+        """
+        with self._bloqueo_lectura:
+            fila = self._lectura.execute(
+                "SELECT datos, actualizado FROM sesiones WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if fila is None:
+            return None
+        return json.loads(fila[0]), fila[1]
+
+    def guardar_lote(self, lote, expiracion=None):
+        """
+        The method `guardar_lote` writes a batch of sessions in a single transaction.
+
+        :param lote: A list of `(user_id, datos, actualizado)` tuples; `datos` None deletes the user.
+        :param expiracion: Optional timestamp; sessions saved before it are deleted.
+        """
+        guardar = [
+            (user_id, json.dumps(datos, ensure_ascii=False), actualizado)
+            for user_id, datos, actualizado in lote
+            if datos is not None
+        ]
+        borrar = [(user_id,) for user_id, datos, _ in lote if datos is None]
+        with self._bloqueo_escritura, self._escritura:
+            self._escritura.executemany(
+                "INSERT OR REPLACE INTO sesiones (user_id, datos, actualizado) VALUES (?, ?, ?)",
+                guardar,
+            )
+            self._escritura.executemany("DELETE FROM sesiones WHERE user_id = ?", borrar)
+            if expiracion is not None:
+                self._escritura.execute(
+                    "DELETE FROM sesiones WHERE actualizado < ?", (expiracion,)
+                )
+
+    def cerrar(self):
+        with self._bloqueo_escritura:
+            self._escritura.close()
+        with self._bloqueo_lectura:
+            self._lectura.close()
+
+
+# Crear el backend configurado
+def crear_backend(nombre, ruta):
+    """
+    The function `crear_backend` creates the session backend selected in the settings.
+
+    :param nombre: The backend name: `sqlite`, or `memory` to keep sessions only in memory.
+    :param ruta: The path of the database used by the `sqlite` backend.
+    :return: The backend instance, or None for the in-memory mode.
+    """
+    if nombre == "memory":
+        return None
+    if nombre == "sqlite":
+        return BackendSQLite(ruta)
+    raise ValueError(f"Backend de sesiones desconocido: {nombre}")
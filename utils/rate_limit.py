@@ -0,0 +1,158 @@
+import asyncio
+import time
+
+from conf.settings import (
+    rate_limit_global_rpm,
+    rate_limit_global_tpm,
+    rate_limit_max_wait,
+    rate_limit_mode,
+    rate_limit_user_rpm,
+    rate_limit_user_tpm,
+    session_max,
+)
+from utils.cache import TTLCache
+
+
+class TokenBucket:
+    """
+    Token bucket that refills continuously at a fixed rate up to its capacity.
+    """
+
+    __slots__ = ("_actualizado", "_nivel", "capacidad", "tasa")
+
+    def __init__(self, capacidad, tasa):
+        """
+        :param capacidad: Maximum number of tokens (the allowed burst).
+        :param tasa: Tokens added per second.
+        """
+        self.capacidad = capacidad
+        self.tasa = tasa
+        self._nivel = capacidad
+        self._actualizado = time.monotonic()
+
+    @classmethod
+    def por_minuto(cls, cantidad):
+        return cls(cantidad, cantidad / 60)
+
+    def _rellenar(self):
+        ahora = time.monotonic()
+        self._nivel = min(
+            self.capacidad, self._nivel + (ahora - self._actualizado) * self.tasa
+        )
+        self._actualizado = ahora
+
+    @property
+    def nivel(self):
+        self._rellenar()
+        return self._nivel
+
+    def espera(self, cantidad):
+        """
+        The method `espera` returns how many seconds until `cantidad` tokens are available.
+        """
+        cantidad = min(cantidad, self.capacidad)
+        faltan = cantidad - self.nivel
+        return 0.0 if faltan <= 0 else faltan / self.tasa
+
+    def consumir(self, cantidad):
+        self._rellenar()
+        self._nivel -= min(cantidad, self.capacidad)
+
+
+class LimitadorUso:
+    """
+    Admission control in front of OpenAI with per-user and global token buckets, both for requests
+    per minute and for prompt tokens per minute.
+    """
+
+    def __init__(self, user_rpm, user_tpm, global_rpm, global_tpm, modo, max_espera):
+        """
+        :param user_rpm: Requests per minute allowed to each user.
+        :param user_tpm: Prompt tokens per minute allowed to each user.
+        :param global_rpm: Requests per minute allowed to the whole bot.
+        :param global_tpm: Prompt tokens per minute allowed to the whole bot.
+        :param modo: `queue` to wait up to `max_espera` seconds for capacity, `reject` to refuse
+        immediately.
+        :param max_espera: Maximum number of seconds a request waits in `queue` mode.
+        """
+        self.user_rpm = user_rpm
+        self.user_tpm = user_tpm
+        self.modo = modo
+        self.max_espera = max_espera
+        self.global_solicitudes = TokenBucket.por_minuto(global_rpm)
+        self.global_tokens = TokenBucket.por_minuto(global_tpm)
+        # Un bucket inactivo más de un minuto ya está lleno: se puede descartar
+        self._usuarios = TTLCache(maxsize=session_max, ttl=60)
+        self.admitidas = 0
+        self.rechazadas = 0
+        self.en_espera = 0
+
+    def _buckets(self, user_id):
+        buckets = self._usuarios.get(user_id)
+        if buckets is None:
+            buckets = (
+                TokenBucket.por_minuto(self.user_rpm),
+                TokenBucket.por_minuto(self.user_tpm),
+            )
+        # Renovar el TTL en cada uso
+        self._usuarios.set(user_id, buckets)
+        return buckets + (self.global_solicitudes, self.global_tokens)
+
+    async def admitir(self, user_id, tokens):
+        """
+        The method `admitir` decides whether a request of a user can be sent to OpenAI now.
+
+        :param user_id: The Telegram user ID.
+        :param tokens: Estimated prompt tokens of the request.
+        :return: True if the request was admitted (and its cost consumed), False if it was rejected.
+        """
+        solicitudes, tokens_usuario, solicitudes_global, tokens_global = self._buckets(
+            user_id
+        )
+        costes = (
+            (solicitudes, 1),
+            (tokens_usuario, tokens),
+            (solicitudes_global, 1),
+            (tokens_global, tokens),
+        )
+        limite = time.monotonic() + (self.max_espera if self.modo == "queue" else 0)
+        while True:
+            espera = max(bucket.espera(coste) for bucket, coste in costes)
+            if not espera:
+                for bucket, coste in costes:
+                    bucket.consumir(coste)
+                self.admitidas += 1
+                return True
+            if time.monotonic() + espera > limite:
+                self.rechazadas += 1
+                return False
+            self.en_espera += 1
+            try:
+                await asyncio.sleep(espera)
+            finally:
+                self.en_espera -= 1
+
+    def estado(self):
+        """
+        The method `estado` reports the state of the limiter for the metrics.
+
+        :return: A dictionary with the admission counters and the level of the global buckets.
+        """
+        return {
+            "admitidas": self.admitidas,
+            "rechazadas": self.rechazadas,
+            "en_espera": self.en_espera,
+            "usuarios": len(self._usuarios),
+            "global_solicitudes": self.global_solicitudes.nivel,
+            "global_tokens": self.global_tokens.nivel,
+        }
+
+
+limitador = LimitadorUso(
+    user_rpm=rate_limit_user_rpm,
+    user_tpm=rate_limit_user_tpm,
+    global_rpm=rate_limit_global_rpm,
+    global_tpm=rate_limit_global_tpm,
+    modo=rate_limit_mode,
+    max_espera=rate_limit_max_wait,
+)
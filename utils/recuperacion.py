@@ -0,0 +1,309 @@
+"""
+Local retrieval over the curated corpus of each topic. The BM25 index is built offline from
+`conocimiento/corpus.json` and memory-mapped by the bot:
+
+    python -m utils.recuperacion                                  # build RAG_INDEX_PATH
+    python -m utils.recuperacion --corpus otro.json --salida otro/indice
+    python -m utils.recuperacion --buscar pediculosis "¿cómo se contagian los piojos?"
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import NamedTuple
+
+import numpy as np
+
+from conf.settings import (
+    rag_answer_threshold,
+    rag_enabled,
+    rag_index_path,
+    rag_max_tokens,
+    rag_min_score,
+    rag_top_k,
+)
+from utils.historial import contar_tokens
+from utils.keyword_matcher import PALABRAS_VACIAS, normalizar
+
+logger = logging.getLogger(__name__)
+
+CORPUS = "conocimiento/corpus.json"
+# Las palabras se truncan a esta longitud: "piojo" y "piojos" o "tratar" y "tratamiento"
+# comparten el mismo término
+LONGITUD_RAIZ = 5
+
+_palabras = re.compile(r"[^\W_]+")
+_ARCHIVOS = ("inicios", "documentos", "pesos", "idf")
+
+
+def terminos(texto):
+    """
+    The function `terminos` splits a text into the terms of the index: normalized words without
+    stop words, truncated to `LONGITUD_RAIZ` characters.
+
+    :param texto: The text to split.
+    :return: The list of terms, in order and with repetitions.
+    """
+    return [
+        palabra[:LONGITUD_RAIZ]
+        for palabra in _palabras.findall(normalizar(texto))
+        if len(palabra) > 1 and palabra not in PALABRAS_VACIAS
+    ]
+
+
+def _huella(ruta):
+    with open(ruta, "rb") as archivo:
+        return hashlib.sha256(archivo.read()).hexdigest()
+
+
+class Resultado(NamedTuple):
+    """
+    A passage retrieved for a question.
+    """
+
+    pasaje: dict
+    # Puntuación BM25 del pasaje
+    puntuacion: float
+    # Fracción del IDF de los términos de la pregunta que aparecen en el pasaje (0-1)
+    cobertura: float
+
+
+# Construir el índice BM25 del corpus y guardarlo en una carpeta
+def construir_indice(corpus, salida, k1=1.5, b=0.75, origen=None):
+    """
+    The function `construir_indice` builds the BM25 index of a corpus and writes it as NumPy arrays
+    that the bot memory-maps. For every term the index keeps the passages that contain it with their
+    precomputed BM25 weight, so scoring a question only adds up the postings of its terms.
+
+    :param corpus: A dictionary `{tema: [{"titulo": ..., "preguntas": [...], "texto": ...}]}`.
+    :param salida: The folder where the index is written.
+    :param k1: The term frequency saturation of BM25.
+    :param b: The length normalization of BM25.
+    :param origen: The path of the corpus file, recorded to detect an outdated index.
+    :return: The number of passages and the number of terms of the index.
+    """
+    pasajes = [{"tema": tema, **pasaje} for tema, lista in corpus.items() for pasaje in lista]
+    cuentas = [
+        Counter(terminos(" ".join((p["titulo"], *p.get("preguntas", ()), p["texto"]))))
+        for p in pasajes
+    ]
+    longitudes = np.array([sum(cuenta.values()) for cuenta in cuentas], dtype=np.float64)
+    media = longitudes.mean()
+
+    vocabulario = {
+        termino: indice
+        for indice, termino in enumerate(sorted(set().union(*cuentas)))
+    }
+    listas = [[] for _ in vocabulario]
+    for documento, cuenta in enumerate(cuentas):
+        for termino, frecuencia in cuenta.items():
+            listas[vocabulario[termino]].append((documento, frecuencia))
+
+    total = len(pasajes)
+    idf = np.array(
+        [math.log(1 + (total - len(lista) + 0.5) / (len(lista) + 0.5)) for lista in listas],
+        dtype=np.float32,
+    )
+    inicios = np.cumsum([0] + [len(lista) for lista in listas], dtype=np.int64)
+    documentos = np.array([d for lista in listas for d, _ in lista], dtype=np.int32)
+    frecuencias = np.array([f for lista in listas for _, f in lista], dtype=np.float64)
+    terminos_de = np.repeat(np.arange(len(listas)), np.diff(inicios))
+    normalizacion = k1 * (1 - b + b * longitudes[documentos] / media)
+    pesos = (idf[terminos_de] * frecuencias * (k1 + 1) / (frecuencias + normalizacion)).astype(
+        np.float32
+    )
+
+    os.makedirs(salida, exist_ok=True)
+    for nombre, arreglo in zip(_ARCHIVOS, (inicios, documentos, pesos, idf)):
+        np.save(os.path.join(salida, f"{nombre}.npy"), arreglo)
+    meta = {
+        "vocabulario": vocabulario,
+        "pasajes": pasajes,
+        "k1": k1,
+        "b": b,
+        # IDF de un término que no aparece en el corpus
+        "idf_desconocido": math.log(1 + (total + 0.5) / 0.5),
+        "corpus": origen,
+        "huella": _huella(origen) if origen else None,
+    }
+    with open(os.path.join(salida, "meta.json"), "w", encoding="utf-8") as archivo:
+        json.dump(meta, archivo, ensure_ascii=False)
+    return total, len(vocabulario)
+
+
+class IndiceBM25:
+    """
+    BM25 index of the curated corpus written by `construir_indice`. The postings are memory-mapped,
+    so loading it costs a few milliseconds and its pages are shared between processes.
+    """
+
+    def __init__(self, ruta):
+        """
+        :param ruta: The folder of the index.
+        """
+        with open(os.path.join(ruta, "meta.json"), encoding="utf-8") as archivo:
+            meta = json.load(archivo)
+        self.vocabulario = meta["vocabulario"]
+        self.pasajes = meta["pasajes"]
+        self.corpus = meta["corpus"]
+        self.huella = meta["huella"]
+        self._idf_desconocido = meta["idf_desconocido"]
+        self._inicios, self._documentos, self._pesos, self._idf = (
+            np.load(os.path.join(ruta, f"{nombre}.npy"), mmap_mode="r") for nombre in _ARCHIVOS
+        )
+        self.temas = tuple(dict.fromkeys(pasaje["tema"] for pasaje in self.pasajes))
+        self._tema = np.array([self.temas.index(pasaje["tema"]) for pasaje in self.pasajes])
+
+    def __len__(self):
+        return len(self.pasajes)
+
+    def buscar(self, texto, tema=None, k=3):
+        """
+        The method `buscar` retrieves the passages that best answer a question.
+
+        :param texto: The question.
+        :param tema: Only passages of this topic are returned when given.
+        :param k: The maximum number of passages.
+        :return: A list of up to `k` `Resultado`, best first, with a positive score.
+        """
+        consulta = set(terminos(texto))
+        conocidos = [self.vocabulario[t] for t in consulta if t in self.vocabulario]
+        if not conocidos or (tema is not None and tema not in self.temas):
+            return []
+        total_idf = float(self._idf[conocidos].sum()) + self._idf_desconocido * (
+            len(consulta) - len(conocidos)
+        )
+
+        tramos = [slice(self._inicios[t], self._inicios[t + 1]) for t in conocidos]
+        documentos = np.concatenate([self._documentos[tramo] for tramo in tramos])
+        pesos = np.concatenate([self._pesos[tramo] for tramo in tramos])
+        idf = np.repeat(self._idf[conocidos], [tramo.stop - tramo.start for tramo in tramos])
+        puntuaciones = np.bincount(documentos, weights=pesos, minlength=len(self))
+        cubierto = np.bincount(documentos, weights=idf, minlength=len(self))
+        if tema is not None:
+            puntuaciones[self._tema != self.temas.index(tema)] = 0
+
+        mejores = np.argsort(-puntuaciones, kind="stable")[:k]
+        return [
+            Resultado(self.pasajes[d], float(puntuaciones[d]), float(cubierto[d]) / total_idf)
+            for d in mejores
+            if puntuaciones[d] > 0
+        ]
+
+
+_indice = None
+
+
+def _cargar(ruta):
+    if not rag_enabled:
+        return False
+    if not os.path.exists(os.path.join(ruta, "meta.json")):
+        logger.warning(
+            "No hay índice de recuperación en %s; constrúyelo con python -m utils.recuperacion",
+            ruta,
+        )
+        return False
+    indice = IndiceBM25(ruta)
+    if indice.corpus and os.path.exists(indice.corpus) and _huella(indice.corpus) != indice.huella:
+        logger.warning("El índice de recuperación no corresponde a %s", indice.corpus)
+    logger.info("Índice de recuperación cargado", extra={"pasajes": len(indice)})
+    return indice
+
+
+def obtener_indice():
+    """
+    The function `obtener_indice` loads the index from `RAG_INDEX_PATH` on first use.
+
+    :return: The `IndiceBM25`, or None when retrieval is disabled or the index was not built.
+    """
+    global _indice
+    if _indice is None:
+        _indice = _cargar(rag_index_path)
+    return _indice or None
+
+
+# Pasajes del tema que respaldan la pregunta
+@lru_cache(maxsize=1024)
+def buscar_pasajes(tema, texto):
+    """
+    The function `buscar_pasajes` retrieves the `RAG_TOP_K` passages of a topic that best match a
+    question and score at least `RAG_MIN_SCORE`.
+
+    :param tema: The topic selected by the user.
+    :param texto: The question.
+    :return: A tuple of `Resultado`, best first; empty when there is no index.
+    """
+    indice = obtener_indice()
+    if indice is None:
+        return ()
+    return tuple(r for r in indice.buscar(texto, tema, rag_top_k) if r.puntuacion >= rag_min_score)
+
+
+def respuesta_directa(tema, texto):
+    """
+    The function `respuesta_directa` answers a question with a passage of the corpus, without
+    OpenAI, when the best passage covers at least `RAG_ANSWER_THRESHOLD` of the question.
+
+    :param tema: The topic selected by the user.
+    :param texto: The question.
+    :return: The text of the passage, or None when no passage covers the question well enough.
+    """
+    resultados = buscar_pasajes(tema, texto)
+    if resultados and resultados[0].cobertura >= rag_answer_threshold:
+        return resultados[0].pasaje["texto"]
+    return None
+
+
+def pasajes_para_prompt(tema, texto):
+    """
+    The function `pasajes_para_prompt` selects the texts of the passages injected into the prompt,
+    best first, within `RAG_MAX_TOKENS`.
+
+    :param tema: The topic selected by the user.
+    :param texto: The question.
+    :return: A list with the texts of the passages.
+    """
+    textos = []
+    disponibles = rag_max_tokens
+    for resultado in buscar_pasajes(tema, texto):
+        tokens = contar_tokens(resultado.pasaje["texto"])
+        if tokens > disponibles:
+            break
+        textos.append(resultado.pasaje["texto"])
+        disponibles -= tokens
+    return textos
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the BM25 index of the curated corpus")
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--salida", default=rag_index_path)
+    parser.add_argument("--k1", type=float, default=1.5)
+    parser.add_argument("--b", type=float, default=0.75)
+    parser.add_argument(
+        "--buscar", nargs=2, metavar=("TEMA", "PREGUNTA"), help="Query the built index instead"
+    )
+    args = parser.parse_args()
+
+    if args.buscar:
+        tema, pregunta = args.buscar
+        for resultado in IndiceBM25(args.salida).buscar(pregunta, tema, rag_top_k):
+            print(
+                f"{resultado.puntuacion:7.3f}  {resultado.cobertura:5.2f}  "
+                f"{resultado.pasaje['titulo']}"
+            )
+        return
+
+    with open(args.corpus, encoding="utf-8") as archivo:
+        corpus = json.load(archivo)
+    pasajes, vocabulario = construir_indice(corpus, args.salida, args.k1, args.b, args.corpus)
+    print(f"Índice de {pasajes} pasajes y {vocabulario} términos escrito en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
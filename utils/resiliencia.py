@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from conf.settings import (
+    breaker_error_rate,
+    breaker_min_calls,
+    breaker_open_seconds,
+    breaker_slow_rate,
+    breaker_window,
+    retry_backoff_base,
+    retry_backoff_max,
+)
+from utils.metricas import circuito_aperturas, circuito_rechazos, reintentos
+
+logger = logging.getLogger(__name__)
+
+CERRADO = "cerrado"
+ABIERTO = "abierto"
+SEMIABIERTO = "semiabierto"
+
+
+class CircuitoAbierto(Exception):
+    """
+    Raised instead of calling a service whose circuit breaker is open.
+    """
+
+    def __init__(self, servicio, restante):
+        super().__init__(f"El circuito de {servicio} está abierto ({restante:.1f} s)")
+        self.servicio = servicio
+
+
+class Interruptor:
+    """
+    Circuit breaker of an external service over the outcomes of its last calls. It opens when, with
+    enough calls in the window, the share of failed calls or the share of slow calls reaches its
+    threshold. While open every call fails at once with `CircuitoAbierto`; after `espera` seconds a
+    single probe call is let through (half-open) and its outcome closes or reopens the breaker.
+    """
+
+    def __init__(
+        self,
+        servicio,
+        lenta,
+        ventana=breaker_window,
+        minimo=breaker_min_calls,
+        tasa_errores=breaker_error_rate,
+        tasa_lentas=breaker_slow_rate,
+        espera=breaker_open_seconds,
+    ):
+        """
+        :param servicio: The name of the service (`openai`, `dialogflow`).
+        :param lenta: Seconds from which a successful call counts as slow.
+        :param ventana: Number of recent calls considered.
+        :param minimo: Calls needed in the window before the breaker can open.
+        :param tasa_errores: Share of failed calls that opens the breaker.
+        :param tasa_lentas: Share of slow calls that opens the breaker.
+        :param espera: Seconds the breaker stays open before the probe call.
+        """
+        self.servicio = servicio
+        self.lenta = lenta
+        self.minimo = minimo
+        self.tasa_errores = tasa_errores
+        self.tasa_lentas = tasa_lentas
+        self.espera = espera
+        self.estado = CERRADO
+        # (fallida, lenta) de cada llamada reciente
+        self._resultados = deque(maxlen=ventana)
+        self._abierto_hasta = 0.0
+        self._sondeando = False
+
+    def permitir(self):
+        """
+        The method `permitir` admits a call, or raises `CircuitoAbierto` if the breaker is open or
+        its probe call is still in flight.
+        """
+        if self.estado == CERRADO:
+            return
+        ahora = time.monotonic()
+        if self.estado == ABIERTO and ahora >= self._abierto_hasta:
+            self.estado = SEMIABIERTO
+        if self.estado == SEMIABIERTO and not self._sondeando:
+            self._sondeando = True
+            return
+        circuito_rechazos.inc(self.servicio)
+        raise CircuitoAbierto(self.servicio, max(self._abierto_hasta - ahora, 0))
+
+    def registrar(self, exito, segundos):
+        """
+        The method `registrar` records the outcome of an admitted call.
+
+        :param exito: Whether the call succeeded.
+        :param segundos: The duration of the call.
+        """
+        lenta = segundos >= self.lenta
+        if self.estado == SEMIABIERTO:
+            if exito and not lenta:
+                self._cerrar()
+            else:
+                self._abrir()
+            return
+        if self.estado == ABIERTO:
+            return
+        self._resultados.append((not exito, lenta))
+        total = len(self._resultados)
+        if total < self.minimo:
+            return
+        fallidas = sum(fallida for fallida, _ in self._resultados)
+        lentas = sum(lenta for _, lenta in self._resultados)
+        if fallidas >= self.tasa_errores * total or lentas >= self.tasa_lentas * total:
+            self._abrir()
+
+    def liberar(self):
+        """
+        The method `liberar` forgets an admitted call that was cancelled before it finished, so a
+        cancelled probe does not keep the breaker half-open forever.
+        """
+        if self.estado == SEMIABIERTO:
+            self._sondeando = False
+
+    def _abrir(self):
+        self.estado = ABIERTO
+        self._abierto_hasta = time.monotonic() + self.espera
+        self._sondeando = False
+        self._resultados.clear()
+        circuito_aperturas.inc(self.servicio)
+        logger.warning(
+            "Circuito abierto", extra={"servicio": self.servicio, "espera": self.espera}
+        )
+
+    def _cerrar(self):
+        self.estado = CERRADO
+        self._sondeando = False
+        self._resultados.clear()
+        logger.info("Circuito cerrado", extra={"servicio": self.servicio})
+
+
+def espera_reintento(intento):
+    """
+    The function `espera_reintento` returns the pause before a retry: exponential backoff with full
+    jitter, so the clients that failed together do not retry together.
+
+    :param intento: The number of the failed attempt, starting at 0.
+    :return: The seconds to wait.
+    """
+    return random.uniform(0, min(retry_backoff_max, retry_backoff_base * 2**intento))
+
+
+async def llamar(interruptor, funcion, plazo, intentos_extra, reintentables=()):
+    """
+    The function `llamar` calls an external service through its circuit breaker, retrying the
+    transient failures with jittered backoff while the overall deadline allows it.
+
+    :param interruptor: The `Interruptor` of the service.
+    :param funcion: A callable that receives the seconds left before the deadline and returns the
+    awaitable performing one attempt.
+    :param plazo: The overall deadline in seconds, retries included.
+    :param intentos_extra: The maximum number of retries.
+    :param reintentables: Exception types worth retrying, besides `asyncio.TimeoutError`.
+    :return: The result of the first successful attempt. Raises `CircuitoAbierto` when the breaker
+    rejects the call, or the error of the last attempt.
+    """
+    loop = asyncio.get_running_loop()
+    limite = loop.time() + plazo
+    reintentables = (asyncio.TimeoutError,) + tuple(reintentables)
+    intento = 0
+    while True:
+        interruptor.permitir()
+        inicio = loop.time()
+        try:
+            resultado = await funcion(limite - inicio)
+        except asyncio.CancelledError:
+            interruptor.liberar()
+            raise
+        except Exception as error:
+            interruptor.registrar(False, loop.time() - inicio)
+            espera = espera_reintento(intento)
+            if (
+                intento >= intentos_extra
+                or not isinstance(error, reintentables)
+                or loop.time() + espera >= limite
+            ):
+                raise
+            logger.info(
+                "Reintentando",
+                extra={"servicio": interruptor.servicio, "intento": intento + 1, "error": str(error)},
+            )
+            reintentos.inc(interruptor.servicio)
+            intento += 1
+            await asyncio.sleep(espera)
+        else:
+            interruptor.registrar(True, loop.time() - inicio)
+            return resultado
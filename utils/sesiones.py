@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from conf.settings import (
+    session_backend,
+    session_db_path,
+    session_flush_interval,
+    session_max,
+    session_ttl,
+)
+from utils.historial import Historial
+from utils.persistencia import crear_backend
+
+logger = logging.getLogger(__name__)
+
+
+class Sesion:
+    """
+    Conversation state of a Telegram user: name, selected topic, whether the bot is waiting for the
+    farewell confirmation and the message history.
+    """
+
+    __slots__ = ("esperando_confirmacion", "historial", "name", "tema", "ultimo_acceso")
+
+    def __init__(self):
+        self.name = None
+        self.tema = None
+        self.esperando_confirmacion = False
+        self.historial = Historial()
+        self.ultimo_acceso = time.time()
+
+    def a_dict(self):
+        """
+        The method `a_dict` returns the session as a JSON-serializable dictionary.
+        """
+        return {
+            "name": self.name,
+            "tema": self.tema,
+            "esperando_confirmacion": self.esperando_confirmacion,
+            "historial": self.historial.a_dict(),
+        }
+
+    @classmethod
+    def desde_dict(cls, datos):
+        """
+        The method `desde_dict` rebuilds a session saved with `a_dict`.
+        """
+        sesion = cls()
+        sesion.name = datos["name"]
+        sesion.tema = datos["tema"]
+        sesion.esperando_confirmacion = datos["esperando_confirmacion"]
+        sesion.historial = Historial.desde_dict(datos["historial"])
+        return sesion
+
+
+class AlmacenSesiones:
+    """
+    Bounded store of user sessions. Sessions idle for longer than the TTL are evicted and, when the
+    store is full, the least recently used session is evicted first, so memory stays bounded no
+    matter how many distinct users talk to the bot.
+
+    With a persistent backend, sessions are loaded lazily with `cargar` from a background thread
+    and every session marked as changed with `marcar` is written behind in batches by a background
+    task, so the update path never waits on disk.
+    """
+
+    def __init__(self, max_sesiones, ttl, backend=None):
+        """
+        :param max_sesiones: Maximum number of sessions kept in memory.
+        :param ttl: Seconds of inactivity after which a session is evicted.
+        :param backend: Optional persistent backend (see `utils.persistencia`).
+        """
+        self.max_sesiones = max_sesiones
+        self.ttl = ttl
+        self.backend = backend
+        self.expulsadas = 0
+        self._sesiones = OrderedDict()
+        # Sesiones modificadas pendientes de escribir (None indica que se borró)
+        self._pendientes = {}
+        # Lote que se está escribiendo
+        self._escribiendo = {}
+        self._escritura = None
+        self._ejecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sesiones")
+        # Las lecturas usan su propio hilo para no esperar a que termine un lote
+        self._lector = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sesiones-lectura")
+
+    def __len__(self):
+        return len(self._sesiones)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def _purgar(self, ahora):
+        # Las sesiones están ordenadas por último acceso: basta revisar las más antiguas
+        limite = ahora - self.ttl
+        while self._sesiones:
+            user_id, sesion = next(iter(self._sesiones.items()))
+            if sesion.ultimo_acceso > limite:
+                break
+            del self._sesiones[user_id]
+            self.expulsadas += 1
+
+    def _guardar_en_memoria(self, user_id, sesion):
+        self._sesiones[user_id] = sesion
+        self._sesiones.move_to_end(user_id)
+        while len(self._sesiones) > self.max_sesiones:
+            self._sesiones.popitem(last=False)
+            self.expulsadas += 1
+
+    def _sin_escribir(self, user_id):
+        # Copia que todavía no llegó al backend, pendiente o en el lote que se está escribiendo:
+        # es más reciente que la guardada (None indica que se borró)
+        for cambios in (self._pendientes, self._escribiendo):
+            if user_id in cambios:
+                return True, cambios[user_id]
+        return False, None
+
+    def _recuperar(self, user_id, sesion, ahora):
+        if sesion is None or sesion.ultimo_acceso <= ahora - self.ttl:
+            return None
+        self._guardar_en_memoria(user_id, sesion)
+        return sesion
+
+    def get(self, user_id):
+        """
+        The method `get` returns the session of a user and marks it as recently used. It never
+        reads the persistent backend: the update path loads the session first with `cargar`.
+
+        :param user_id: The Telegram user ID.
+        :return: The `Sesion` of the user, or None if there is none (or it expired).
+        """
+        ahora = time.time()
+        self._purgar(ahora)
+        sesion = self._sesiones.get(user_id)
+        if sesion is None:
+            encontrada, sesion = self._sin_escribir(user_id)
+            if encontrada:
+                sesion = self._recuperar(user_id, sesion, ahora)
+        if sesion is not None:
+            sesion.ultimo_acceso = ahora
+            self._sesiones.move_to_end(user_id)
+        return sesion
+
+    async def cargar(self, user_id):
+        """
+        The method `cargar` returns the session of a user like `get`, but when it is not in memory
+        it is read from the persistent backend in a background thread, so the event loop never
+        waits on disk. It is awaited once at the start of every update; the later `get` calls of
+        the update find the session in memory.
+
+        :param user_id: The Telegram user ID.
+        :return: The `Sesion` of the user, or None if there is none (or it expired).
+        """
+        sesion = self.get(user_id)
+        if sesion is not None or self.backend is None or self._sin_escribir(user_id)[0]:
+            return sesion
+        loop = asyncio.get_running_loop()
+        guardada = await loop.run_in_executor(self._lector, self.backend.cargar, user_id)
+        # Mientras se leía, la sesión pudo crearse o cambiar en memoria
+        if guardada is None or user_id in self._sesiones or self._sin_escribir(user_id)[0]:
+            return self.get(user_id)
+        datos, actualizado = guardada
+        sesion = Sesion.desde_dict(datos)
+        sesion.ultimo_acceso = actualizado
+        self._recuperar(user_id, sesion, time.time())
+        return self.get(user_id)
+
+    def marcar(self, user_id):
+        """
+        The method `marcar` records that the session of a user changed, so the background writer
+        saves it. It must be called after every change to a session, including the ones made after
+        an `await`, since a batch may have been written in between.
+
+        :param user_id: The Telegram user ID.
+        """
+        if self.backend is not None and user_id in self._sesiones:
+            self._pendientes[user_id] = self._sesiones[user_id]
+
+    def crear(self, user_id):
+        """
+        The method `crear` creates a new empty session for a user, replacing any previous one.
+
+        :param user_id: The Telegram user ID.
+        :return: The new `Sesion`.
+        """
+        self._purgar(time.time())
+        sesion = Sesion()
+        self._guardar_en_memoria(user_id, sesion)
+        if self.backend is not None:
+            self._pendientes[user_id] = sesion
+        return sesion
+
+    def obtener_o_crear(self, user_id):
+        sesion = self.get(user_id)
+        return self.crear(user_id) if sesion is None else sesion
+
+    def pop(self, user_id, default=None):
+        if self.backend is not None:
+            self._pendientes[user_id] = None
+        return self._sesiones.pop(user_id, default)
+
+    def memoria(self):
+        """
+        The method `memoria` estimates the memory used by the stored sessions, including the text of
+        their histories and summaries.
+
+        :return: The approximate size in bytes.
+        """
+        total = sys.getsizeof(self._sesiones)
+        for sesion in self._sesiones.values():
+            historial = sesion.historial
+            total += sys.getsizeof(sesion) + sys.getsizeof(historial)
+            total += sys.getsizeof(historial.mensajes) + sys.getsizeof(historial.tokens)
+            total += sum(sys.getsizeof(m) + sys.getsizeof(m["content"]) for m in historial.mensajes)
+            total += sum(sys.getsizeof(linea) for linea, _ in historial.resumen)
+            if sesion.name:
+                total += sys.getsizeof(sesion.name)
+        return total
+
+    def _lote(self):
+        pendientes, self._pendientes = self._pendientes, {}
+        self._escribiendo = pendientes
+        return [
+            (user_id, None, None)
+            if sesion is None
+            else (user_id, sesion.a_dict(), sesion.ultimo_acceso)
+            for user_id, sesion in pendientes.items()
+        ]
+
+    async def vaciar(self):
+        """
+        The method `vaciar` writes every pending session to the backend. The sessions are serialized
+        on the event loop and the batch is written from a background thread.
+        """
+        if self.backend is None or not self._pendientes:
+            return
+        lote = self._lote()
+        escribiendo = self._escribiendo
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                self._ejecutor, self.backend.guardar_lote, lote, time.time() - self.ttl
+            )
+        finally:
+            if self._escribiendo is escribiendo:
+                self._escribiendo = {}
+
+    async def _escribir_periodicamente(self, intervalo):
+        while True:
+            await asyncio.sleep(intervalo)
+            try:
+                await self.vaciar()
+            except Exception:
+                logger.warning("No se pudieron guardar las sesiones", exc_info=True)
+
+    def iniciar_escritura_diferida(self, intervalo=session_flush_interval):
+        """
+        The method `iniciar_escritura_diferida` opens the backend selected in the settings, unless
+        the store was given one, and starts the background task that writes the pending sessions
+        every `intervalo` seconds. Until then sessions are kept only in memory, so importing the
+        store never touches the disk.
+        """
+        if self.backend is None:
+            self.backend = crear_backend(session_backend, session_db_path)
+        if self.backend is not None and self._escritura is None:
+            self._escritura = asyncio.create_task(
+                self._escribir_periodicamente(intervalo)
+            )
+
+    async def cerrar(self):
+        """
+        The method `cerrar` stops the background writer, flushes the pending sessions and closes the
+        backend. It is meant to be called on shutdown.
+        """
+        if self._escritura is not None:
+            self._escritura.cancel()
+            self._escritura = None
+        if self.backend is not None:
+            await self.vaciar()
+            self.backend.cerrar()
+            self.backend = None
+
+
+# Almacén compartido por los puntos de entrada y las utilidades
+sesiones = AlmacenSesiones(max_sesiones=session_max, ttl=session_ttl)
@@ -0,0 +1,74 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent requests: while a call for a key is in flight, every other
+    request for the same key waits for that call and receives its result instead of sending its
+    own request upstream.
+    """
+
+    def __init__(self):
+        self._en_vuelo = {}
+        self.compartidas = 0
+
+    def __len__(self):
+        return len(self._en_vuelo)
+
+    def en_vuelo(self, clave):
+        """
+        The method `en_vuelo` returns the future of the call in flight for a key.
+
+        :param clave: The key of the request.
+        :return: The future of the call, or None if there is no call in flight for the key.
+        """
+        return self._en_vuelo.get(clave)
+
+    def publicar(self, clave):
+        """
+        The method `publicar` registers a call in flight for a key. The caller must resolve the
+        returned future with `set_result` or `set_exception`; it is unregistered once resolved.
+
+        :param clave: The key of the request.
+        :return: The future that other requests for the key will wait on.
+        """
+        futuro = asyncio.get_running_loop().create_future()
+        self._en_vuelo[clave] = futuro
+        futuro.add_done_callback(lambda _: self._retirar(clave, futuro))
+        return futuro
+
+    def _retirar(self, clave, futuro):
+        if self._en_vuelo.get(clave) is futuro:
+            del self._en_vuelo[clave]
+        # Evitar el aviso de excepción no recuperada cuando nadie más esperaba
+        if not futuro.cancelled():
+            futuro.exception()
+
+    async def esperar(self, futuro):
+        """
+        The method `esperar` waits for a call in flight without cancelling it if the waiter is
+        cancelled.
+        """
+        self.compartidas += 1
+        return await asyncio.shield(futuro)
+
+    async def hacer(self, clave, funcion):
+        """
+        The method `hacer` runs `funcion()` for a key, or waits for the call already in flight for
+        the same key and shares its result.
+
+        :param clave: The key of the request.
+        :param funcion: A callable that returns the awaitable performing the upstream call.
+        :return: The result of the shared call.
+        """
+        futuro = self._en_vuelo.get(clave)
+        if futuro is not None:
+            return await self.esperar(futuro)
+        tarea = asyncio.ensure_future(funcion())
+        self._en_vuelo[clave] = tarea
+        tarea.add_done_callback(lambda _: self._retirar(clave, tarea))
+        return await asyncio.shield(tarea)
+
+
+# Llamadas en vuelo compartidas por todo el bot
+vuelos = SingleFlight()
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+
+from telegram.error import BadRequest, RetryAfter
+
+from conf.settings import telegram_edit_interval
+from utils.envios import MASIVA, prioridad
+
+logger = logging.getLogger(__name__)
+
+# Longitud máxima de un mensaje de texto en Telegram
+LIMITE_MENSAJE = 4096
+MARCADOR = "✍️..."
+
+
+# Editar el mensaje sin romper el flujo si Telegram lo rechaza
+async def _editar(mensaje, texto):
+    try:
+        await mensaje.edit_text(texto)
+    except RetryAfter as error:
+        logger.warning(
+            "Edición limitada por Telegram", extra={"reintentar_en": error.retry_after}
+        )
+        return error.retry_after
+    except BadRequest as error:
+        # Telegram rechaza las ediciones que no cambian el texto
+        if "not modified" not in str(error).lower():
+            raise
+    return 0
+
+
+# Enviar la respuesta a Telegram a medida que llegan los fragmentos
+async def responder_en_streaming(message, fragmentos):
+    """
+    The function `responder_en_streaming` sends a placeholder reply and keeps editing it with the text
+    received so far, so the user sees the answer while it is still being generated. Edits are
+    coalesced to one every `TELEGRAM_EDIT_INTERVAL` seconds to stay under Telegram's rate limits.
+
+    :param message: The Telegram message being answered.
+    :param fragmentos: An async iterable with the text fragments of the answer.
+    :return: The complete text of the answer.
+    """
+    enviado = await message.reply_text(MARCADOR)
+    loop = asyncio.get_running_loop()
+    partes = []
+    mostrado = MARCADOR
+    proxima_edicion = loop.time() + telegram_edit_interval
+
+    async for fragmento in fragmentos:
+        partes.append(fragmento)
+        if loop.time() < proxima_edicion:
+            continue
+        texto = "".join(partes)[:LIMITE_MENSAJE]
+        espera = 0
+        if texto != mostrado:
+            # Las ediciones intermedias ceden el paso a las respuestas de otros usuarios
+            with prioridad(MASIVA):
+                espera = await _editar(enviado, texto)
+            if not espera:
+                mostrado = texto
+        proxima_edicion = loop.time() + max(telegram_edit_interval, espera)
+
+    texto = "".join(partes)
+    if not texto:
+        await enviado.delete()
+        return texto
+
+    # Confirmar el texto final, dividiéndolo si supera el límite de Telegram
+    bloques = [
+        texto[inicio : inicio + LIMITE_MENSAJE]
+        for inicio in range(0, len(texto), LIMITE_MENSAJE)
+    ]
+    if bloques[0] != mostrado:
+        espera = await _editar(enviado, bloques[0])
+        if espera:
+            await asyncio.sleep(espera)
+            await _editar(enviado, bloques[0])
+    for bloque in bloques[1:]:
+        await message.reply_text(bloque)
+    return texto
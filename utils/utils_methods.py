@@ -1,21 +1,61 @@
-import unicodedata
-import openai
+from typing import NamedTuple
+
+import asyncio
+import contextvars
 import logging
-import dialogflow_v2 as dialogflow
+import re
 
 from telegram import InlineKeyboardButton
-from conf.settings import (
-    dialogflow_project_id,
-    dialogflow_session_id,
-    dialogflow_language_code,
-)
+from utils.keyword_matcher import KeywordMatcher, normalizar
+from utils.cache import TTLCache
+from utils.dialogflow_client import detect_intent
+from utils.historial import Historial
+from utils.sesiones import sesiones
+from utils.single_flight import vuelos
+from utils.llm_client import completar, completar_stream
+from utils.rate_limit import limitador
+from utils.recuperacion import pasajes_para_prompt, respuesta_directa
+from utils.metricas import respuestas_corpus
+from conf.settings import faq_cache_size, faq_cache_ttl
 
-# Configurar logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Diccionario para guardar mensajes y nombres de usuarios
-usuarios = {}
+
+# Respuestas a preguntas sin contexto, por (tema, pregunta normalizada)
+faq_cache = TTLCache(maxsize=faq_cache_size, ttl=faq_cache_ttl)
+_signos = re.compile(r"[^\w\s]")
+# Llamada en vuelo a la que `controlar_limite` unió la pregunta pendiente en lugar de admitirla
+_vuelo_unido = contextvars.ContextVar("vuelo_unido", default=None)
+
+MENSAJE_LIMITE = (
+    "Estoy recibiendo muchas preguntas en este momento. "
+    "Por favor, espera unos segundos y vuelve a intentarlo."
+)
+
+# Respuestas de cada tema cuando OpenAI no responde
+RESPUESTAS_RESPALDO = {
+    "pediculosis": (
+        "En este momento no puedo darte una respuesta detallada. En resumen: la pediculosis es "
+        "la infestación del cuero cabelludo por piojos. Se trata con un champú o loción "
+        "pediculicida y retirando las liendres con un peine fino, y se previene revisando el pelo "
+        "con frecuencia y evitando compartir peines, gorros o almohadas. "
+        "Vuelve a preguntarme en unos minutos."
+    ),
+    "parasitismo": (
+        "En este momento no puedo darte una respuesta detallada. En resumen: el parasitismo "
+        "intestinal lo causan parásitos como lombrices, oxiuros o giardias que se contagian por "
+        "agua o alimentos contaminados y por las manos sucias. Se previene lavándose las manos, "
+        "lavando frutas y verduras y tomando agua segura; ante dolor abdominal, diarrea o picor "
+        "anal consulta a un profesional de la salud. Vuelve a preguntarme en unos minutos."
+    ),
+}
+RESPUESTA_RESPALDO = (
+    "En este momento no puedo responder tu pregunta. "
+    "Por favor, vuelve a intentarlo en unos minutos."
+)
+RESPUESTA_INTERRUMPIDA = (
+    "\n\n(La respuesta se interrumpió. Vuelve a preguntarme en unos minutos.)"
+)
 
 # Lista de palabras clave relacionadas con pediculosis y parasitismo
 palabras_clave = {
@@ -257,6 +297,78 @@ palabras_despedida = [
     "bye",
 ]
 
+# Frases que indican una solicitud de imágenes. Los nombres de los temas ("piojos", "parásitos")
+# y las palabras sueltas comunes ("foto", "muestra", "ejemplo") no cuentan: aparecen en preguntas
+# normales como "¿cómo se tratan los piojos?"
+palabras_imagen = [
+    "imagen",
+    "muéstrame imagenes",
+    "muéstrame una imagen",
+    "mostrar imagenes",
+    "ver imagenes",
+    "ver una imagen",
+    "muéstrame fotos",
+    "ver fotos",
+    "infografía",
+    # Imagenes pediculosis
+    "muéstrame una imagen de pediculosis",
+    "¿tienes fotos de piojos?",
+    "dame un ejemplo visual de pediculosis",
+    "quiero ver una infografía sobre pediculosis",
+    "¿puedes mostrarme cómo se ven los piojos?",
+    "¿tienes imágenes de los síntomas de pediculosis?",
+    "muéstrame fotos de tratamientos para pediculosis",
+    "¿qué aspecto tiene la pediculosis?",
+    "quiero ver una imagen de cómo prevenir la pediculosis",
+    # Imagenes parasitismo
+    "muéstrame una imagen de parasitismo",
+    "¿tienes fotos de parásitos?",
+    "dame un ejemplo visual de parasitismo",
+    "quiero ver una infografía sobre parasitismo",
+    "¿puedes mostrarme cómo se ven los parásitos?",
+    "¿tienes imágenes de los síntomas de parasitismo?",
+    "muéstrame fotos de tratamientos para parasitismo",
+    "¿qué aspecto tienen los parásitos?",
+    "quiero ver una imagen de cómo prevenir el parasitismo",
+]
+
+GRUPO_DESPEDIDA = "__despedida__"
+GRUPO_IMAGEN = "__imagen__"
+
+# Compilar una sola vez todas las palabras clave en un autómata
+clasificador = KeywordMatcher(
+    {
+        **palabras_clave,
+        GRUPO_DESPEDIDA: palabras_despedida,
+        GRUPO_IMAGEN: palabras_imagen,
+    }
+)
+
+
+# Resultado de clasificar un mensaje en una sola pasada
+class Clasificacion(NamedTuple):
+    temas: tuple
+    despedida: bool
+    imagen: bool
+    # 1 para las palabras clave exactas, la puntuación del modelo para las aproximadas
+    confianza: float = 1.0
+
+    @property
+    def vacia(self):
+        return not (self.temas or self.despedida or self.imagen)
+
+    def otro_tema(self, tema_actual):
+        """
+        The method `otro_tema` returns the first matched topic that is different from the current one.
+
+        :param tema_actual: The topic the user selected.
+        :return: The name of another matched topic, or None if there is none.
+        """
+        for tema in self.temas:
+            if tema != tema_actual:
+                return tema
+        return None
+
 
 # Normalizar el texto acentuado
 def normalize_text(text):
@@ -272,9 +384,7 @@ def normalize_text(text):
     form NFD, removes any combining diacritical marks, and converts the text to lowercase. The function
     returns the normalized and lowercase text.
     """
-    return "".join(
-        c for c in unicodedata.normalize("NFD", text) if unicodedata.category(c) != "Mn"
-    ).lower()
+    return normalizar(text)
 
 
 # Colocar la primera letra mayúscula
@@ -292,8 +402,26 @@ def capitalize_first_letter(text):
     return text[0].upper() + text[1:]
 
 
+# Clasificar el mensaje contra todos los temas, despedidas e imágenes
+def clasificar_mensaje(message_text):
+    """
+    The function `clasificar_mensaje` classifies a message in a single linear pass over the compiled
+    keyword automaton.
+
+    :param message_text: The text of the message sent by the user.
+    :return: A `Clasificacion` with every matched topic (in the order of `palabras_clave`), and
+    whether the message is a farewell and/or an image request.
+    """
+    grupos = clasificador.clasificar(message_text)
+    return Clasificacion(
+        temas=tuple(tema for tema in palabras_clave if tema in grupos),
+        despedida=GRUPO_DESPEDIDA in grupos,
+        imagen=GRUPO_IMAGEN in grupos,
+    )
+
+
 # Guardar el mensaje del usuario
-def handle_user_message(user_id, message_text):
+def handle_user_message(user_id, message_text, tema=None):
     """
     The function `handle_user_message` stores user messages in a dictionary based on the user ID.
 
@@ -301,16 +429,15 @@ def handle_user_message(user_id, message_text):
     is used to keep track of the user's interactions and messages within the system
     :param message_text: The `message_text` parameter in the `handle_user_message` function is the text
     of the message sent by the user. It is the content of the user's message that will be stored in the
-    `usuarios` dictionary under the respective user's ID
+    session store under the respective user's ID
+    :param tema: The topic currently selected by the user, used to pin the system prompt of the
+    conversation history
     """
-    if user_id not in usuarios:
-        usuarios[user_id] = {
-            "messages": [{"role": "user", "content": message_text}],
-            "name": None,
-            "tema": None,
-        }
-    else:
-        usuarios[user_id]["messages"].append({"role": "user", "content": message_text})
+    sesion = sesiones.obtener_o_crear(user_id)
+    if tema is not None:
+        sesion.tema = tema
+    sesion.historial.agregar("user", message_text)
+    sesiones.marcar(user_id)
 
 
 # Comprobar si el mensaje está relacionado con el tema seleccionado
@@ -326,12 +453,8 @@ def mensaje_relacionado_con_temas(message_text, tema):
     :return: The function `mensaje_relacionado_con_temas` returns a boolean value indicating whether the
     message text is related to the specified topic (`tema`).
     """
-    normalized_message = normalize_text(message_text)
-    related = any(
-        normalize_text(palabra) in normalized_message
-        for palabra in palabras_clave.get(tema, [])
-    )
-    logger.info(f"Mensaje relacionado con tema '{tema}': {related}")
+    related = tema in clasificar_mensaje(message_text).temas
+    logger.debug("Mensaje relacionado con tema %s: %s", tema, related)
     return related
 
 
@@ -348,11 +471,11 @@ def mensaje_de_despedida(message_text):
     the `message_text` (converted to lowercase) is present in the list `palabras_despedida`. If at least
     one word is found, it returns `True`, otherwise it returns `False`.
     """
-    return any(palabra in message_text.lower() for palabra in palabras_despedida)
+    return clasificar_mensaje(message_text).despedida
 
 
 # Enviar el mensaje a Dialogflow y obtener la respuesta
-def get_dialogflow_response(message_text):
+async def get_dialogflow_response(message_text, user_id=None):
     """
     The function `get_dialogflow_response` processes a message text using Dialogflow to extract and
     format fulfillment messages with images, titles, and buttons.
@@ -360,21 +483,12 @@ def get_dialogflow_response(message_text):
     :param message_text: The `get_dialogflow_response` function you provided seems to be a Python
     function that interacts with Dialogflow to get responses based on a given message text. It
     constructs messages based on the fulfillment messages received from Dialogflow
+    :param user_id: The Telegram user ID, used to keep a separate Dialogflow session per user
     :return: The `get_dialogflow_response` function returns a list of messages extracted from the
     fulfillment messages received from Dialogflow. These messages can include a combination of text,
     images, and buttons.
     """
-    session_client = dialogflow.SessionsClient()
-    session = session_client.session_path(dialogflow_project_id, dialogflow_session_id)
-    text_input = dialogflow.types.TextInput(
-        text=message_text, language_code=dialogflow_language_code
-    )
-    query_input = dialogflow.types.QueryInput(text=text_input)
-
-    response = session_client.detect_intent(session=session, query_input=query_input)
-
-    # Imprimir la respuesta completa para depuración
-    logger.info(f"Respuesta completa de Dialogflow: {response}")
+    response = await detect_intent(message_text, user_id)
 
     # Lista para almacenar todos los mensajes
     messages = []
@@ -406,30 +520,259 @@ def get_dialogflow_response(message_text):
     return messages
 
 
+# Normalizar una pregunta para usarla como clave de la caché
+def clave_pregunta(message_text):
+    """
+    The function `clave_pregunta` normalizes a question so that trivial variations (accents, case,
+    punctuation and spacing) map to the same cache key.
+
+    :param message_text: The text of the question.
+    :return: The normalized question.
+    """
+    return " ".join(_signos.sub(" ", normalize_text(message_text)).split())
+
+
+# Clave de la caché para la pregunta pendiente, solo si no depende del contexto
+def _clave_faq(user_id):
+    sesion = sesiones.get(user_id)
+    historial = sesion.historial
+    if len(historial) != 1 or historial.resumen:
+        return None
+    return (sesion.tema, clave_pregunta(historial.mensajes[0]["content"]))
+
+
+# Responder desde la caché de preguntas frecuentes
+def get_faq_response(user_id):
+    """
+    The function `get_faq_response` answers the pending question of a user from the FAQ cache. Only
+    first-turn questions are served, so answers that depend on earlier context are never reused.
+    On a hit the cached answer is added to the user's message history.
+
+    :param user_id: The ID of the user whose pending question is looked up.
+    :return: The cached answer, or None when the question is not cached or depends on context.
+    """
+    clave = _clave_faq(user_id)
+    if clave is None:
+        return None
+    reply = faq_cache.get(clave)
+    if reply is not None:
+        sesiones.get(user_id).historial.agregar("assistant", reply)
+        sesiones.marcar(user_id)
+    return reply
+
+
+# Responder con un pasaje del corpus que cubre la pregunta, sin llamar a OpenAI
+def responder_desde_corpus(user_id):
+    """
+    The function `responder_desde_corpus` answers the pending question of a user with a passage of
+    the curated corpus of the topic when it covers the question well enough, and adds the answer to
+    the user's message history.
+
+    :param user_id: The ID of the user whose pending question is answered.
+    :return: The text of the passage, or None when the question needs the model.
+    """
+    sesion = sesiones.get(user_id)
+    reply = respuesta_directa(sesion.tema, sesion.historial.mensajes[-1]["content"])
+    if reply is not None:
+        respuestas_corpus.inc()
+        sesion.historial.agregar("assistant", reply)
+        sesiones.marcar(user_id)
+    return reply
+
+
+# Prompt de la pregunta pendiente con los pasajes del corpus que la respaldan
+def _prompt(sesion):
+    pregunta = sesion.historial.mensajes[-1]["content"]
+    return sesion.historial.prompt(sesion.tema, pasajes_para_prompt(sesion.tema, pregunta))
+
+
+# Controlar los límites de uso antes de llamar a OpenAI
+async def controlar_limite(user_id):
+    """
+    The function `controlar_limite` checks the pending question of a user against the per-user and
+    global rate limits. When the limits are hit the question is removed from the history, so a
+    flooding user cannot grow it, and a cached answer is served if there is one for the same
+    question (even if it was asked with context), otherwise a friendly message.
+
+    A question identical to one already being answered joins that call instead of being admitted,
+    and `generate_response_stream` later waits for that same call even if it has finished by then,
+    so the question never reaches OpenAI without having been admitted.
+
+    :param user_id: The ID of the user whose pending question is checked.
+    :return: None if the question was admitted, otherwise the text to reply instead of calling
+    OpenAI.
+    """
+    sesion = sesiones.get(user_id)
+    historial = sesion.historial
+    clave = _clave_faq(user_id)
+    compartida = None if clave is None else vuelos.en_vuelo(("llm",) + clave)
+    _vuelo_unido.set(compartida)
+    if compartida is not None:
+        # Se compartirá una llamada en curso: no consume cupo
+        return None
+    if await limitador.admitir(user_id, historial.total_tokens + historial.tokens_resumen):
+        return None
+    pregunta = historial.mensajes[-1]["content"]
+    historial.descartar_ultimo()
+    sesiones.marcar(user_id)
+    logger.info("Límite de uso alcanzado", extra={"user_id": user_id})
+    return faq_cache.get((sesion.tema, clave_pregunta(pregunta))) or MENSAJE_LIMITE
+
+
+# Responder sin OpenAI cuando falla o su interruptor está abierto
+def respuesta_de_respaldo(user_id):
+    """
+    The function `respuesta_de_respaldo` answers the pending question of a user without OpenAI. The
+    question is removed from the history, so it can be asked again once OpenAI recovers, and the
+    cached answer of the same question is served if there is one, otherwise a canned answer of the
+    topic.
+
+    :param user_id: The ID of the user whose question could not be answered.
+    :return: The text to reply instead of the answer of the model.
+    """
+    sesion = sesiones.get(user_id)
+    pregunta = sesion.historial.mensajes[-1]["content"]
+    sesion.historial.descartar_ultimo()
+    sesiones.marcar(user_id)
+    return faq_cache.get((sesion.tema, clave_pregunta(pregunta))) or RESPUESTAS_RESPALDO.get(
+        sesion.tema, RESPUESTA_RESPALDO
+    )
+
+
+# Precalcular las respuestas de las preguntas canónicas de cada tema
+async def precalentar_faq():
+    """
+    The function `precalentar_faq` precomputes the answers for the canonical questions listed in
+    `palabras_clave` and stores them in the FAQ cache.
+
+    :return: The number of answers stored.
+    """
+
+    async def precalcular(tema, pregunta):
+        historial = Historial()
+        historial.agregar("user", pregunta)
+        try:
+            reply = await completar(
+                historial.prompt(tema, pasajes_para_prompt(tema, pregunta))
+            )
+        except Exception:
+            logger.warning(f"No se pudo precalcular '{pregunta}'", exc_info=True)
+            return 0
+        faq_cache.set((tema, clave_pregunta(pregunta)), reply)
+        return 1
+
+    preguntas = {
+        (tema, clave_pregunta(palabra)): palabra
+        for tema, palabras in palabras_clave.items()
+        for palabra in palabras
+        if "?" in palabra
+    }
+    resultados = await asyncio.gather(
+        *(precalcular(tema, pregunta) for (tema, _), pregunta in preguntas.items())
+    )
+    logger.info(f"Caché de preguntas frecuentes precalentada: {sum(resultados)}")
+    return sum(resultados)
+
+
 # Generar la respuesta del bot
-def generate_response(user_id):
+async def generate_response(user_id):
     """
     The function `generate_response` uses OpenAI's GPT-3.5-turbo model to generate a response based on
     the messages associated with a user ID, and then adds the response to the user's message history.
+    The call is awaited through `utils.llm_client`, so it does not block the event loop. When OpenAI
+    fails or its circuit breaker is open, the answer of `respuesta_de_respaldo` is returned instead.
 
     :param user_id: The `user_id` parameter in the `generate_response` function is used to identify a
     specific user for whom a response is being generated. This user ID is used to retrieve the messages
-    associated with that user from the `usuarios` dictionary, which presumably contains information
+    associated with that user from the session store, which presumably contains information
     about users and their messages. The response
     :return: The function `generate_response(user_id)` returns the reply generated by the OpenAI
     ChatCompletion model based on the messages associated with the user ID provided as input.
     """
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=usuarios[user_id]["messages"],
-    )
+    sesion = sesiones.get(user_id)
+    clave = _clave_faq(user_id)
+    prompt = _prompt(sesion)
+    try:
+        if clave is None:
+            reply = await completar(prompt)
+        else:
+            # Compartir la llamada con las preguntas idénticas que estén en curso
+            reply = await vuelos.hacer(("llm",) + clave, lambda: completar(prompt))
+            faq_cache.set(clave, reply)
+    except Exception:
+        logger.warning("Respuesta de respaldo", extra={"user_id": user_id}, exc_info=True)
+        return respuesta_de_respaldo(user_id)
+
+    # Añadir la respuesta al historial
+    sesion.historial.agregar("assistant", reply)
+    sesiones.marcar(user_id)
+    return reply
 
-    # Obtener la respuesta
-    reply = response.choices[0].message["content"]
 
-    # Añadir la respuesta al diccionario
-    usuarios[user_id]["messages"].append({"role": "assistant", "content": reply})
-    return reply
+# Generar la respuesta del bot fragmento a fragmento
+async def generate_response_stream(user_id):
+    """
+    The function `generate_response_stream` streams the reply for a user from OpenAI and, once the
+    stream is complete, adds the full reply to the user's message history. When OpenAI fails before
+    the first fragment the answer of `respuesta_de_respaldo` is yielded instead; when it fails
+    midway, a note that the answer was interrupted.
+
+    :param user_id: The ID of the user whose message history is sent to the model.
+    :return: An async generator with the text fragments of the reply as they arrive.
+    """
+    sesion = sesiones.get(user_id)
+    clave = _clave_faq(user_id)
+    futuro = None
+    # La llamada a la que se unió la pregunta al controlar el límite pudo terminar mientras se
+    # enviaba el mensaje provisional: se espera igualmente su resultado
+    compartida = _vuelo_unido.get()
+    _vuelo_unido.set(None)
+    if clave is not None:
+        if compartida is None:
+            compartida = vuelos.en_vuelo(("llm",) + clave)
+        if compartida is not None:
+            # Otra solicitud idéntica ya está generando la respuesta
+            try:
+                reply = await vuelos.esperar(compartida)
+            except Exception:
+                logger.warning(
+                    "Respuesta de respaldo", extra={"user_id": user_id}, exc_info=True
+                )
+                yield respuesta_de_respaldo(user_id)
+                return
+            yield reply
+            sesion.historial.agregar("assistant", reply)
+            sesiones.marcar(user_id)
+            return
+        futuro = vuelos.publicar(("llm",) + clave)
+
+    partes = []
+    try:
+        async for fragmento in completar_stream(_prompt(sesion)):
+            partes.append(fragmento)
+            yield fragmento
+    except BaseException as error:
+        if futuro is not None:
+            futuro.set_exception(
+                error
+                if isinstance(error, Exception)
+                else RuntimeError("Respuesta interrumpida")
+            )
+        if not isinstance(error, Exception):
+            raise
+        logger.warning("Respuesta de respaldo", extra={"user_id": user_id}, exc_info=True)
+        respaldo = respuesta_de_respaldo(user_id)
+        yield RESPUESTA_INTERRUMPIDA if partes else respaldo
+        return
+
+    reply = "".join(partes)
+    if futuro is not None:
+        futuro.set_result(reply)
+        faq_cache.set(clave, reply)
+
+    # Añadir la respuesta completa al historial
+    sesion.historial.agregar("assistant", reply)
+    sesiones.marcar(user_id)
 
 
 # Comprobar si el mensaje está relacionado con cualquier tema disponible
@@ -451,10 +794,4 @@ def mensaje_relacionado_con_otro_tema(message_text, tema_actual):
     topic are found in the normalized message text and that topic is not the current topic, then that
     different topic is returned. If no such topic is found, it returns None.
     """
-    normalized_message = normalize_text(message_text)
-    for tema, palabras in palabras_clave.items():
-        if tema != tema_actual and any(
-            normalize_text(palabra) in normalized_message for palabra in palabras
-        ):
-            return tema
-    return None
+    return clasificar_mensaje(message_text).otro_tema(tema_actual)